@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+补丁应用的预写日志(journal)
+
+apply/switch在修改源码树之前先写入begin条目，记录本次事务将要处理的全部
+目标文件并立即fsync；之后每处理完一个目标文件追加一条done条目，按批次fsync。
+事务完成并写入应用记录后删除日志文件。
+
+进程崩溃或被中断后，日志文件仍然存在：
+1. 再次执行同一配置的apply/switch时，done条目中内容哈希与磁盘一致的文件被跳过，
+   其余文件从原始内容重新计算
+2. 执行restore时，按begin条目中的目标文件列表逐个还原
+
+每个目标文件都以“临时文件+原子替换”的方式写入，因此不会出现写了一半的文件；
+done条目丢失最多导致对应文件被重新处理一次。
+
+日志格式为每行一个JSON对象：
+  {"op": "begin", "command": "apply", "config": {...}, "targets": [...], "time": ...}
+  {"op": "done", "target": "<相对路径>", "results": [true, ...], "sha256": "..."}
+"""
+
+import json
+import os
+import time
+
+# 累计多少条done条目或距上次fsync多少秒后执行一次fsync
+SYNC_EVERY = 64
+SYNC_INTERVAL = 0.5
+
+
+class JournalState(object):
+    """从日志文件中读出的未完成事务"""
+
+    def __init__(self, command, config, targets, done):
+        self.command = command
+        self.config = config
+        self.targets = targets
+        # 相对路径 -> (成功标志列表, 写入后的内容哈希)
+        self.done = done
+
+    @property
+    def fingerprint_id(self):
+        return self.config.get("fingerprint_id")
+
+
+def load(path):
+    """读取未完成的事务，日志不存在或没有有效的begin条目时返回None
+
+    崩溃时最后一行可能只写了一半，解析失败的行会被忽略。
+    """
+    if not os.path.exists(path):
+        return None
+    begin = None
+    done = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get("op") == "begin":
+                begin = entry
+                done = {}
+            elif entry.get("op") == "done" and begin is not None:
+                done[entry["target"]] = (entry["results"], entry["sha256"])
+    if begin is None:
+        return None
+    return JournalState(begin["command"], begin["config"], begin["targets"], done)
+
+
+class ApplyJournal(object):
+    """以追加方式写入的预写日志，done条目按批次fsync"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._pending = 0
+        self._last_sync = 0.0
+
+    def begin(self, command, config, targets, resume=False):
+        """开始事务；resume为True时在已有日志后继续追加"""
+        self._file = open(self.path, "a" if resume else "w", encoding="utf-8")
+        if not resume:
+            self._append({
+                "op": "begin",
+                "command": command,
+                "config": config,
+                "targets": targets,
+                "time": time.time()
+            })
+        # begin条目必须在修改任何文件之前落盘
+        self.sync()
+
+    def record_done(self, target, results, sha256):
+        """记录一个目标文件已处理完成"""
+        self._append({"op": "done", "target": target, "results": results, "sha256": sha256})
+        self._pending += 1
+        if self._pending >= SYNC_EVERY or time.monotonic() - self._last_sync >= SYNC_INTERVAL:
+            self.sync()
+
+    def _append(self, entry):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def sync(self):
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        """同步并关闭日志文件（保留文件，用于恢复或回滚）"""
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def commit(self):
+        """事务完成，删除日志文件"""
+        self.close()
+        remove(self.path)
+
+
+def remove(path):
+    """删除日志文件，并同步所在目录使删除落盘"""
+    if not os.path.exists(path):
+        return
+    os.unlink(path)
+    try:
+        dir_fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+构建产物缓存
+
+多个配置往往只在params上不同，对应的补丁后源码完全一致。该模块以
+(源码版本, 有序补丁内容, 构建参数) 的规范化哈希为键缓存构建产物，支持：
+1. 命中时跳过构建，以reflink（不支持时复制）方式还原产物
+2. 未命中时在构建成功后保存产物
+3. 按最近使用时间(LRU)在容量上限内淘汰旧条目
+4. 记录并输出命中/未命中统计
+
+目录结构：
+  artifact_cache/index.json               # 条目大小、最近使用时间及统计
+  artifact_cache/<键>/<产物相对路径>      # 缓存的产物文件
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+import subprocess
+import threading
+import time
+
+import blob_store
+
+INDEX_VERSION = 1
+
+
+def source_revision(src_dir):
+    """获取源码目录的git版本，无法获取时返回unknown"""
+    try:
+        result = subprocess.run(["git", "-C", src_dir, "rev-parse", "HEAD"],
+                                capture_output=True, text=True)
+    except OSError:
+        return "unknown"
+    if result.returncode != 0:
+        return "unknown"
+    return result.stdout.strip()
+
+
+def compute_cache_key(revision, patch_set, build_args, patch_hash):
+    """计算构建产物缓存键
+
+    patch_set为((目标相对路径, (补丁文件, ...)), ...)，按目标路径排序、组内保持
+    应用顺序；patch_hash(补丁文件)返回补丁内容哈希，使补丁内容变化时键随之变化。
+    """
+    canonical = {
+        "revision": revision,
+        "patches": [[target, [patch_hash(p) for p in patches]] for target, patches in patch_set],
+        "build_args": build_args.split()
+    }
+    data = json.dumps(canonical, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+class ArtifactCache(object):
+    """以补丁集合哈希为键的本地构建产物缓存"""
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(root, "index.json")
+        self._lock = threading.Lock()
+        self.session_hits = 0
+        self.session_misses = 0
+
+    def _load_index(self):
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, "r", encoding="utf-8") as f:
+                    index = json.load(f)
+                if index.get("version") == INDEX_VERSION:
+                    return index
+            except (OSError, ValueError):
+                pass
+        return {"version": INDEX_VERSION, "entries": {}, "stats": {"hits": 0, "misses": 0}}
+
+    def _save_index(self, index):
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = f"{self.index_file}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.index_file)
+
+    def lookup(self, key, out_root, artifacts):
+        """查找缓存，命中时将产物还原到out_root下并返回True"""
+        with self._lock:
+            index = self._load_index()
+            entry = index["entries"].get(key)
+            entry_dir = os.path.join(self.root, key)
+            hit = entry is not None and all(
+                os.path.isfile(os.path.join(entry_dir, rel)) for rel in artifacts
+            )
+            if hit:
+                for rel in artifacts:
+                    src = os.path.join(entry_dir, rel)
+                    # 不使用硬链接：构建或调试工具原地改写还原出的产物时会连带污染缓存
+                    method = blob_store.materialize_file(
+                        src, os.path.join(out_root, rel),
+                        mode=stat.S_IMODE(os.stat(src).st_mode))
+                    print(f"已从缓存还原产物: {rel} ({method})")
+                entry["last_access"] = time.time()
+                index["stats"]["hits"] += 1
+                self.session_hits += 1
+            else:
+                index["stats"]["misses"] += 1
+                self.session_misses += 1
+            self._save_index(index)
+            return hit
+
+    def store(self, key, out_root, artifacts, meta=None):
+        """构建成功后保存产物，并按LRU淘汰超出容量的条目"""
+        missing = [rel for rel in artifacts if not os.path.isfile(os.path.join(out_root, rel))]
+        if missing:
+            print(f"警告: 以下产物不存在，未写入缓存: {', '.join(missing)}")
+            return False
+        total = sum(os.path.getsize(os.path.join(out_root, rel)) for rel in artifacts)
+        if total > self.max_bytes:
+            print(f"警告: 产物共 {total / 1024 / 1024:.1f} MB，超过缓存容量 "
+                  f"{self.max_bytes / 1024 / 1024:.1f} MB，未写入缓存")
+            return False
+
+        with self._lock:
+            entry_dir = os.path.join(self.root, key)
+            tmp_dir = f"{entry_dir}.tmp"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            size = 0
+            for rel in artifacts:
+                src = os.path.join(out_root, rel)
+                dest = os.path.join(tmp_dir, rel)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                # 缓存副本不使用硬链接，避免后续构建原地改写产物时污染缓存
+                blob_store.clone_file(src, dest)
+                shutil.copymode(src, dest)
+                size += os.path.getsize(dest)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+
+            index = self._load_index()
+            index["entries"][key] = {
+                "size": size,
+                "artifacts": list(artifacts),
+                "created": time.time(),
+                "last_access": time.time(),
+                "meta": meta or {}
+            }
+            self._evict(index, keep=key)
+            self._save_index(index)
+            print(f"已将 {len(artifacts)} 个产物写入缓存 ({size / 1024 / 1024:.1f} MB)")
+            return True
+
+    def _evict(self, index, keep=None):
+        """按最近使用时间淘汰条目（keep除外），直到总大小不超过上限"""
+        entries = index["entries"]
+        total = sum(e["size"] for e in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= entries[key]["size"]
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+            del entries[key]
+            print(f"缓存超出容量，已淘汰条目: {key[:12]}")
+
+    def report(self):
+        """输出本次及累计的命中统计"""
+        index = self._load_index()
+        stats = index["stats"]
+        total = stats["hits"] + stats["misses"]
+        rate = stats["hits"] / total * 100 if total else 0.0
+        used = sum(e["size"] for e in index["entries"].values())
+        print(f"产物缓存: 本次命中 {self.session_hits} 次，未命中 {self.session_misses} 次；"
+              f"累计命中率 {rate:.1f}% ({stats['hits']}/{total})，"
+              f"占用 {used / 1024 / 1024:.1f} MB / {self.max_bytes / 1024 / 1024:.1f} MB，"
+              f"共 {len(index['entries'])} 个条目")
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+补丁管理系统性能基准测试
+
+该脚本在临时目录中生成一个Chromium规模的合成源码树，用于衡量
+patch_manager.py在大规模源码下的表现，支持以下功能：
+1. 生成合成源码树：大量填充文件、PATCH_FILE_MAPPINGS中的真实目录结构、
+   以canvas_rendering_context_2d.cc为模板的大型源文件
+2. 为每个指纹类别和模式生成可叠加的补丁集
+3. 在冷/热缓存下分别计时：补丁索引构建、应用补丁、还原补丁、生成补丁
+4. 将结果保存为JSON，并与基线比较以发现性能回退
+
+整个过程完全离线运行。注意：“冷缓存”指清空本工具自身的索引、备份和解析
+缓存，操作系统的页缓存不会被清除。
+
+使用方法：
+  python benchmark.py                                  # 默认规模运行
+  python benchmark.py --files=400000 --output=bench.json
+  python benchmark.py --save-baseline                  # 保存为基线
+  python benchmark.py --baseline=bench_baseline.json --tolerance=0.2
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import patch_manager
+
+# 全局配置
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_SOURCE = os.path.join(BASE_DIR, 'canvas_rendering_context_2d.cc')
+DEFAULT_BASELINE = os.path.join(BASE_DIR, 'bench_baseline.json')
+
+# 合成补丁使用的模式
+BENCH_MODES = ['custom', 'noise', 'random']
+
+# 每个目录中的填充文件数
+FILES_PER_DIR = 40
+
+# 映射文件的最小行数，保证每个类别都有独立的补丁区域
+MIN_TARGET_LINES = 2000
+
+
+def _load_template_lines():
+    """读取大型源文件模板"""
+    if os.path.exists(TEMPLATE_SOURCE):
+        with open(TEMPLATE_SOURCE, "r", encoding="utf-8", errors="replace") as f:
+            lines = f.read().splitlines()
+    else:
+        lines = [f"int placeholder_{i} = {i};" for i in range(1000)]
+    return lines
+
+
+def _target_lines(rel_path, template):
+    """生成映射文件的内容：模板内容重复到足够长度，每行带唯一标记便于补丁定位"""
+    lines = []
+    while len(lines) < MIN_TARGET_LINES:
+        for line in template:
+            lines.append(f"{line}  // {len(lines)}")
+    return [f"// {rel_path}"] + lines
+
+
+def _category_region(category):
+    """每个类别在目标文件中修改的行号（互不重叠，保证同一文件上的补丁可叠加）"""
+    return 10 + patch_manager.FINGERPRINT_CATEGORIES.index(category) * 40
+
+
+def _make_patch(rel_path, lines, line_no, added):
+    """生成在line_no行之后插入added的补丁文本（3行上下文）"""
+    start = line_no - 2
+    context_before = lines[start - 1:line_no]
+    context_after = lines[line_no:line_no + 3]
+    old_count = len(context_before) + len(context_after)
+    body = [f" {l}" for l in context_before] + [f"+{l}" for l in added] + [f" {l}" for l in context_after]
+    header = [
+        f"diff --git a/{rel_path} b/{rel_path}",
+        f"--- a/{rel_path}",
+        f"+++ b/{rel_path}",
+        f"@@ -{start},{old_count} +{start},{old_count + len(added)} @@"
+    ]
+    return "\n".join(header + body) + "\n"
+
+
+def generate_tree(root, total_files, seed=0):
+    """生成合成源码树和补丁集，返回统计信息"""
+    rng = random.Random(seed)
+    src_dir = os.path.join(root, 'src')
+    patches_dir = os.path.join(root, 'patches')
+    template = _load_template_lines()
+
+    mapped = sorted(set(f for files in patch_manager.PATCH_FILE_MAPPINGS.values() for f in files))
+
+    # 目录结构：映射文件的所有祖先目录，再在其下派生子目录
+    base_dirs = set()
+    for rel in mapped:
+        parent = os.path.dirname(rel)
+        while parent:
+            base_dirs.add(parent)
+            parent = os.path.dirname(parent)
+    base_dirs = sorted(base_dirs)
+
+    dir_count = max(1, total_files // FILES_PER_DIR)
+    dirs = list(base_dirs)
+    while len(dirs) < dir_count:
+        parent = rng.choice(dirs)
+        dirs.append(f"{parent}/gen_{len(dirs)}")
+
+    file_count = 0
+    filler = "// synthetic filler\nint value_{0} = {0};\n"
+    for index, rel_dir in enumerate(dirs):
+        directory = os.path.join(src_dir, rel_dir)
+        os.makedirs(directory, exist_ok=True)
+        for j in range(FILES_PER_DIR):
+            if file_count >= total_files:
+                break
+            suffix = ".h" if j % 3 == 0 else ".cc"
+            with open(os.path.join(directory, f"file_{j}{suffix}"), "w") as f:
+                f.write(filler.format(index * FILES_PER_DIR + j))
+            file_count += 1
+
+    contents = {}
+    for rel in mapped:
+        lines = _target_lines(rel, template)
+        contents[rel] = lines
+        path = os.path.join(src_dir, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    patch_count = 0
+    for category, files in patch_manager.PATCH_FILE_MAPPINGS.items():
+        category_dir = os.path.join(patches_dir, category)
+        os.makedirs(category_dir, exist_ok=True)
+        for mode in BENCH_MODES:
+            for rel in files:
+                added = [f"  // {category} {mode} fingerprint hook", f"  FingerprintHook_{category}();"]
+                text = _make_patch(rel, contents[rel], _category_region(category), added)
+                name = os.path.basename(os.path.dirname(rel))
+                with open(os.path.join(category_dir, f"{mode}_{name}_{os.path.basename(rel)}.patch"), "w") as f:
+                    f.write(text)
+                patch_count += 1
+
+    return {"files": file_count + len(mapped), "dirs": len(dirs), "mapped_files": len(mapped), "patches": patch_count}
+
+
+def _write_config(root, mode):
+    """生成启用全部类别、使用指定模式的配置文件"""
+    config = {
+        "fingerprint_mode": "fixed",
+        "fingerprint_id": f"bench_{mode}",
+        "creation_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "settings": {c: {"enabled": True, "mode": mode, "params": {}} for c in patch_manager.FINGERPRINT_CATEGORIES}
+    }
+    path = os.path.join(root, 'configs', f"bench_{mode}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2)
+    return path
+
+
+def _point_patch_manager(root):
+    """将patch_manager的全局路径指向合成目录"""
+    patch_manager.SRC_DIR = os.path.join(root, 'src')
+    patch_manager.PATCHES_DIR = os.path.join(root, 'patches')
+    patch_manager.CONFIG_DIR = os.path.join(root, 'configs')
+    patch_manager.BACKUP_DIR = os.path.join(root, 'backups')
+    patch_manager.OVERLAY_DIR = os.path.join(root, 'overlays')
+    patch_manager.PATCH_INDEX_FILE = os.path.join(root, 'patches_index.json')
+    patch_manager.FILE_STATE_INDEX_FILE = os.path.join(root, 'file_state_index.json')
+    patch_manager.APPLY_JOURNAL_FILE = os.path.join(root, 'apply_journal.jsonl')
+    patch_manager.STATE_DB_FILE = os.path.join(root, 'state.db')
+    patch_manager.PLAN_CACHE_FILE = os.path.join(root, 'plan_cache.json')
+    patch_manager.CONFLICT_MATRIX_FILE = os.path.join(root, 'patch_conflicts.json')
+    patch_manager.DAEMON_SOCKET_FILE = os.path.join(root, '.patch_daemon.sock')
+    patch_manager.BUILD_HISTORY_FILE = os.path.join(root, 'build_history.jsonl')
+    patch_manager.BUNDLE_CACHE_DIR = os.path.join(root, 'bundle_cache')
+    patch_manager.SRC_INDEX_FILE = os.path.join(root, 'src_index.bin')
+    patch_manager.BUILD_RULES_DIR = os.path.join(root, 'build_rules')
+    patch_manager.CHECK_COMPILE_DIR = os.path.join(root, 'check_compile')
+    patch_manager.BISECT_DIR = os.path.join(root, 'bisect')
+    patch_manager.REBASED_PATCHES_DIR = os.path.join(root, 'patches_rebased')
+    os.makedirs(patch_manager.CONFIG_DIR, exist_ok=True)
+
+
+def _drop_tool_caches(root):
+    """清空本工具的磁盘和进程内缓存（冷缓存）"""
+    for name in ('patches_index.json', 'file_state_index.json', 'plan_cache.json', 'patch_conflicts.json'):
+        path = os.path.join(root, name)
+        if os.path.exists(path):
+            os.unlink(path)
+    shutil.rmtree(os.path.join(root, 'backups'), ignore_errors=True)
+    patch_manager._PARSED_PATCHES.clear()
+    patch_manager._PATCH_HASHES.clear()
+    patch_manager._BLOB_STORE = None
+
+
+def _timed(func, *args, **kwargs):
+    """静默执行并返回耗时（秒）"""
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def _bench_generate(root, count):
+    """为若干映射文件生成补丁"""
+    src_dir = patch_manager.SRC_DIR
+    mapped = sorted(set(f for files in patch_manager.PATCH_FILE_MAPPINGS.values() for f in files))[:count]
+    for rel in mapped:
+        target = os.path.join(src_dir, rel)
+        backup = patch_manager.pristine_file_path(target)
+        patch_manager.generate_patch(backup, target, "custom_bench", "language")
+
+
+def run_benchmarks(root, jobs):
+    """运行全部基准测试，返回{名称: {"cold": 秒, "warm": 秒}}"""
+    _point_patch_manager(root)
+    config = _write_config(root, 'custom')
+    results = {}
+
+    # 补丁索引构建
+    _drop_tool_caches(root)
+    cold = _timed(patch_manager.build_patch_index)
+    warm = _timed(patch_manager.build_patch_index)
+    results["build_patch_index"] = {"cold": cold, "warm": warm}
+
+    # 应用与还原（冷：无备份、无索引、无解析缓存；热：第二轮）
+    _drop_tool_caches(root)
+    apply_cold = _timed(patch_manager.apply_fingerprint_patches, config, jobs=jobs)
+    restore_cold = _timed(patch_manager.restore_all_patches)
+    apply_warm = _timed(patch_manager.apply_fingerprint_patches, config, jobs=jobs)
+    restore_warm = _timed(patch_manager.restore_all_patches)
+    results["apply_fingerprint_patches"] = {"cold": apply_cold, "warm": apply_warm}
+    results["restore_all_patches"] = {"cold": restore_cold, "warm": restore_warm}
+
+    # 生成补丁（需要git）
+    if shutil.which("git"):
+        with contextlib.redirect_stdout(io.StringIO()):
+            patch_manager.apply_fingerprint_patches(config, jobs=jobs)
+        cold = _timed(_bench_generate, root, 20)
+        warm = _timed(_bench_generate, root, 20)
+        with contextlib.redirect_stdout(io.StringIO()):
+            patch_manager.restore_all_patches()
+        results["generate_patch"] = {"cold": cold, "warm": warm}
+    else:
+        print("未找到git，跳过生成补丁的基准测试")
+
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """与基线比较，返回回退项列表[(名称, 缓存状态, 基线耗时, 当前耗时), ...]"""
+    regressions = []
+    for name, timings in results.items():
+        base = baseline.get("results", {}).get(name)
+        if not base:
+            continue
+        for phase, seconds in timings.items():
+            base_seconds = base.get(phase)
+            if base_seconds and seconds > base_seconds * (1 + tolerance):
+                regressions.append((name, phase, base_seconds, seconds))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="补丁管理系统性能基准测试")
+    parser.add_argument("--files", type=int, default=200000, help="合成源码树中的文件数（默认200000）")
+    parser.add_argument("--workdir", help="合成源码树目录（默认使用临时目录，结束后删除）")
+    parser.add_argument("--keep", action="store_true", help="保留合成源码树")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="应用补丁时的并发数")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--output", help="结果JSON输出路径")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="基线JSON路径")
+    parser.add_argument("--save-baseline", action="store_true", help="将本次结果保存为基线")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的相对回退幅度（默认0.2，即20%%）")
+
+    args = parser.parse_args()
+
+    root = args.workdir or tempfile.mkdtemp(prefix="fp_bench_")
+    os.makedirs(root, exist_ok=True)
+    try:
+        if not os.path.exists(os.path.join(root, 'src')):
+            print(f"正在生成合成源码树: {root}")
+            start = time.perf_counter()
+            tree = generate_tree(root, args.files, args.seed)
+            print(f"生成完成: {tree['files']} 个文件，{tree['dirs']} 个目录，{tree['patches']} 个补丁，"
+                  f"耗时 {time.perf_counter() - start:.1f}秒")
+        else:
+            tree = {}
+            print(f"复用已有的合成源码树: {root}")
+
+        results = run_benchmarks(root, args.jobs)
+    finally:
+        if not args.workdir and not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "python": sys.version.split()[0],
+        "params": {"files": args.files, "jobs": args.jobs, "seed": args.seed},
+        "tree": tree,
+        "results": results
+    }
+
+    print("\n===== 基准测试结果 =====")
+    for name, timings in results.items():
+        print(f"{name:28s} 冷: {timings['cold'] * 1000:9.1f} ms   热: {timings['warm'] * 1000:9.1f} ms")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\n结果已保存: {args.output}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"基线已保存: {args.baseline}")
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("params") != report["params"]:
+            print("警告: 基线的测试参数与本次不同，比较结果仅供参考")
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n发现 {len(regressions)} 项性能回退（容差 {args.tolerance:.0%}）：")
+            for name, phase, base_seconds, seconds in regressions:
+                print(f"  {name} [{phase}]: {base_seconds * 1000:.1f} ms -> {seconds * 1000:.1f} ms")
+            return 1
+        print(f"\n与基线相比未发现性能回退（容差 {args.tolerance:.0%}）")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+内容寻址的备份存储
+
+该模块用于替代按源码路径镜像的备份目录，支持以下功能：
+1. 按SHA-256存储去重后的文件内容(blob)，多个源码目录、多个版本共享同一份内容
+2. 为每个源码目录维护一份清单(manifest)，记录相对路径到内容哈希的映射
+3. 还原时优先使用FICLONE写时复制(reflink)，不支持时退回到普通复制
+4. 可选的git模式：原始内容与源码仓库HEAD一致时，只记录git对象ID，
+   还原时直接从Chromium源码仓库的对象数据库读取，不额外占用磁盘
+
+目录结构：
+  backups/objects/<哈希前2位>/<哈希剩余部分>   # blob文件（只读）
+  backups/manifests/<源码目录ID>.json          # 每个源码目录的清单
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+import subprocess
+import threading
+
+# linux/fs.h: #define FICLONE _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# 读取文件时的块大小
+CHUNK_SIZE = 1024 * 1024
+
+
+class BackupMissingError(OSError):
+    """备份记录对应的原始内容无法读取（git对象丢失且blob存储中没有该内容）"""
+
+
+def file_sha256(path):
+    """分块计算文件的SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def git_blob_oid(data):
+    """计算内容对应的git blob对象ID"""
+    header = f"blob {len(data)}\0".encode("ascii")
+    return hashlib.sha1(header + data).hexdigest()
+
+
+def reflink(src, dst):
+    """尝试以FICLONE创建写时复制副本，成功返回True"""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except OSError:
+        try:
+            os.unlink(dst)
+        except OSError:
+            pass
+        return False
+
+
+def clone_file(src, dst, allow_hardlink=False):
+    """以最低成本在dst处得到src的内容，返回使用的方式
+
+    依次尝试reflink、硬链接（仅allow_hardlink为True时）和普通复制。
+    硬链接与源文件共享inode，只适用于之后不会被原地修改的文件。
+    """
+    if reflink(src, dst):
+        return "reflink"
+    if allow_hardlink:
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+def _replace_into(dest, fill, mode=None):
+    """通过临时文件加原子替换写入dest
+
+    替换而非原地写入，保证dest原有的硬链接（例如其他工作区或缓存）不会被
+    连带修改；新文件的mtime为当前时间。
+    """
+    tmp_path = f"{dest}.fp_tmp"
+    if os.path.lexists(tmp_path):
+        os.unlink(tmp_path)
+    fill(tmp_path)
+    if mode is None:
+        if os.path.exists(dest):
+            mode = stat.S_IMODE(os.stat(dest).st_mode)
+        else:
+            mode = 0o644
+    os.chmod(tmp_path, mode)
+    os.replace(tmp_path, dest)
+
+
+def materialize_file(src, dest, allow_hardlink=False, mode=None):
+    """以reflink/硬链接/复制的方式将src放到dest（替换写入），返回使用的方式"""
+    os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+    method = []
+    _replace_into(dest, lambda tmp: method.append(clone_file(src, tmp, allow_hardlink)), mode)
+    return method[0]
+
+
+def checkout_id(src_dir):
+    """根据源码目录的真实路径计算清单ID"""
+    real = os.path.realpath(src_dir)
+    return hashlib.sha256(real.encode("utf-8")).hexdigest()[:16]
+
+
+class GitObjectReader(object):
+    """通过常驻的 git cat-file --batch 进程读取源码仓库中的对象"""
+
+    def __init__(self, repo_dir, rev="HEAD"):
+        self.repo_dir = repo_dir
+        self.rev = rev
+        self._process = None
+        self._lock = threading.Lock()
+
+    def _ensure_process(self):
+        if self._process is None:
+            self._process = subprocess.Popen(
+                ["git", "-C", self.repo_dir, "cat-file", "--batch"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL
+            )
+        return self._process
+
+    def _request(self, spec):
+        process = self._ensure_process()
+        process.stdin.write(spec.encode("utf-8") + b"\n")
+        process.stdin.flush()
+        header = process.stdout.readline().decode("utf-8").split()
+        if len(header) != 3:
+            return None, None
+        oid, _, size = header
+        data = process.stdout.read(int(size))
+        process.stdout.read(1)  # 结尾的换行符
+        return oid, data
+
+    def read_path(self, rel_path):
+        """读取指定版本中某个路径的内容，返回(对象ID, 内容)或(None, None)"""
+        with self._lock:
+            try:
+                return self._request(f"{self.rev}:{rel_path.replace(os.sep, '/')}")
+            except OSError:
+                return None, None
+
+    def read_oid(self, oid):
+        """按对象ID读取内容"""
+        with self._lock:
+            try:
+                return self._request(oid)[1]
+            except OSError:
+                return None
+
+    def close(self):
+        if self._process is not None:
+            self._process.stdin.close()
+            self._process.wait()
+            self._process = None
+
+
+class BlobStore(object):
+    """内容寻址的blob存储及每个源码目录的清单"""
+
+    def __init__(self, root, src_dir):
+        self.root = root
+        self.src_dir = src_dir
+        self.objects_dir = os.path.join(root, "objects")
+        self.manifests_dir = os.path.join(root, "manifests")
+        self.manifest_file = os.path.join(self.manifests_dir, f"{checkout_id(src_dir)}.json")
+        self._lock = threading.RLock()
+        self._manifest = None
+        # 已加载清单对应的文件状态，其他进程改写清单后重新加载
+        self._manifest_stat = None
+        self._git = None
+
+    # ----- blob -----
+
+    def blob_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+    def has_blob(self, digest):
+        return os.path.exists(self.blob_path(digest))
+
+    def put_file(self, path, digest=None):
+        """将文件存入blob存储（已存在则跳过），返回内容哈希"""
+        if digest is None:
+            digest = file_sha256(path)
+        blob = self.blob_path(digest)
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            tmp_path = f"{blob}.{threading.get_ident()}.tmp"
+            clone_file(path, tmp_path)
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, blob)
+        return digest
+
+    def put_bytes(self, data):
+        """将字节内容存入blob存储，返回内容哈希"""
+        digest = hashlib.sha256(data).hexdigest()
+        blob = self.blob_path(digest)
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            tmp_path = f"{blob}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, blob)
+        return digest
+
+    def read_blob(self, digest):
+        with open(self.blob_path(digest), "rb") as f:
+            return f.read()
+
+    # ----- 清单 -----
+
+    def _stat_manifest(self):
+        try:
+            st = os.stat(self.manifest_file)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def _load_manifest(self):
+        """返回清单，清单文件被其他进程改写过时重新读取（常驻进程中实例长期存在）"""
+        current = self._stat_manifest()
+        if self._manifest is None or current != self._manifest_stat:
+            manifest = None
+            if os.path.exists(self.manifest_file):
+                try:
+                    with open(self.manifest_file, "r", encoding="utf-8") as f:
+                        manifest = json.load(f)
+                except (OSError, ValueError):
+                    manifest = None
+            if not manifest:
+                manifest = {"src_dir": os.path.realpath(self.src_dir), "files": {}}
+            self._manifest = manifest
+            self._manifest_stat = current
+        return self._manifest
+
+    def _save_manifest(self):
+        os.makedirs(self.manifests_dir, exist_ok=True)
+        tmp_path = f"{self.manifest_file}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._manifest, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_file)
+        self._manifest_stat = self._stat_manifest()
+
+    def get_entry(self, rel_path):
+        """返回清单中的记录，不存在时返回None"""
+        with self._lock:
+            return self._load_manifest()["files"].get(rel_path.replace(os.sep, "/"))
+
+    def set_entry(self, rel_path, entry):
+        with self._lock:
+            self._load_manifest()["files"][rel_path.replace(os.sep, "/")] = entry
+            self._save_manifest()
+
+    def entries(self):
+        with self._lock:
+            return dict(self._load_manifest()["files"])
+
+    # ----- git对象数据库 -----
+
+    def git_reader(self):
+        if self._git is None:
+            self._git = GitObjectReader(self.src_dir)
+        return self._git
+
+    # ----- 备份与还原 -----
+
+    def backup(self, file_path, rel_path, use_git=False, known_hashes=()):
+        """备份原始文件，返回记录
+
+        已有记录时，文件内容与记录一致或属于known_hashes（已知的补丁后内容）则
+        直接返回记录；否则说明源码已更新（例如同步了上游版本），原有记录已过期，
+        重新备份当前内容。
+        """
+        with self._lock:
+            entry = self.get_entry(rel_path)
+            st = os.stat(file_path)
+            if entry:
+                if entry.get("size") == st.st_size and entry.get("mtime_ns") == st.st_mtime_ns:
+                    return entry
+                digest = file_sha256(file_path)
+                if digest == entry["sha256"] or digest in known_hashes:
+                    return entry
+
+            if use_git:
+                with open(file_path, "rb") as f:
+                    data = f.read()
+                oid, _ = self.git_reader().read_path(rel_path)
+                # 只有能按对象ID读回内容时才不存储blob，否则之后无法还原
+                if oid and oid == git_blob_oid(data) and self.git_reader().read_oid(oid) == data:
+                    # 与仓库HEAD一致，只记录对象ID，不存储内容
+                    entry = {
+                        "sha256": hashlib.sha256(data).hexdigest(),
+                        "size": st.st_size,
+                        "mtime_ns": st.st_mtime_ns,
+                        "git_oid": oid
+                    }
+                    self.set_entry(rel_path, entry)
+                    return entry
+
+            entry = {
+                "sha256": self.put_file(file_path),
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns
+            }
+            self.set_entry(rel_path, entry)
+            return entry
+
+    def read(self, entry, rel_path=None):
+        """读取记录对应的原始内容，无法读取时抛出BackupMissingError"""
+        if entry.get("git_oid"):
+            data = self.git_reader().read_oid(entry["git_oid"])
+            if data is not None:
+                return data
+            if not self.has_blob(entry["sha256"]):
+                raise BackupMissingError(
+                    f"无法读取 {rel_path or entry['sha256']} 的原始内容: git对象 {entry['git_oid']} "
+                    f"在 {self.src_dir} 的仓库中不存在（可能已被gc、浅克隆或切换了仓库），"
+                    f"备份存储中也没有该内容")
+        return self.read_blob(entry["sha256"])
+
+    def materialize(self, entry, dest):
+        """将记录对应的原始内容写到dest（reflink优先，替换写入）"""
+        if entry.get("git_oid") and not self.has_blob(entry["sha256"]):
+            data = self.read(entry, os.path.relpath(dest, self.src_dir))
+            _replace_into(dest, lambda tmp: _write_bytes(tmp, data))
+            return "git"
+        blob = self.blob_path(entry["sha256"])
+        method = []
+        _replace_into(dest, lambda tmp: method.append(clone_file(blob, tmp)))
+        return method[0]
+
+    def pristine_path(self, entry, rel_path=None):
+        """返回包含原始内容的文件路径（git模式下按需写入blob存储）"""
+        if not self.has_blob(entry["sha256"]):
+            self.put_bytes(self.read(entry, rel_path))
+        return self.blob_path(entry["sha256"])
+
+    def close(self):
+        if self._git is not None:
+            self._git.close()
+            self._git = None
+
+
+def _write_bytes(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
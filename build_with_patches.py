@@ -12,44 +12,90 @@ Chromium指纹补丁构建集成脚本
 使用方法：
   python build_with_patches.py --config=<config_file> --build-args="<构建参数>"
   python build_with_patches.py --random --build-args="<构建参数>"
+  python build_with_patches.py --config=<config_file> --overlay --build-args="<构建参数>"  # 变体目录模式
+  python build_with_patches.py --queue <config1> <config2> ... --build-args="<构建参数>"  # 批量构建队列
 """
 
 import argparse
+import contextlib
+import json
 import os
+import re
 import subprocess
 import sys
 import time
 
+import artifact_cache
+import blob_store
+import compiler_cache
+import ninja_deps
+import patch_bundle
+import patch_manager
+import trace_events
+
 # 全局配置
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 PATCH_MANAGER = os.path.join(BASE_DIR, 'patch_manager.py')
+OVERLAY_DIR = os.path.join(BASE_DIR, 'overlays')
+
+ARTIFACT_CACHE_DIR = os.path.join(BASE_DIR, 'artifact_cache')
+
+# 修改头文件通常会引发比修改源文件多得多的重新编译，排序时按此估算重建代价
+HEADER_REBUILD_WEIGHT = 20
+SOURCE_REBUILD_WEIGHT = 1
 
-def run_command(cmd, cwd=None):
-    """运行命令并实时输出结果"""
+# ninja默认的进度输出格式 NINJA_STATUS="[%f/%t] "
+NINJA_PROGRESS_RE = re.compile(r"^\[(\d+)/(\d+)\] ")
+
+def run_command(cmd, cwd=None, env=None):
+    """运行命令并实时输出结果，启用trace时将ninja进度记录为计数事件
+
+    env为需要额外设置的环境变量。
+    """
     print(f"执行命令: {' '.join(cmd)}")
-    process = subprocess.Popen(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True,
-        cwd=cwd or BASE_DIR
-    )
-    
-    # 实时输出命令执行结果
-    for line in process.stdout:
-        print(line, end='')
-    
-    # 等待命令执行完成
-    return_code = process.wait()
+    with trace_events.span("subprocess", cmd=' '.join(cmd)):
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            cwd=cwd or BASE_DIR,
+            env=dict(os.environ, **env) if env else None
+        )
+        
+        # 实时输出命令执行结果
+        tracing = trace_events.enabled()
+        for line in process.stdout:
+            print(line, end='')
+            if tracing:
+                match = NINJA_PROGRESS_RE.match(line)
+                if match:
+                    trace_events.counter("ninja_progress", finished=int(match.group(1)),
+                                         total=int(match.group(2)))
+        
+        # 等待命令执行完成
+        return_code = process.wait()
     if return_code != 0:
         print(f"命令执行失败，返回码: {return_code}")
         return False
     
     return True
 
-def apply_patches(config_file=None, random=False):
+def patch_manager_cmd(command):
+    """patch_manager.py子命令的命令行；启用trace时子进程的trace会合并到本进程的trace中"""
+    cmd = [sys.executable, PATCH_MANAGER]
+    child_trace = trace_events.child_trace_path(command)
+    if child_trace:
+        cmd.extend(['--trace', child_trace])
+    return cmd + [command]
+
+def bundle_args(bundle):
+    """补丁包参数，未使用补丁包时为空"""
+    return ['--bundle', bundle] if bundle else []
+
+def apply_patches(config_file=None, random=False, jobs=1, bundle=None):
     """应用指纹补丁"""
-    cmd = [sys.executable, PATCH_MANAGER, 'apply']
+    cmd = patch_manager_cmd('apply') + ['--jobs', str(jobs)] + bundle_args(bundle)
     
     if config_file:
         cmd.extend(['--config', config_file])
@@ -61,12 +107,40 @@ def apply_patches(config_file=None, random=False):
     
     return run_command(cmd)
 
+def create_overlay(config_file=None, random=False, overlay_dir=None, method="shadow", jobs=1, bundle=None):
+    """在独立的变体目录中应用补丁，返回变体目录路径"""
+    cmd = patch_manager_cmd('overlay') + ['--method', method, '--jobs', str(jobs)] + bundle_args(bundle)
+    
+    if config_file:
+        cmd.extend(['--config', config_file])
+    elif random:
+        cmd.append('--random')
+    else:
+        print("错误: 必须指定配置文件或使用随机模式")
+        return None
+    
+    if not overlay_dir:
+        if not config_file:
+            print("错误: 随机模式下必须通过--overlay-dir指定变体目录")
+            return None
+        with open(config_file, "r", encoding="utf-8") as f:
+            fingerprint_id = json.load(f)["fingerprint_id"]
+        overlay_dir = os.path.join(OVERLAY_DIR, fingerprint_id)
+    cmd.extend(['--dir', overlay_dir])
+    
+    return overlay_dir if run_command(cmd) else None
+
+def switch_patches(config_file, jobs=1, bundle=None):
+    """以最小改动切换到新的指纹配置"""
+    cmd = patch_manager_cmd('switch') + ['--config', config_file, '--jobs', str(jobs)] + bundle_args(bundle)
+    return run_command(cmd)
+
 def restore_patches():
     """还原指纹补丁"""
-    cmd = [sys.executable, PATCH_MANAGER, 'restore']
+    cmd = patch_manager_cmd('restore')
     return run_command(cmd)
 
-def build_chromium(build_args):
+def build_chromium(build_args, src_dir=None, env=None):
     """执行Chromium构建命令"""
     # 解析构建参数
     build_cmd = build_args.split()
@@ -78,7 +152,308 @@ def build_chromium(build_args):
             print("警告: 在Windows平台上，推荐使用ninja或autoninja进行构建")
     
     # 执行构建命令
-    return run_command(build_cmd, cwd=os.path.join(BASE_DIR, 'src'))
+    return run_command(build_cmd, cwd=src_dir or os.path.join(BASE_DIR, 'src'), env=env)
+
+def timed_build(build_args, src_dir=None, env=None):
+    """执行构建并输出耗时"""
+    build_start_time = time.time()
+    build_success = build_chromium(build_args, src_dir, env)
+    build_end_time = time.time()
+    build_duration = build_end_time - build_start_time
+    
+    if build_success:
+        print(f"\n构建成功！耗时: {build_duration:.2f}秒 ({build_duration/60:.2f}分钟)")
+    else:
+        print("\n构建失败！")
+    return build_success
+
+def cached_build(build_args, launcher=None, src_dir=None, patched=()):
+    """执行构建，指定编译器缓存启动器时统计缓存命中情况，返回(是否成功, 缓存统计)
+
+    patched为本次构建中被补丁修改的源码相对路径，依赖它们的翻译单元按
+    受补丁影响统计。
+    """
+    if not launcher:
+        return timed_build(build_args, src_dir), None
+    src_dir = src_dir or patch_manager.SRC_DIR
+    out_dir = build_out_dir(build_args, src_dir)
+    if not out_dir:
+        print("警告: 构建命令中没有通过-C指定out目录，无法区分受补丁影响的翻译单元")
+    log_file = os.path.join(out_dir or BASE_DIR, "fp_ccache.log")
+    monitor = compiler_cache.CacheMonitor(launcher, src_dir, out_dir, log_file)
+    success = timed_build(build_args, src_dir, monitor.start())
+    
+    patched = sorted(patched)
+    objects = set()
+    if out_dir and patched:
+        try:
+            objects = ninja_deps.BuildCostModel(out_dir, src_dir, patched).affected_objects(patched)
+        except (OSError, ValueError) as e:
+            print(f"警告: 读取ninja构建记录失败: {e}")
+    return success, monitor.finish(objects, patched)
+
+class PhaseTimer(object):
+    """记录构建流程中各阶段（应用补丁、构建、还原等）的耗时"""
+    
+    def __init__(self):
+        self.phases = {}
+    
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            with trace_events.span(name, cat="phase"):
+                yield
+        finally:
+            self.phases[name] = round(self.phases.get(name, 0.0) + time.time() - start, 3)
+
+def record_build_history(mode, configs, timer, success, estimate=None, changed=None, cache_stats=None):
+    """将一次构建的各阶段耗时、重建代价估算和编译器缓存命中情况追加到构建历史"""
+    try:
+        ninja_deps.append_history(patch_manager.BUILD_HISTORY_FILE, {
+            "mode": mode,
+            "configs": configs,
+            "phases": timer.phases,
+            "success": success,
+            "changed_files": changed or [],
+            "estimate": estimate,
+            "compiler_cache": cache_stats
+        })
+    except OSError as e:
+        print(f"警告: 写入构建历史失败: {e}")
+
+def build_out_dir(build_args, src_dir=None):
+    """从构建命令的 -C 参数中取得ninja out目录，未指定时返回None"""
+    tokens = build_args.split()
+    for i, token in enumerate(tokens):
+        if token == "-C" and i + 1 < len(tokens):
+            out_dir = tokens[i + 1]
+        elif token.startswith("-C") and len(token) > 2:
+            out_dir = token[2:]
+        else:
+            continue
+        return os.path.join(src_dir or patch_manager.SRC_DIR, out_dir)
+    return None
+
+def load_cost_model(build_args, rel_paths):
+    """根据out目录中的ninja构建记录创建重建代价模型，没有构建记录时返回None"""
+    out_dir = build_out_dir(build_args)
+    if not out_dir:
+        return None
+    try:
+        model = ninja_deps.BuildCostModel(out_dir, patch_manager.SRC_DIR, rel_paths)
+    except (OSError, ValueError) as e:
+        print(f"警告: 读取ninja构建记录失败: {e}")
+        return None
+    return model if model.available else None
+
+def estimate_change(model, changed):
+    """估算修改changed中的文件需要重新编译的目标文件数和CPU秒数"""
+    if model is None:
+        return None
+    objects, seconds = model.estimate(changed)
+    return {"objects": objects, "seconds": round(seconds, 1)}
+
+def build_overlay_variant(args, cache=None, key=None):
+    """变体目录模式：补丁写入独立目录，在该目录中构建，无需还原"""
+    timer = PhaseTimer()
+    print("\n===== 构建变体目录 =====")
+    with timer.phase("overlay"):
+        overlay_dir = create_overlay(args.config, args.random, args.overlay_dir, args.overlay_method, args.jobs,
+                                     args.bundle)
+    if not overlay_dir:
+        print("构建变体目录失败，中止构建")
+        return 1
+    
+    if cache and cache.lookup(key, overlay_dir, args.artifacts):
+        print("\n命中产物缓存，跳过构建")
+        cache.report()
+        return 0
+    
+    with open(os.path.join(overlay_dir, ".fp_overlay.json"), "r", encoding="utf-8") as f:
+        patched = {os.path.relpath(p["target_file"], patch_manager.SRC_DIR) for p in json.load(f)["patches"]}
+    print(f"\n===== 在变体目录中构建Chromium: {overlay_dir} =====")
+    with timer.phase("build"):
+        success, cache_stats = cached_build(args.build_args, args.compiler_cache, overlay_dir, patched)
+    if success and cache:
+        with timer.phase("cache_store"):
+            cache.store(key, overlay_dir, args.artifacts, {"configs": [args.config]})
+    record_build_history("overlay", [args.config], timer, success, cache_stats=cache_stats)
+    if cache:
+        cache.report()
+    return 0 if success else 1
+
+def rebuild_weight(rel_path):
+    """估算修改某个文件引发的重建代价"""
+    if rel_path.endswith(('.h', '.hh', '.hpp', '.inc')):
+        return HEADER_REBUILD_WEIGHT
+    return SOURCE_REBUILD_WEIGHT
+
+def variant_patch_set(config, patch_index):
+    """计算配置的有效补丁集合: ((目标相对路径, (补丁文件, ...)), ...)"""
+    selected = patch_manager.select_patches(config, patch_index, verbose=False)
+    groups = patch_manager.group_patches_by_target(selected)
+    return tuple(sorted(
+        (os.path.relpath(target_file, patch_manager.SRC_DIR), tuple(patch_files))
+        for target_file, patch_files in groups.items()
+    ))
+
+def changed_targets(a, b):
+    """两个补丁集合之间切换时内容会发生变化的目标文件"""
+    da = dict(a)
+    db = dict(b)
+    return [t for t in set(da) | set(db) if da.get(t) != db.get(t)]
+
+def patch_set_distance(a, b, weight=rebuild_weight):
+    """两个补丁集合之间切换时需要改写的文件的重建代价之和"""
+    return sum(weight(t) for t in changed_targets(a, b))
+
+def order_variants(patch_sets, start=(), weight=rebuild_weight):
+    """对补丁集合排序，使相邻两次构建之间的重建代价之和尽量小
+
+    先以最近邻贪心得到初始顺序，再用2-opt反转子序列做局部优化。
+    返回patch_sets的下标列表。
+    """
+    remaining = list(range(len(patch_sets)))
+    order = []
+    current = start
+    while remaining:
+        best = min(remaining, key=lambda i: patch_set_distance(current, patch_sets[i], weight))
+        order.append(best)
+        remaining.remove(best)
+        current = patch_sets[best]
+    
+    def node(k):
+        return start if k < 0 else patch_sets[order[k]]
+    
+    improved = True
+    while improved and len(order) > 2:
+        improved = False
+        for i in range(len(order) - 1):
+            for j in range(i + 1, len(order)):
+                # 反转 order[i..j]，路径起点固定、终点开放
+                before = patch_set_distance(node(i - 1), node(i), weight)
+                after = patch_set_distance(node(i - 1), node(j), weight)
+                if j + 1 < len(order):
+                    before += patch_set_distance(node(j), node(j + 1), weight)
+                    after += patch_set_distance(node(i), node(j + 1), weight)
+                if after < before:
+                    order[i:j + 1] = reversed(order[i:j + 1])
+                    improved = True
+    return order
+
+_PATCH_HASHES = {}
+
+def patch_file_hash(patch_file):
+    """补丁文件内容哈希（进程内缓存）"""
+    if patch_file not in _PATCH_HASHES:
+        _PATCH_HASHES[patch_file] = blob_store.file_sha256(patch_file)
+    return _PATCH_HASHES[patch_file]
+
+def variant_cache_key(patch_set, build_args):
+    """计算变体的构建产物缓存键"""
+    revision = artifact_cache.source_revision(patch_manager.SRC_DIR)
+    return artifact_cache.compute_cache_key(revision, patch_set, build_args, patch_file_hash)
+
+def open_artifact_cache(args):
+    """根据命令行参数创建产物缓存，未启用时返回None"""
+    if not args.artifacts or args.no_cache:
+        return None
+    return artifact_cache.ArtifactCache(ARTIFACT_CACHE_DIR, int(args.cache_size * 1024 ** 3))
+
+def config_cache_key(config_file, build_args):
+    """计算单个配置文件对应的缓存键"""
+    config = patch_manager.load_config(config_file)
+    return variant_cache_key(variant_patch_set(config, patch_manager.build_patch_index()), build_args)
+
+def plan_build_queue(config_files, weight=rebuild_weight):
+    """计算构建队列：合并补丁集合相同的配置，并按相似度排序
+
+    返回[(补丁集合, [配置文件, ...]), ...]，每一项只需构建一次。
+    """
+    patch_index = patch_manager.build_patch_index()
+    unique = {}
+    for config_file in config_files:
+        config = patch_manager.load_config(config_file)
+        unique.setdefault(variant_patch_set(config, patch_index), []).append(config_file)
+    
+    # 从源码树当前生效（尚未还原）的补丁集合出发
+    start = tuple(sorted(
+        (os.path.normpath(target), patch_files)
+        for target, patch_files in patch_manager.active_patch_set().items()
+    ))
+    
+    patch_sets = list(unique)
+    order = order_variants(patch_sets, start, weight)
+    return [(patch_sets[i], unique[patch_sets[i]]) for i in order], start
+
+def run_build_queue(config_files, build_args, jobs=1, skip_restore=False, cache=None, artifacts=(), bundle=None,
+                    launcher=None):
+    """按相似度顺序依次切换配置并构建，所有变体共享同一个out目录
+
+    启用产物缓存时，命中缓存的变体直接还原产物，不切换配置也不构建。
+    """
+    # out目录中有ninja构建记录时，按实际依赖关系和编译耗时估算重建代价
+    targets = sorted({os.path.normpath(t) for files in patch_manager.patch_file_mappings().values() for t in files})
+    model = load_cost_model(build_args, targets)
+    weight = model.target_seconds if model else rebuild_weight
+    queue, start = plan_build_queue(config_files, weight)
+    
+    print(f"\n===== 构建队列: {len(config_files)} 个配置，去重后 {len(queue)} 个变体 =====")
+    previous = start
+    total_cost = 0
+    for position, (patch_set, configs) in enumerate(queue, 1):
+        cost = patch_set_distance(previous, patch_set, weight)
+        total_cost += cost
+        changed = len(changed_targets(previous, patch_set))
+        cost_text = f"预计编译 {cost:.0f} CPU秒" if model else f"重建代价 {cost}"
+        print(f"{position}. {configs[0]} (改动 {changed} 个文件，{cost_text})")
+        for alias in configs[1:]:
+            print(f"   与 {alias} 补丁集合相同，只构建一次")
+        previous = patch_set
+    print(f"预计总重建代价: {total_cost:.0f}" + (" CPU秒" if model else ""))
+    
+    results = []
+    previous = start
+    try:
+        for position, (patch_set, configs) in enumerate(queue, 1):
+            key = variant_cache_key(patch_set, build_args) if cache else None
+            if cache and cache.lookup(key, patch_manager.SRC_DIR, artifacts):
+                print(f"\n===== [{position}/{len(queue)}] {configs[0]} 命中产物缓存，跳过构建 =====")
+                results.append((configs, True))
+                continue
+            
+            timer = PhaseTimer()
+            changed = sorted(changed_targets(previous, patch_set))
+            print(f"\n===== [{position}/{len(queue)}] 切换到指纹配置: {configs[0]} =====")
+            with timer.phase("switch"):
+                switched = switch_patches(configs[0], jobs, bundle)
+            if not switched:
+                print("切换配置失败，跳过该变体")
+                record_build_history("queue", configs, timer, False, changed=changed)
+                results.append((configs, False))
+                continue
+            previous = patch_set
+            print("\n===== 开始构建Chromium =====")
+            with timer.phase("build"):
+                success, cache_stats = cached_build(build_args, launcher, patched=dict(patch_set))
+            if success and cache:
+                with timer.phase("cache_store"):
+                    cache.store(key, patch_manager.SRC_DIR, artifacts, {"configs": configs})
+            record_build_history("queue", configs, timer, success, estimate_change(model, changed), changed,
+                                 cache_stats)
+            results.append((configs, success))
+    finally:
+        if not skip_restore:
+            print("\n===== 还原指纹补丁 =====")
+            restore_patches()
+    
+    print("\n===== 构建队列结果 =====")
+    for configs, success in results:
+        print(f"{'成功' if success else '失败'}: {', '.join(configs)}")
+    if cache:
+        cache.report()
+    return all(success for _, success in results) and len(results) == len(queue)
 
 def main():
     parser = argparse.ArgumentParser(description="Chromium指纹补丁构建集成脚本")
@@ -87,43 +462,117 @@ def main():
     patch_group = parser.add_mutually_exclusive_group(required=True)
     patch_group.add_argument("--config", help="指纹配置文件路径")
     patch_group.add_argument("--random", action="store_true", help="使用随机指纹配置")
+    patch_group.add_argument("--queue", nargs="+", metavar="CONFIG", help="批量构建多个配置，按补丁集合相似度排序并去重")
     
     # 构建参数
     parser.add_argument("--build-args", required=True, help="Chromium构建命令及参数")
     parser.add_argument("--skip-restore", action="store_true", help="跳过还原补丁步骤")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="应用补丁时并发处理的目标文件数")
+    parser.add_argument("--bundle", help="从补丁包读取补丁和映射表")
+    parser.add_argument("--compiler-cache", choices=compiler_cache.LAUNCHERS,
+                        help="使用编译器缓存构建（需在args.gn中设置对应的cc_wrapper），并统计受补丁影响和未受影响的翻译单元的命中率")
+    parser.add_argument("--trace", metavar="OUT_JSON",
+                        help="将各阶段耗时（含patch_manager子进程和ninja进度）写入Chrome trace-event JSON")
+    
+    # 产物缓存参数
+    parser.add_argument("--artifacts", nargs="+", metavar="PATH",
+                        help="需要缓存的构建产物（相对于src或变体目录，例如 out/Default/chrome），指定后启用产物缓存")
+    parser.add_argument("--cache-size", type=float, default=50.0, help="产物缓存容量上限（GB，默认50）")
+    parser.add_argument("--no-cache", action="store_true", help="禁用产物缓存")
+    
+    # 变体目录模式参数
+    parser.add_argument("--overlay", action="store_true", help="在独立的变体目录中构建，不修改src，可与其他变体并行")
+    parser.add_argument("--overlay-dir", help="变体目录（默认overlays/<fingerprint_id>）")
+    parser.add_argument("--overlay-method", choices=["shadow", "worktree"], default="shadow",
+                        help="变体目录的构建方式：符号链接影子树或git worktree")
     
     args = parser.parse_args()
     
+    if args.trace:
+        trace_events.start(args.trace, "build_with_patches")
+    try:
+        return run_build(args)
+    finally:
+        if args.trace:
+            trace_events.stop()
+            print(f"已写入trace: {args.trace}")
+
+def run_build(args):
+    """按命令行参数执行单次构建、变体目录构建或构建队列，返回退出码"""
     # 确保补丁管理系统目录结构已创建
     if not os.path.exists(os.path.join(BASE_DIR, 'patches')):
         print("初始化补丁管理系统目录结构...")
         if not run_command([sys.executable, PATCH_MANAGER, 'create_structure']):
             return 1
     
+    # 使用补丁包时，本进程内的补丁集合计算也以补丁包为准
+    if args.bundle:
+        try:
+            patch_manager.open_bundle(args.bundle)
+        except (OSError, patch_bundle.BundleError) as e:
+            print(f"错误: 无法打开补丁包: {e}")
+            return 1
+    
+    # 随机配置在应用时才生成，无法预先计算缓存键
+    cache = open_artifact_cache(args) if not args.random else None
+    
+    if args.queue:
+        return 0 if run_build_queue(args.queue, args.build_args, args.jobs, args.skip_restore,
+                                    cache, args.artifacts or (), args.bundle, args.compiler_cache) else 1
+    
+    key = config_cache_key(args.config, args.build_args) if cache else None
+    
+    if args.overlay:
+        return build_overlay_variant(args, cache, key)
+    
+    if cache and cache.lookup(key, patch_manager.SRC_DIR, args.artifacts):
+        print("\n命中产物缓存，跳过应用补丁与构建")
+        cache.report()
+        return 0
+    
+    # 随机配置在应用时才生成，无法预先估算
+    timer = PhaseTimer()
+    changed = estimate = None
+    if args.config:
+        with timer.phase("estimate"):
+            old_set = patch_manager.active_patch_set()
+            new_set, _ = patch_manager.config_patch_set(patch_manager.load_config(args.config),
+                                                        patch_manager.build_patch_index())
+            changed = sorted(t for t in set(old_set) | set(new_set) if old_set.get(t) != new_set.get(t))
+            estimate = estimate_change(load_cost_model(args.build_args, changed), changed)
+        if estimate:
+            print(f"预计重新编译 {estimate['objects']} 个目标文件，编译CPU时间约 {estimate['seconds']:.0f} 秒")
+    
     # 应用补丁
     print("\n===== 应用指纹补丁 =====")
-    if not apply_patches(args.config, args.random):
+    with timer.phase("apply"):
+        applied = apply_patches(args.config, args.random, args.jobs, args.bundle)
+    if not applied:
         print("应用补丁失败，中止构建")
         return 1
     
+    build_success = False
+    cache_stats = None
     try:
         # 执行构建
         print("\n===== 开始构建Chromium =====")
-        build_start_time = time.time()
-        build_success = build_chromium(args.build_args)
-        build_end_time = time.time()
-        build_duration = build_end_time - build_start_time
-        
-        if build_success:
-            print(f"\n构建成功！耗时: {build_duration:.2f}秒 ({build_duration/60:.2f}分钟)")
-        else:
-            print("\n构建失败！")
+        with timer.phase("build"):
+            build_success, cache_stats = cached_build(args.build_args, args.compiler_cache,
+                                                      patched=patch_manager.active_patch_set() if args.compiler_cache else ())
+        if build_success and cache:
+            with timer.phase("cache_store"):
+                cache.store(key, patch_manager.SRC_DIR, args.artifacts, {"configs": [args.config]})
     finally:
         # 无论构建是否成功，都尝试还原补丁
         if not args.skip_restore:
             print("\n===== 还原指纹补丁 =====")
-            restore_patches()
+            with timer.phase("restore"):
+                restore_patches()
+        record_build_history("single", [args.config] if args.config else [], timer, build_success,
+                             estimate, changed, cache_stats)
     
+    if cache:
+        cache.report()
     return 0 if build_success else 1
 
 if __name__ == "__main__":
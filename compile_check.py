@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+基于compile_commands.json的编译检查
+
+读取out目录中的compile_commands.json（gn gen --export-compile-commands生成），
+只编译被补丁影响的翻译单元，用于在完整构建之前发现无法编译的补丁。
+
+编译命令保持记录中的参数不变，只做两处改写：
+1. 指向src目录的绝对路径改为指向变体目录（影子树），相对路径通过在变体目录
+   中的同名out目录下执行自然解析到变体目录，从而编译补丁后的内容；
+2. 目标文件和依赖文件输出(-o/-MF、/Fo)改到临时目录，不影响out目录中的构建产物。
+
+编译结果按(编译命令, 输入内容哈希)缓存，输入包括被补丁修改的文件和.ninja_deps中
+记录的翻译单元全部依赖，补丁、源码和头文件都未变化时再次检查不会重新编译。
+"""
+
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+import time
+
+CACHE_VERSION = 2
+
+# 编译器输出的错误信息在报告中保留的最大行数
+MAX_OUTPUT_LINES = 40
+
+
+def load_compile_commands(path):
+    """读取compile_commands.json，返回条目列表
+
+    每个条目为{"directory", "file", "arguments", "output"}，其中directory、file和
+    output为规范化的绝对路径（记录中没有输出时output为None）。
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        records = json.load(f)
+    entries = []
+    for record in records:
+        directory = os.path.abspath(record["directory"])
+        if "arguments" in record:
+            arguments = list(record["arguments"])
+        else:
+            arguments = shlex.split(record["command"], posix=os.name != "nt")
+        output = record.get("output") or command_output(arguments)
+        entries.append({
+            "directory": directory,
+            "file": os.path.normpath(os.path.join(directory, record["file"])),
+            "arguments": arguments,
+            "output": os.path.normpath(os.path.join(directory, output)) if output else None
+        })
+    return entries
+
+
+def command_output(arguments):
+    """从编译参数中找出目标文件路径"""
+    for i, arg in enumerate(arguments):
+        if arg == "-o" and i + 1 < len(arguments):
+            return arguments[i + 1]
+        if arg.startswith("-o") and len(arg) > 2:
+            return arg[2:]
+        if arg.startswith(("/Fo", "-Fo")) and len(arg) > 3:
+            return arg[3:]
+    return None
+
+
+def redirect_outputs(arguments, obj_path):
+    """将目标文件和依赖文件输出改到obj_path（依赖文件为obj_path.d）"""
+    result = []
+    skip = False
+    for i, arg in enumerate(arguments):
+        if skip:
+            skip = False
+            continue
+        if arg in ("-o", "-MF") and i + 1 < len(arguments):
+            result.extend([arg, obj_path if arg == "-o" else obj_path + ".d"])
+            skip = True
+        elif arg.startswith("-o") and len(arg) > 2:
+            result.append("-o" + obj_path)
+        elif arg.startswith("-MF") and len(arg) > 3:
+            result.append("-MF" + obj_path + ".d")
+        elif arg.startswith(("/Fo", "-Fo")) and len(arg) > 3:
+            result.append(arg[:3] + obj_path)
+        else:
+            result.append(arg)
+    return result
+
+
+def rebase_arguments(arguments, src_dir, tree_dir):
+    """将参数中指向src_dir的绝对路径改为指向tree_dir"""
+    src_dir = os.path.normpath(src_dir)
+    result = []
+    for arg in arguments:
+        pos = arg.find(src_dir)
+        end = pos + len(src_dir)
+        if pos >= 0 and (end == len(arg) or arg[end] in "/\\"):
+            arg = arg[:pos] + tree_dir + arg[end:]
+        result.append(arg)
+    return result
+
+
+def cache_key(arguments, directory, inputs):
+    """编译缓存键：记录中的编译参数、执行目录和输入内容哈希[(路径, sha256), ...]
+
+    路径为src中的相对路径或其他位置的绝对路径，文件不存在时哈希为None。
+    """
+    data = json.dumps([arguments, directory, sorted(inputs)], separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8", errors="surrogateescape")).hexdigest()
+
+
+class CompileCache(object):
+    """编译结果缓存：{缓存键: {"ok", "output", "seconds"}}"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._dirty = False
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("version") == CACHE_VERSION:
+                    self.entries = data.get("entries", {})
+            except (OSError, ValueError):
+                self.entries = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, result):
+        self.entries[key] = result
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": CACHE_VERSION, "entries": self.entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+
+def compile_unit(arguments, cwd, timeout=None):
+    """执行一次编译，返回{"ok", "output", "seconds"}，output只保留前MAX_OUTPUT_LINES行"""
+    start = time.time()
+    try:
+        proc = subprocess.run(arguments, cwd=cwd, capture_output=True, text=True,
+                              errors="replace", timeout=timeout)
+        ok = proc.returncode == 0
+        output = (proc.stderr + proc.stdout).strip()
+    except subprocess.TimeoutExpired:
+        ok = False
+        output = f"编译超时（{timeout} 秒）"
+    except OSError as e:
+        ok = False
+        output = f"无法执行编译器: {e}"
+    lines = output.splitlines()
+    if len(lines) > MAX_OUTPUT_LINES:
+        lines = lines[:MAX_OUTPUT_LINES] + [f"...（省略 {len(lines) - MAX_OUTPUT_LINES} 行）"]
+    return {"ok": ok, "output": "\n".join(lines), "seconds": round(time.time() - start, 3)}
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+编译器缓存（ccache/sccache）集成与命中率统计
+
+Chromium通过GN参数 cc_wrapper="ccache" 或 cc_wrapper="sccache" 为每条编译命令
+加上缓存启动器，本模块负责为构建设置启动器所需的环境变量，并在构建结束后统计
+缓存命中情况：
+
+- ccache：通过CCACHE_LOGFILE记录本次构建的日志，按目标文件解析每次编译的
+  结果，区分受补丁影响的翻译单元（源文件或其依赖的头文件被补丁修改）和未受
+  影响的翻译单元，分别统计命中和未命中数；
+- sccache：没有逐个编译的日志，只能根据构建前后 sccache --show-stats 的差值
+  统计总的命中和未命中数。
+
+为使不同变体目录、不同时间的构建能够共用缓存，ccache设置CCACHE_BASEDIR为源码
+目录、CCACHE_NOHASHDIR=1（不把工作目录计入哈希），并放宽对头文件mtime/ctime的
+检查：切换配置时内容未变化的文件保留mtime，但内容变化后又切换回来的文件mtime
+会更新，按内容判断才能命中。
+"""
+
+import json
+import os
+import re
+import subprocess
+
+LAUNCHERS = ("ccache", "sccache")
+
+CCACHE_SLOPPINESS = "include_file_mtime,include_file_ctime,time_macros"
+
+# ccache日志行: [2024-01-01T12:00:00.123456 12345] 内容
+_LOG_LINE_RE = re.compile(r"^\[[^\]]* (\d+)\] (.*)$")
+_CC_WRAPPER_RE = re.compile(r"^\s*cc_wrapper\s*=\s*\"([^\"]*)\"", re.MULTILINE)
+
+
+def launcher_env(launcher, src_dir, log_file=None):
+    """返回启动器需要的环境变量"""
+    if launcher == "ccache":
+        env = {
+            "CCACHE_BASEDIR": os.path.abspath(src_dir),
+            "CCACHE_NOHASHDIR": "1",
+            "CCACHE_SLOPPINESS": CCACHE_SLOPPINESS
+        }
+        if log_file:
+            env["CCACHE_LOGFILE"] = log_file
+        return env
+    return {}
+
+
+def gn_cc_wrapper(out_dir):
+    """读取out目录args.gn中的cc_wrapper，未设置时返回None"""
+    try:
+        with open(os.path.join(out_dir, "args.gn"), "r", encoding="utf-8") as f:
+            match = _CC_WRAPPER_RE.search(f.read())
+    except OSError:
+        return None
+    return match.group(1) if match else None
+
+
+def _classify(result):
+    """将ccache的Result行归类为hit、miss或None（不可缓存的调用，例如链接）"""
+    result = result.lower()
+    if "hit" in result:
+        return "hit"
+    if "miss" in result:
+        return "miss"
+    return None
+
+
+def parse_ccache_log(path):
+    """解析ccache日志，返回[(目标文件, 源文件, "hit"|"miss"), ...]
+
+    日志中同一进程的行以进程号区分，依次出现Source file、Object file和Result。
+    兼容ccache 3（Result: cache hit (direct)）和ccache 4（Result: direct_cache_hit）。
+    """
+    records = []
+    current = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            match = _LOG_LINE_RE.match(line.rstrip("\n"))
+            if not match:
+                continue
+            pid, text = match.groups()
+            state = current.setdefault(pid, {})
+            if text.startswith("Source file: "):
+                state["source"] = text[len("Source file: "):]
+            elif text.startswith("Object file: "):
+                state["object"] = text[len("Object file: "):]
+            elif text.startswith("Result: "):
+                kind = _classify(text[len("Result: "):])
+                if kind and state.get("object"):
+                    records.append((state["object"], state.get("source"), kind))
+                current.pop(pid, None)
+    return records
+
+
+def split_stats(records, out_dir, src_dir, patched_objects, patched_sources):
+    """按是否受补丁影响统计命中数
+
+    patched_objects为受补丁影响的目标文件（相对于out目录），patched_sources为
+    被补丁修改的源码相对路径。返回{"patched": {"hit", "miss"}, "untouched": {...}}。
+    """
+    patched_objects = {os.path.normpath(o) for o in patched_objects}
+    patched_sources = {os.path.normpath(s) for s in patched_sources}
+    stats = {"patched": {"hit": 0, "miss": 0}, "untouched": {"hit": 0, "miss": 0}}
+    for obj, source, kind in records:
+        rel_obj = os.path.normpath(os.path.relpath(os.path.join(out_dir, obj), out_dir))
+        rel_source = None
+        if source:
+            rel_source = os.path.normpath(os.path.relpath(os.path.join(out_dir, source), src_dir))
+        group = "patched" if rel_obj in patched_objects or rel_source in patched_sources else "untouched"
+        stats[group][kind] += 1
+    return stats
+
+
+def sccache_stats():
+    """读取sccache的累计命中统计，返回{"hit", "miss"}，无法获取时返回None"""
+    try:
+        proc = subprocess.run(["sccache", "--show-stats", "--stats-format", "json"],
+                              capture_output=True, text=True, timeout=30)
+        stats = json.loads(proc.stdout)["stats"]
+    except (OSError, subprocess.SubprocessError, ValueError, KeyError):
+        return None
+    return {
+        "hit": sum(stats.get("cache_hits", {}).get("counts", {}).values()),
+        "miss": sum(stats.get("cache_misses", {}).get("counts", {}).values())
+    }
+
+
+def hit_rate(counts):
+    total = counts["hit"] + counts["miss"]
+    return counts["hit"] / total if total else None
+
+
+class CacheMonitor(object):
+    """一次构建的编译器缓存统计"""
+
+    def __init__(self, launcher, src_dir, out_dir, log_file):
+        self.launcher = launcher
+        self.src_dir = os.path.abspath(src_dir)
+        self.out_dir = os.path.abspath(out_dir) if out_dir else None
+        self.log_file = os.path.abspath(log_file)
+        self._sccache_before = None
+
+    def start(self):
+        """构建前调用，返回需要加入构建环境的变量"""
+        if self.out_dir:
+            wrapper = gn_cc_wrapper(self.out_dir)
+            if not wrapper or self.launcher not in wrapper:
+                print(f"警告: {os.path.join(self.out_dir, 'args.gn')} 中没有设置 cc_wrapper = \"{self.launcher}\"，"
+                      f"编译器缓存不会生效")
+        if self.launcher == "sccache":
+            self._sccache_before = sccache_stats()
+        elif os.path.exists(self.log_file):
+            os.unlink(self.log_file)
+        return launcher_env(self.launcher, self.src_dir, self.log_file)
+
+    def finish(self, patched_objects, patched_sources):
+        """构建后调用，返回统计结果并输出"""
+        if self.launcher == "sccache":
+            after = sccache_stats()
+            if after is None or self._sccache_before is None:
+                print("警告: 无法读取sccache统计")
+                return None
+            total = {key: after[key] - self._sccache_before[key] for key in ("hit", "miss")}
+            result = {"launcher": self.launcher, "total": total}
+        else:
+            if not self.out_dir:
+                return None
+            records = parse_ccache_log(self.log_file)
+            result = {"launcher": self.launcher}
+            result.update(split_stats(records, self.out_dir, self.src_dir, patched_objects, patched_sources))
+            result["total"] = {key: result["patched"][key] + result["untouched"][key] for key in ("hit", "miss")}
+
+        for group, label in (("patched", "受补丁影响"), ("untouched", "未受影响"), ("total", "合计")):
+            if group not in result:
+                continue
+            counts = result[group]
+            rate = hit_rate(counts)
+            rate_text = f"{rate * 100:.1f}%" if rate is not None else "-"
+            print(f"编译器缓存 {label}: 命中 {counts['hit']}，未命中 {counts['miss']}，命中率 {rate_text}")
+        return result
@@ -17,6 +17,7 @@ Chromium指纹补丁创建工具
 """
 
 import argparse
+import filecmp
 import os
 import subprocess
 import sys
@@ -36,6 +37,9 @@ FINGERPRINT_CATEGORIES = [
     'canvas_font', 'css_font', 'webrtc', 'webgl'
 ]
 
+# 补丁模式，与patch_manager.PATCH_MODES一致
+PATCH_MODES = ['custom', 'random', 'noise', 'auto_replace']
+
 def backup_file(file_path):
     """备份原始文件"""
     rel_path = os.path.relpath(file_path, SRC_DIR)
@@ -62,24 +66,39 @@ def open_editor(file_path):
     
     input("\n请在编辑器中修改文件，完成后按回车键继续...")
 
-def generate_patch(original_file, modified_file, patch_name, category, mode):
-    """生成补丁文件"""
-    rel_path = os.path.relpath(modified_file, SRC_DIR)
+def rewrite_diff_header(line, rel_path):
+    """将git diff文件头中的路径改写为相对于src目录的路径"""
+    if line.startswith(b"diff --git "):
+        return f"diff --git a/{rel_path} b/{rel_path}\n".encode("utf-8")
+    if line.startswith(b"--- "):
+        return f"--- a/{rel_path}\n".encode("utf-8")
+    if line.startswith(b"+++ "):
+        return f"+++ b/{rel_path}\n".encode("utf-8")
+    return line
+
+def generate_patch(original_file, modified_file, patch_name, category, mode, rel_path):
+    """生成补丁文件（流式写入，只改写文件头中的路径）"""
+    rel_path = rel_path.replace(os.sep, "/")
     patch_dir = os.path.join(PATCHES_DIR, category)
     os.makedirs(patch_dir, exist_ok=True)
     
-    patch_file = os.path.join(patch_dir, f"{mode}_{patch_name}_{os.path.basename(modified_file)}.patch")
+    patch_file = os.path.join(patch_dir, f"{mode}_{patch_name}_{os.path.basename(rel_path)}.patch")
     
     try:
         # 使用git diff生成补丁
         cmd = ["git", "diff", "--no-index", original_file, modified_file]
-        result = subprocess.run(cmd, check=False, capture_output=True, text=True)
-        
-        # 保存补丁文件
-        with open(patch_file, "w", encoding="utf-8") as f:
-            # 修改补丁文件中的路径，使其相对于src目录
-            patch_content = result.stdout.replace(original_file, f"a/{rel_path}").replace(modified_file, f"b/{rel_path}")
-            f.write(patch_content)
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as process, \
+                open(patch_file, "wb") as f:
+            in_header = False
+            for line in process.stdout:
+                if line.startswith(b"diff --git "):
+                    in_header = True
+                elif line.startswith(b"@@"):
+                    in_header = False
+                if in_header:
+                    # 修改补丁文件中的路径，使其相对于src目录
+                    line = rewrite_diff_header(line, rel_path)
+                f.write(line)
         
         print(f"已生成补丁: {patch_file}")
         return patch_file
@@ -92,7 +111,7 @@ def main():
     
     parser.add_argument("--category", required=True, choices=FINGERPRINT_CATEGORIES, help="指纹类别")
     parser.add_argument("--file", required=True, help="要修改的文件路径（相对于src目录）")
-    parser.add_argument("--mode", required=True, help="补丁模式（例如：custom, random, noise）")
+    parser.add_argument("--mode", required=True, choices=PATCH_MODES, help="补丁模式")
     parser.add_argument("--name", required=True, help="补丁名称")
     
     args = parser.parse_args()
@@ -117,15 +136,14 @@ def main():
     print(f"\n正在打开编辑器，请修改文件...")
     open_editor(temp_path)
     
-    # 检查文件是否被修改
-    with open(backup_path, "rb") as f1, open(temp_path, "rb") as f2:
-        if f1.read() == f2.read():
-            print("警告: 文件未被修改，不生成补丁")
-            os.unlink(temp_path)
-            return 1
+    # 检查文件是否被修改（先比较大小，再分块比较内容）
+    if filecmp.cmp(backup_path, temp_path, shallow=False):
+        print("警告: 文件未被修改，不生成补丁")
+        os.unlink(temp_path)
+        return 1
     
     # 生成补丁
-    patch_file = generate_patch(backup_path, temp_path, args.name, args.category, args.mode)
+    patch_file = generate_patch(backup_path, temp_path, args.name, args.category, args.mode, args.file)
     
     # 清理临时文件
     os.unlink(temp_path)
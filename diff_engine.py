@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+统一diff格式补丁引擎
+
+该模块在进程内解析和应用unified diff格式的补丁，用于替代逐文件调用
+`git apply` 子进程的方式，支持以下功能：
+1. 解析补丁文件（兼容git diff扩展头）
+2. 按偏移量查找补丁块位置，调用方可显式指定模糊度(fuzz)
+3. 忽略空白差异比较上下文行
+4. 在内存中应用补丁，由调用方统一写回目标文件
+5. 由新旧内容生成unified diff格式的补丁
+"""
+
+import difflib
+import re
+
+# 补丁块头部格式: @@ -旧起始行,旧行数 +新起始行,新行数 @@
+HUNK_HEADER_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+# 默认允许忽略的首尾上下文行数：与git apply一致，要求上下文完全匹配；
+# 忽略部分上下文可能把补丁块应用到错误的位置，需要时由调用方显式指定
+DEFAULT_FUZZ = 0
+
+
+class PatchError(Exception):
+    """补丁解析或应用失败"""
+
+
+class Hunk(object):
+    """补丁块"""
+
+    def __init__(self, old_start, old_count, new_start, new_count):
+        self.old_start = old_start
+        self.old_count = old_count
+        self.new_start = new_start
+        self.new_count = new_count
+        # 每一项为 (标记, 文本)，标记取值 ' '、'-'、'+'
+        self.lines = []
+        # 旧文件/新文件最后一行是否缺少换行符
+        self.old_no_newline = False
+        self.new_no_newline = False
+
+    def old_lines(self):
+        return [text for tag, text in self.lines if tag != '+']
+
+    def new_lines(self):
+        return [text for tag, text in self.lines if tag != '-']
+
+
+class FilePatch(object):
+    """单个文件的补丁"""
+
+    def __init__(self, old_path, new_path):
+        self.old_path = old_path
+        self.new_path = new_path
+        self.hunks = []
+
+    @property
+    def path(self):
+        """补丁对应的相对路径（已去除a/、b/前缀）"""
+        if self.new_path and self.new_path != '/dev/null':
+            return normalize_path(self.new_path)
+        return normalize_path(self.old_path)
+
+    @property
+    def is_new_file(self):
+        return self.old_path == '/dev/null'
+
+    @property
+    def is_deleted_file(self):
+        return self.new_path == '/dev/null'
+
+
+def normalize_path(path, strip_src=True):
+    """去除补丁路径中的a/、b/前缀以及可选的src/前缀，返回统一的相对路径"""
+    if not path or path == '/dev/null':
+        return path
+    # 去除git diff可能附带的时间戳
+    path = path.split('\t')[0].strip()
+    if path.startswith('"') and path.endswith('"'):
+        path = path[1:-1]
+    path = path.replace('\\', '/')
+    if path.startswith('a/') or path.startswith('b/'):
+        path = path[2:]
+    if strip_src and path.startswith('src/'):
+        path = path[4:]
+    return path
+
+
+def _parse_header_path(line):
+    return line[4:].rstrip('\r\n')
+
+
+def _patch_lines(text):
+    """按换行符切分补丁文本（去掉行尾的\r）
+
+    不能使用str.splitlines()：它还会在\f、\x1c-\x1e、\x85、U+2028、U+2029等
+    字符处断行，而这些字符可以出现在上下文行中间，会把补丁块截断。
+    """
+    lines = text.split('\n')
+    if lines and lines[-1] == '':
+        lines.pop()
+    return [line[:-1] if line.endswith('\r') else line for line in lines]
+
+
+def parse_patch(text):
+    """解析补丁文本，返回FilePatch列表"""
+    lines = _patch_lines(text)
+    file_patches = []
+    current = None
+    i = 0
+    n = len(lines)
+
+    while i < n:
+        line = lines[i]
+
+        if line.startswith('--- ') and i + 1 < n and lines[i + 1].startswith('+++ '):
+            current = FilePatch(_parse_header_path(line), _parse_header_path(lines[i + 1]))
+            file_patches.append(current)
+            i += 2
+            continue
+
+        match = HUNK_HEADER_RE.match(line)
+        if match:
+            if current is None:
+                raise PatchError(f"补丁块缺少文件头: {line}")
+            old_count = int(match.group(2)) if match.group(2) is not None else 1
+            new_count = int(match.group(4)) if match.group(4) is not None else 1
+            hunk = Hunk(int(match.group(1)), old_count, int(match.group(3)), new_count)
+            i = _parse_hunk_body(lines, i + 1, hunk)
+            current.hunks.append(hunk)
+            continue
+
+        # diff --git、index、mode等扩展头以及补丁间的说明文字直接跳过
+        i += 1
+
+    if not file_patches:
+        raise PatchError("未在补丁中找到任何文件改动")
+    return file_patches
+
+
+def patch_targets(text):
+    """只扫描文件头，返回补丁涉及的相对路径列表（不解析补丁块）"""
+    targets = []
+    previous = ''
+    for line in _patch_lines(text):
+        if line.startswith('+++ ') and previous.startswith('--- '):
+            new_path = _parse_header_path(line)
+            if new_path == '/dev/null':
+                new_path = _parse_header_path(previous)
+            path = normalize_path(new_path)
+            if path not in targets:
+                targets.append(path)
+        previous = line
+    return targets
+
+
+def _parse_hunk_body(lines, i, hunk):
+    """解析补丁块内容，返回下一个未处理行的索引"""
+    old_seen = 0
+    new_seen = 0
+    n = len(lines)
+    last_tag = None
+
+    while i < n:
+        line = lines[i]
+
+        if line.startswith('\\'):
+            # "\ No newline at end of file"
+            if last_tag in (' ', '-'):
+                hunk.old_no_newline = True
+            if last_tag in (' ', '+'):
+                hunk.new_no_newline = True
+            i += 1
+            continue
+
+        if old_seen >= hunk.old_count and new_seen >= hunk.new_count:
+            break
+
+        # 遇到下一个补丁块或文件头时结束，行数不足的补丁块在下面报错
+        if HUNK_HEADER_RE.match(line) or line.startswith('diff --git '):
+            break
+        if line.startswith('--- ') and i + 1 < n and lines[i + 1].startswith('+++ '):
+            break
+
+        if line == '':
+            # 编辑器可能去掉了空上下文行行首的空格
+            tag, text = ' ', ''
+        else:
+            tag, text = line[0], line[1:]
+            if tag not in (' ', '-', '+'):
+                break
+
+        hunk.lines.append((tag, text))
+        if tag != '+':
+            old_seen += 1
+        if tag != '-':
+            new_seen += 1
+        last_tag = tag
+        i += 1
+
+    # 行数与补丁块头不一致说明补丁被截断或已损坏，不能当作完整的补丁块应用
+    if old_seen != hunk.old_count or new_seen != hunk.new_count:
+        raise PatchError(
+            f"补丁块 @@ -{hunk.old_start},{hunk.old_count} +{hunk.new_start},{hunk.new_count} @@ "
+            f"的内容行数不符: 实际 -{old_seen} +{new_seen}")
+    return i
+
+
+def _squash(text):
+    """忽略空白差异的比较键"""
+    return ' '.join(text.split())
+
+
+def _strip_eol(line):
+    if line.endswith('\r\n'):
+        return line[:-2]
+    if line.endswith('\n') or line.endswith('\r'):
+        return line[:-1]
+    return line
+
+
+def _detect_eol(lines):
+    for line in lines:
+        if line.endswith('\r\n'):
+            return '\r\n'
+        if line.endswith('\n'):
+            return '\n'
+    return '\n'
+
+
+def _match_at(keys, pos, expected):
+    if pos < 0 or pos + len(expected) > len(keys):
+        return False
+    for offset, key in enumerate(expected):
+        if keys[pos + offset] != key:
+            return False
+    return True
+
+
+def _find_position(keys, expected, start, lower_bound):
+    """从预期位置开始向两侧查找匹配位置，返回行索引或None"""
+    if not expected:
+        return max(min(start, len(keys)), lower_bound)
+
+    limit = len(keys) - len(expected)
+    if limit < lower_bound:
+        return None
+    start = min(max(start, lower_bound), limit)
+
+    distance = 0
+    while True:
+        forward = start + distance
+        backward = start - distance
+        in_range = False
+        if forward <= limit:
+            in_range = True
+            if _match_at(keys, forward, expected):
+                return forward
+        if distance and backward >= lower_bound:
+            in_range = True
+            if _match_at(keys, backward, expected):
+                return backward
+        if not in_range:
+            return None
+        distance += 1
+
+
+def _trim_context(hunk_lines, fuzz):
+    """按模糊度去掉首尾的上下文行，返回(前部去掉行数, 后部去掉行数, 剩余行)"""
+    head = 0
+    while head < fuzz and head < len(hunk_lines) and hunk_lines[head][0] == ' ':
+        head += 1
+    tail = 0
+    while (tail < fuzz and tail < len(hunk_lines) - head
+           and hunk_lines[len(hunk_lines) - 1 - tail][0] == ' '):
+        tail += 1
+    return head, tail, hunk_lines[head:len(hunk_lines) - tail]
+
+
+def apply_hunks(lines, file_patch, fuzz=DEFAULT_FUZZ, keys=None):
+    """将FilePatch应用到行列表（保留行尾换行符），返回新的行列表
+
+    上下文行按忽略空白的方式比较，匹配成功时保留原文件中的上下文行内容，
+    新增行使用原文件的换行风格。
+    """
+    if file_patch.is_deleted_file:
+        return []
+
+    eol = _detect_eol(lines)
+    if keys is None:
+        keys = [_squash(_strip_eol(line)) for line in lines]
+    result = []
+    cursor = 0
+    offset = 0
+
+    for index, hunk in enumerate(file_patch.hunks):
+        position = None
+        for level in range(fuzz + 1):
+            head, tail, body = _trim_context(hunk.lines, level)
+            if level and not (head or tail):
+                continue
+            expected = [_squash(text) for tag, text in body if tag != '+']
+            # 旧起始行为0表示在文件开头插入
+            start = max(hunk.old_start - 1, 0) + offset + head
+            position = _find_position(keys, expected, start, cursor)
+            if position is not None:
+                break
+        if position is None:
+            raise PatchError(f"补丁块 #{index + 1} (@@ -{hunk.old_start},{hunk.old_count}) 无法匹配 {file_patch.path}")
+
+        offset = position - (max(hunk.old_start - 1, 0) + head)
+        result.extend(lines[cursor:position])
+        source = position
+        for tag, text in body:
+            if tag == ' ':
+                result.append(lines[source])
+                source += 1
+            elif tag == '-':
+                source += 1
+            else:
+                result.append(text + eol)
+        cursor = source
+
+    result.extend(lines[cursor:])
+
+    # 处理文件末尾换行符
+    if result and file_patch.hunks:
+        last_hunk = file_patch.hunks[-1]
+        if last_hunk.new_no_newline and cursor == len(lines):
+            result[-1] = _strip_eol(result[-1])
+        elif last_hunk.old_no_newline and not last_hunk.new_no_newline:
+            if not result[-1].endswith(('\n', '\r')):
+                result[-1] += eol
+    return result
+
+
+def find_file_patch(file_patches, rel_path):
+    """在补丁中查找针对指定相对路径的FilePatch"""
+    rel_path = rel_path.replace('\\', '/')
+    for file_patch in file_patches:
+        if file_patch.path == rel_path:
+            return file_patch
+    # 补丁可能以其他目录为根生成，允许按完整路径后缀匹配
+    for file_patch in file_patches:
+        path = file_patch.path
+        if path.endswith('/' + rel_path) or rel_path.endswith('/' + path):
+            return file_patch
+    return None
+
+
+def decode_content(data):
+    """将文件字节按换行符解码为行列表（保留行尾，无法解码的字节原样保留）
+
+    与git diff的行定义一致，只在\n处断行，\f、U+2028等字符保留在行内。
+    """
+    text = data.decode('utf-8', errors='surrogateescape')
+    lines = text.split('\n')
+    result = [line + '\n' for line in lines[:-1]]
+    if lines[-1]:
+        result.append(lines[-1])
+    return result
+
+
+def encode_content(lines):
+    """将行列表编码回字节"""
+    return ''.join(lines).encode('utf-8', errors='surrogateescape')
+
+
+def apply_to_bytes(data, file_patch, fuzz=DEFAULT_FUZZ):
+    """将FilePatch应用到文件字节内容，返回新的字节内容"""
+    return encode_content(apply_hunks(decode_content(data), file_patch, fuzz))
+
+
+def _split_lines(data):
+    """按换行符切分字节内容（保留行尾），与git diff的行定义一致"""
+    return decode_content(data)
+
+
+def make_patch(old_data, new_data, rel_path, context=3):
+    """生成从old_data到new_data的unified diff文本，内容相同时返回空字符串
+
+    文件头与git diff一致（a/、b/前缀），可直接被本模块和git apply应用。
+    """
+    rel_path = rel_path.replace('\\', '/')
+    old_lines = _split_lines(old_data)
+    new_lines = _split_lines(new_data)
+    if old_lines == new_lines:
+        return ''
+    out = [f'diff --git a/{rel_path} b/{rel_path}\n']
+    for line in difflib.unified_diff(old_lines, new_lines, f'a/{rel_path}', f'b/{rel_path}', n=context):
+        out.append(line)
+        if not line.endswith('\n'):
+            out.append('\n\\ No newline at end of file\n')
+    return ''.join(out)
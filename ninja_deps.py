@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+基于ninja构建记录的重建代价估算
+
+读取out目录中的两个文件：
+1. .ninja_deps：二进制格式，记录每个输出（目标文件）依赖的头文件和源文件
+2. .ninja_log：文本格式，记录每个输出最近一次构建的起止时间
+
+对被补丁修改的源码文件，从.ninja_deps反查依赖它的目标文件，再用.ninja_log中
+的编译耗时求和，得到修改该文件需要重新编译的目标文件数和预计编译CPU秒数。
+多个文件共同影响的目标文件只计算一次。
+
+.ninja_deps中没有源文件本身的记录时（例如MSVC的/showIncludes只列出头文件），
+按Chromium的目标文件命名规则 obj/<BUILD.gn目录>/<目标名>/<文件名>.o(bj) 匹配。
+
+此外提供构建历史(build_history.jsonl)的读写，build_with_patches.py在每次构建后
+追加一条记录，其中包含各阶段耗时和本次构建的估算值，用于将CPU秒换算为实际耗时。
+"""
+
+import json
+import mmap
+import os
+import statistics
+import struct
+import time
+
+DEPS_SIGNATURE = b"# ninjadeps\n"
+LOG_SIGNATURE = "# ninja log v"
+
+# .ninja_log中没有记录的目标文件，按已记录的编译耗时中位数估算
+DEFAULT_OBJECT_SECONDS = 1.0
+
+OBJECT_SUFFIXES = (".o", ".obj")
+
+_UINT32 = struct.Struct("<I")
+
+
+def _iter_deps(path):
+    """逐条产生.ninja_deps中的记录
+
+    路径记录产生(路径原始字节, None, None)，依赖记录产生(None, 输出编号,
+    依赖编号元组)。路径记录按出现顺序编号，依赖记录中引用的编号总是指向
+    之前出现过的路径。
+    """
+    with open(path, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # 空文件无法映射
+            return
+    try:
+        if data[:len(DEPS_SIGNATURE)] != DEPS_SIGNATURE:
+            raise ValueError(f"不是有效的.ninja_deps文件: {path}")
+        version = _UINT32.unpack_from(data, len(DEPS_SIGNATURE))[0]
+        if version not in (3, 4):
+            raise ValueError(f"不支持的.ninja_deps版本: {version}")
+        # v4的mtime为8字节，v3为4字节
+        header_size = 12 if version == 4 else 8
+
+        offset = len(DEPS_SIGNATURE) + 4
+        end = len(data)
+        while offset + 4 <= end:
+            size = _UINT32.unpack_from(data, offset)[0]
+            offset += 4
+            is_deps = size & 0x80000000
+            size &= 0x7FFFFFFF
+            if offset + size > end:
+                # 写了一半的记录
+                break
+            if is_deps:
+                out_id = struct.unpack_from("<i", data, offset)[0]
+                count = (size - header_size) // 4
+                yield None, out_id, struct.unpack_from(f"<{count}i", data, offset + header_size)
+            else:
+                yield data[offset:offset + size - 4].rstrip(b"\0"), None, None
+            offset += size
+    finally:
+        data.close()
+
+
+def _read_deps(path, wanted):
+    """解析.ninja_deps，返回{wanted中的值: {输出路径, ...}}
+
+    wanted为{路径记录的原始字节: 键}。同一输出的依赖记录以最后一条为准。
+    """
+    paths = []
+    wanted_ids = {}
+    # 输出编号 -> 依赖的wanted键集合
+    outputs = {}
+    for raw, out_id, ids in _iter_deps(path):
+        if raw is not None:
+            key = wanted.get(raw)
+            if key is not None:
+                wanted_ids[len(paths)] = key
+            paths.append(raw)
+            continue
+        keys = {wanted_ids[i] for i in ids if i in wanted_ids}
+        if keys:
+            outputs[out_id] = keys
+        else:
+            outputs.pop(out_id, None)
+
+    result = {}
+    for out_id, keys in outputs.items():
+        output = os.fsdecode(paths[out_id])
+        for key in keys:
+            result.setdefault(key, set()).add(output)
+    return result
+
+
+def read_output_deps(out_dir, outputs):
+    """读取out目录.ninja_deps中指定目标文件的全部依赖
+
+    outputs为目标文件的绝对路径。返回{目标文件: [依赖文件的绝对路径, ...]}，
+    没有依赖记录的目标文件不出现在结果中。
+    """
+    out_dir = os.path.abspath(out_dir)
+    deps_file = os.path.join(out_dir, ".ninja_deps")
+    if not os.path.exists(deps_file):
+        return {}
+    # .ninja_deps中的输出路径相对于out目录
+    wanted = {}
+    for output in outputs:
+        rel = os.path.relpath(output, out_dir)
+        wanted[os.fsencode(rel)] = output
+        wanted[os.fsencode(rel.replace(os.sep, "/"))] = output
+    paths = []
+    records = {}
+    for raw, out_id, ids in _iter_deps(deps_file):
+        if raw is not None:
+            paths.append(raw)
+            continue
+        key = wanted.get(paths[out_id])
+        if key is not None:
+            records[key] = ids
+    return {
+        output: [os.path.normpath(os.path.join(out_dir, os.fsdecode(paths[i]))) for i in ids]
+        for output, ids in records.items()
+    }
+
+
+def read_ninja_log(path):
+    """解析.ninja_log，返回{输出路径: 编译秒数}，同一输出以最后一次构建为准"""
+    durations = {}
+    if not os.path.exists(path):
+        return durations
+    with open(path, "r", encoding="utf-8", errors="surrogateescape") as f:
+        first = f.readline()
+        if not first.startswith(LOG_SIGNATURE):
+            raise ValueError(f"不是有效的.ninja_log文件: {path}")
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 4:
+                continue
+            try:
+                start, finish = int(fields[0]), int(fields[1])
+            except ValueError:
+                continue
+            durations[fields[3]] = max(finish - start, 0) / 1000.0
+    return durations
+
+
+def _fallback_objects(rel_path, durations):
+    """按Chromium的目标文件命名规则查找源文件对应的目标文件"""
+    stem = os.path.splitext(os.path.basename(rel_path))[0]
+    names = {stem + suffix for suffix in OBJECT_SUFFIXES}
+    # BUILD.gn所在目录是源文件所在目录或其上级目录
+    parts = rel_path.replace("\\", "/").split("/")[:-1]
+    prefixes = tuple("obj/" + "/".join(parts[:i]) + "/" for i in range(len(parts), 0, -1))
+    return {
+        output for output in durations
+        if output.startswith(prefixes) and output.rsplit("/", 1)[-1] in names
+    }
+
+
+class BuildCostModel(object):
+    """一个out目录的重建代价模型，只关注rel_paths中的源码文件"""
+
+    def __init__(self, out_dir, src_dir, rel_paths):
+        self.out_dir = os.path.abspath(out_dir)
+        self.src_dir = os.path.abspath(src_dir)
+        self.durations = read_ninja_log(os.path.join(self.out_dir, ".ninja_log"))
+
+        # .ninja_deps中的路径相对于out目录，系统头文件等为绝对路径
+        wanted = {}
+        for rel_path in rel_paths:
+            abs_path = os.path.join(self.src_dir, rel_path)
+            for form in (os.path.relpath(abs_path, self.out_dir), abs_path):
+                wanted[os.fsencode(form)] = rel_path
+                wanted[os.fsencode(form.replace(os.sep, "/"))] = rel_path
+        deps_file = os.path.join(self.out_dir, ".ninja_deps")
+        self.objects = _read_deps(deps_file, wanted) if os.path.exists(deps_file) else {}
+        for rel_path in rel_paths:
+            if rel_path not in self.objects and not rel_path.endswith((".h", ".hh", ".hpp", ".inc")):
+                found = _fallback_objects(rel_path, self.durations)
+                if found:
+                    self.objects[rel_path] = found
+
+        compile_times = [s for o, s in self.durations.items() if o.endswith(OBJECT_SUFFIXES)]
+        self.default_seconds = statistics.median(compile_times) if compile_times else DEFAULT_OBJECT_SECONDS
+
+    @property
+    def available(self):
+        """out目录中是否有可用的构建记录"""
+        return bool(self.durations) or bool(self.objects)
+
+    def affected_objects(self, rel_paths):
+        """修改这些文件后需要重新编译的目标文件"""
+        result = set()
+        for rel_path in rel_paths:
+            result.update(self.objects.get(rel_path, ()))
+        return result
+
+    def object_seconds(self, objects):
+        return sum(self.durations.get(o, self.default_seconds) for o in objects)
+
+    def estimate(self, rel_paths):
+        """返回(目标文件数, 预计编译CPU秒数)"""
+        objects = self.affected_objects(rel_paths)
+        return len(objects), self.object_seconds(objects)
+
+    def target_seconds(self, rel_path):
+        """单个文件的重建代价，用作构建队列排序的权重"""
+        return self.object_seconds(self.objects.get(rel_path, ()))
+
+
+# ----- 构建历史 -----
+
+def append_history(path, entry):
+    """追加一条构建记录"""
+    entry = dict(entry, time=entry.get("time") or time.strftime("%Y-%m-%d %H:%M:%S"))
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def load_history(path, limit=None):
+    """读取构建记录，按时间顺序返回，limit指定时只返回最近的limit条"""
+    entries = []
+    if not os.path.exists(path):
+        return entries
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+    return entries[-limit:] if limit else entries
+
+
+def wall_time_ratio(entries):
+    """根据历史记录中实际构建耗时与估算CPU秒数之比的中位数，无可用记录时返回None"""
+    ratios = [
+        e["phases"]["build"] / e["estimate"]["seconds"]
+        for e in entries
+        if e.get("success") and e.get("estimate") and e["estimate"].get("seconds")
+        and e.get("phases", {}).get("build")
+    ]
+    return statistics.median(ratios) if ratios else None
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+补丁集合二分定位
+
+使用delta debugging的ddmin算法，在有效补丁集合中找出使测试命令失败的最小
+补丁子集：每一轮把当前失败集合分成n份，并行测试每一份及其补集；某一份失败
+时缩小到该份，某个补集失败时缩小到该补集，都不失败时加倍粒度。得到的子集是
+1-最小的，即去掉其中任意一个补丁后测试都会通过，因此两个或多个补丁共同作用
+才导致的失败也会以多个补丁的形式出现在结果中。单个补丁导致失败时只需要
+约log2(补丁数)轮。
+
+本模块只包含算法，子集的应用和测试由调用方通过run_tests提供。
+"""
+
+
+def split(items, n):
+    """将items按顺序分成n个大小尽量相等的连续块"""
+    chunks = []
+    start = 0
+    for i in range(n):
+        end = start + (len(items) - start) // (n - i)
+        chunks.append(tuple(items[start:end]))
+        start = end
+    return chunks
+
+
+def ddmin(items, run_tests, on_round=None):
+    """在items中查找1-最小的失败子集
+
+    run_tests(subsets)并行测试一组子集（元组），返回与之一一对应的布尔列表，
+    True表示测试失败。调用方应保证items整体测试失败。每轮结束后调用
+    on_round(轮次, 粒度, 当前集合大小, 本轮测试的子集数)。返回(最小失败子集,
+    轮数, 实际测试的子集数)，相同的子集只测试一次。
+    """
+    results = {}
+
+    def test_many(subsets):
+        todo = [s for s in dict.fromkeys(subsets) if s not in results]
+        if todo:
+            for subset, failed in zip(todo, run_tests(todo)):
+                results[subset] = failed
+        return [results[s] for s in subsets]
+
+    current = tuple(items)
+    n = 2
+    rounds = 0
+    while len(current) >= 2:
+        rounds += 1
+        chunks = split(current, n)
+        # n为2时补集就是另一块，无需重复测试
+        complements = []
+        if n > 2:
+            for chunk in chunks:
+                removed = set(chunk)
+                complements.append(tuple(i for i in current if i not in removed))
+        outcome = test_many(chunks + complements)
+        if on_round:
+            on_round(rounds, n, len(current), len(chunks) + len(complements))
+
+        failing = [chunk for chunk, failed in zip(chunks, outcome) if failed]
+        if failing:
+            current, n = failing[0], 2
+            continue
+        failing = [c for c, failed in zip(complements, outcome[len(chunks):]) if failed]
+        if failing:
+            current, n = failing[0], max(n - 1, 2)
+            continue
+        if n >= len(current):
+            break
+        n = min(n * 2, len(current))
+    return current, rounds, len(results)
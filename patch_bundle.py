@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+补丁包格式
+
+将patches目录下的全部补丁、补丁映射表和清单打包为单个文件，构建机只需接收
+一个内容确定、哈希稳定的文件，无需解压即可应用。
+
+文件布局：
+  [0:8)     魔数 b"FPBUNDLE"
+  [8:12)    格式版本（uint32，小端）
+  [12:16)   清单长度N（uint32，小端）
+  [16:16+N) 清单（UTF-8 JSON）
+  [16+N:)   数据区：按清单顺序依次存放的补丁内容
+
+清单格式：
+  {
+    "format": 1,
+    "mappings": {类别: [目标相对路径, ...]},
+    "categories": [类别, ...],
+    "data_size": 数据区长度,
+    "patches": [{"path": "<类别>/<文件名>", "offset": 数据区内偏移, "size": 长度,
+                 "sha256": 内容哈希, "targets": [目标相对路径, ...]}, ...]
+  }
+
+清单以排序后的紧凑JSON写入、补丁按路径排序，且不含时间戳，因此相同的输入
+总是产生字节完全相同的补丁包。打开补丁包时通过mmap只读取头部和清单，补丁
+内容在使用时才从映射中切片读取并校验哈希。
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+import diff_engine
+
+MAGIC = b"FPBUNDLE"
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("<8sII")
+
+
+class BundleError(Exception):
+    """补丁包格式错误或内容校验失败"""
+
+
+def pack(patches_dir, mappings, categories, output):
+    """将patches_dir下的补丁打包到output，返回(补丁包哈希, 补丁数)"""
+    patches = []
+    data = []
+    offset = 0
+    for category in sorted(os.listdir(patches_dir)):
+        category_dir = os.path.join(patches_dir, category)
+        if not os.path.isdir(category_dir):
+            continue
+        for name in sorted(os.listdir(category_dir)):
+            path = os.path.join(category_dir, name)
+            if not name.endswith(".patch") or not os.path.isfile(path):
+                continue
+            with open(path, "rb") as f:
+                content = f.read()
+            patches.append({
+                "path": f"{category}/{name}",
+                "offset": offset,
+                "size": len(content),
+                "sha256": hashlib.sha256(content).hexdigest(),
+                "targets": diff_engine.patch_targets(content.decode("utf-8", errors="surrogateescape"))
+            })
+            data.append(content)
+            offset += len(content)
+
+    manifest = json.dumps({
+        "format": FORMAT_VERSION,
+        "mappings": mappings,
+        "categories": list(categories),
+        "data_size": offset,
+        "patches": patches
+    }, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+    digest = hashlib.sha256()
+    tmp_path = f"{output}.tmp"
+    with open(tmp_path, "wb") as f:
+        for chunk in [_HEADER.pack(MAGIC, FORMAT_VERSION, len(manifest)), manifest] + data:
+            f.write(chunk)
+            digest.update(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, output)
+    return digest.hexdigest(), len(patches)
+
+
+class PatchBundle(object):
+    """以mmap方式打开的补丁包"""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        with open(self.path, "rb") as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise BundleError(f"补丁包为空: {path}")
+        try:
+            self._parse()
+        except Exception:
+            self._map.close()
+            raise
+
+    def _parse(self):
+        if len(self._map) < _HEADER.size:
+            raise BundleError(f"补丁包头部不完整: {self.path}")
+        magic, version, manifest_size = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise BundleError(f"不是补丁包文件: {self.path}")
+        if version != FORMAT_VERSION:
+            raise BundleError(f"不支持的补丁包版本: {version}")
+        self.data_start = _HEADER.size + manifest_size
+        if self.data_start > len(self._map):
+            raise BundleError(f"补丁包清单不完整: {self.path}")
+        manifest_bytes = self._map[_HEADER.size:self.data_start]
+        try:
+            self.manifest = json.loads(manifest_bytes)
+        except ValueError as e:
+            raise BundleError(f"补丁包清单无法解析: {e}")
+        # 清单哈希唯一确定补丁包内容（清单中包含每个补丁的哈希），用作补丁包ID
+        self.bundle_id = hashlib.sha256(self._map[:self.data_start]).hexdigest()
+        self.mappings = self.manifest["mappings"]
+        self.categories = self.manifest["categories"]
+        self.entries = {entry["path"]: entry for entry in self.manifest["patches"]}
+
+    def close(self):
+        self._map.close()
+
+    def read(self, rel_path, verify=True):
+        """读取一个补丁的内容，verify为True时校验哈希"""
+        entry = self.entries[rel_path]
+        start = self.data_start + entry["offset"]
+        end = start + entry["size"]
+        if end > len(self._map):
+            raise BundleError(f"补丁超出补丁包范围: {rel_path}")
+        content = self._map[start:end]
+        if verify and hashlib.sha256(content).hexdigest() != entry["sha256"]:
+            raise BundleError(f"补丁内容哈希不匹配: {rel_path}")
+        return content
+
+    def extract(self, rel_path, dest):
+        """将补丁写入dest，已存在且大小一致时跳过（提取目录按补丁包ID区分）"""
+        entry = self.entries[rel_path]
+        try:
+            if os.path.getsize(dest) == entry["size"]:
+                return dest
+        except OSError:
+            pass
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp_path = f"{dest}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.read(rel_path))
+        os.replace(tmp_path, dest)
+        return dest
+
+    def unpack(self, dest_dir):
+        """解出全部补丁，返回写入的文件数"""
+        for rel_path in self.entries:
+            self.extract(rel_path, os.path.join(dest_dir, *rel_path.split("/")))
+        return len(self.entries)
+
+    def verify(self):
+        """校验补丁包完整性，返回(错误列表, 整个文件的哈希)"""
+        errors = []
+        data_size = self.manifest.get("data_size", 0)
+        if self.data_start + data_size != len(self._map):
+            errors.append(f"文件长度不符: 清单记录 {self.data_start + data_size} 字节，实际 {len(self._map)} 字节")
+        expected = 0
+        for entry in self.manifest["patches"]:
+            if entry["offset"] != expected:
+                errors.append(f"补丁偏移不连续: {entry['path']}")
+            expected = entry["offset"] + entry["size"]
+            try:
+                self.read(entry["path"])
+            except BundleError as e:
+                errors.append(str(e))
+        return errors, hashlib.sha256(self._map).hexdigest()
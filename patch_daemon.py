@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+补丁管理常驻进程
+
+在内存中保持补丁查找表、目标文件状态索引和已读取的配置文件，通过Unix socket
+接收patch_manager.py转发来的命令并在进程内执行，省去每次启动时读取索引、
+扫描补丁目录和逐个stat目标文件的开销。
+
+缓存失效依赖inotify：
+1. patches/及其类别子目录有任何变化时丢弃补丁查找表
+2. configs/中的文件变化时丢弃已读取的配置
+3. 补丁涉及的源码文件被修改时，丢弃该文件在状态索引中的条目，
+   即使修改前后size和mtime相同也会重新计算哈希
+inotify队列溢出时丢弃全部缓存。
+
+系统不支持inotify时退化为每次命令都重新加载查找表和配置（状态索引仍保存在
+内存中，依靠stat校验）。
+
+用法：
+  python patch_daemon.py start [--detach]
+  python patch_daemon.py status
+  python patch_daemon.py stop
+
+常驻进程运行期间，patch_manager.py的所有命令都会转发给它执行；设置环境变量
+FP_NO_DAEMON=1 可强制在当前进程中执行。
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import io
+import json
+import os
+import select
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import traceback
+
+import patch_manager
+
+# inotify事件掩码
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify(object):
+    """通过ctypes调用inotify的最小封装"""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        # 监视描述符 -> 目录路径
+        self.watches = {}
+        self._paths = {}
+
+    def add_watch(self, path):
+        """监视一个目录，重复添加时直接返回已有的描述符"""
+        if path in self._paths:
+            return self._paths[path]
+        wd = self._add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"无法监视目录: {path}")
+        self.watches[wd] = path
+        self._paths[path] = wd
+        return wd
+
+    def remove_watch(self, path):
+        wd = self._paths.pop(path, None)
+        if wd is not None:
+            self.watches.pop(wd, None)
+            self._rm_watch(self.fd, wd)
+
+    def read_events(self, timeout):
+        """等待并读取事件，返回[(目录路径或None, 掩码, 文件名), ...]"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_IGNORED:
+                path = self.watches.pop(wd, None)
+                if path is not None:
+                    self._paths.pop(path, None)
+                continue
+            events.append((self.watches.get(wd), mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class WarmCache(object):
+    """常驻进程的内存缓存，由patch_manager在加载索引和配置时读写
+
+    watching为False（inotify不可用）时patch_manager不会使用patch_lookup和configs。
+    """
+
+    def __init__(self, watching):
+        self.lock = threading.RLock()
+        self.watching = watching
+        self.patch_lookup = None
+        self.file_state_index = None
+        # 配置文件绝对路径 -> 解析后的配置
+        self.configs = {}
+
+    def invalidate_all(self):
+        with self.lock:
+            self.patch_lookup = None
+            self.file_state_index = None
+            self.configs = {}
+
+    def invalidate_source(self, rel_path):
+        """丢弃一个源码文件的状态索引条目"""
+        with self.lock:
+            if self.file_state_index is not None:
+                self.file_state_index["files"].pop(rel_path, None)
+
+
+class Watcher(threading.Thread):
+    """后台线程：读取inotify事件并使对应的缓存失效"""
+
+    def __init__(self, warm, inotify):
+        super().__init__(name="fp-watcher", daemon=True)
+        self.warm = warm
+        self.inotify = inotify
+        self._stopping = threading.Event()
+        # 被监视的源码目录 -> 该目录下需要关注的文件名集合
+        self._source_dirs = {}
+        self._watch_lock = threading.Lock()
+        # 保证事件只被一个线程读取和处理
+        self._read_lock = threading.Lock()
+
+    def watch_static(self):
+        """监视补丁目录、各类别子目录和配置目录"""
+        for path in (patch_manager.PATCHES_DIR, patch_manager.CONFIG_DIR):
+            if os.path.isdir(path):
+                self.inotify.add_watch(path)
+        if os.path.isdir(patch_manager.PATCHES_DIR):
+            with os.scandir(patch_manager.PATCHES_DIR) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        self.inotify.add_watch(entry.path)
+
+    def sync_sources(self, lookup):
+        """根据补丁查找表监视所有被补丁修改的源码文件所在目录"""
+        wanted = {}
+        for _, _, target in lookup:
+            rel_dir, name = os.path.split(target)
+            wanted.setdefault(os.path.join(patch_manager.SRC_DIR, rel_dir), set()).add(name)
+        with self._watch_lock:
+            for path in set(self._source_dirs) - set(wanted):
+                self.inotify.remove_watch(path)
+            for path in wanted:
+                if path not in self._source_dirs and os.path.isdir(path):
+                    try:
+                        self.inotify.add_watch(path)
+                    except OSError:
+                        continue
+            self._source_dirs = wanted
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                ready, _, _ = select.select([self.inotify.fd], [], [], 0.5)
+                if ready:
+                    self.drain()
+            except OSError:
+                self.warm.invalidate_all()
+                return
+
+    def drain(self):
+        """处理所有已到达的事件；执行命令前调用，保证命令开始前的修改都已生效"""
+        with self._read_lock:
+            for path, mask, name in self.inotify.read_events(0):
+                self._handle(path, mask, name)
+
+    def _handle(self, path, mask, name):
+        warm = self.warm
+        if mask & IN_Q_OVERFLOW or path is None:
+            warm.invalidate_all()
+            return
+        if path == patch_manager.PATCHES_DIR or os.path.dirname(path) == patch_manager.PATCHES_DIR:
+            with warm.lock:
+                warm.patch_lookup = None
+            if path == patch_manager.PATCHES_DIR and mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self.inotify.add_watch(os.path.join(path, name))
+                except OSError:
+                    pass
+            return
+        if path == patch_manager.CONFIG_DIR:
+            with warm.lock:
+                warm.configs.pop(os.path.join(path, name), None)
+            return
+        with self._watch_lock:
+            names = self._source_dirs.get(path)
+        if names is not None and name in names:
+            rel_path = os.path.relpath(os.path.join(path, name), patch_manager.SRC_DIR)
+            warm.invalidate_source(rel_path.replace(os.sep, "/"))
+
+
+class _StreamWriter(io.TextIOBase):
+    """将命令输出按行转发给客户端，客户端断开后丢弃输出"""
+
+    def __init__(self, wfile):
+        self._wfile = wfile
+        self._lock = threading.Lock()
+        self.closed_by_peer = False
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if not text or self.closed_by_peer:
+            return len(text)
+        data = json.dumps({"out": text}, ensure_ascii=False).encode("utf-8") + b"\n"
+        with self._lock:
+            try:
+                self._wfile.write(data)
+                self._wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                self.closed_by_peer = True
+        return len(text)
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    """处理一个客户端连接：读取一行JSON请求，执行后以JSON行返回输出和退出码"""
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        control = request.get("control")
+        if control is not None:
+            self._send({"exit": 0, "pid": os.getpid(), "watching": self.server.warm.watching})
+            if control == "stop":
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return
+
+        writer = _StreamWriter(self.wfile)
+        exit_code = self.server.run_command(request, writer)
+        if not writer.closed_by_peer:
+            self._send({"exit": exit_code})
+
+    def _send(self, message):
+        try:
+            self.wfile.write(json.dumps(message, ensure_ascii=False).encode("utf-8") + b"\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """命令逐个串行执行；控制消息不受正在执行的命令影响"""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, warm, watcher):
+        self.warm = warm
+        self.watcher = watcher
+        self._command_lock = threading.Lock()
+        super().__init__(socket_path, CommandHandler)
+
+    def server_bind(self):
+        # 常驻进程会执行任意子命令（包括bisect --test-cmd），socket只允许当前用户访问；
+        # 在listen之前修改权限，不存在可被其他用户连接的时间窗口
+        super().server_bind()
+        os.chmod(self.server_address, 0o600)
+
+    def run_command(self, request, writer):
+        with self._command_lock:
+            if self.watcher is not None:
+                self.watcher.drain()
+            with self.warm.lock:
+                return self._run_locked(request, writer)
+
+    def _run_locked(self, request, writer):
+        """在客户端的工作目录和环境变量下执行命令，返回退出码"""
+        argv = request.get("argv", [])
+        saved_cwd = os.getcwd()
+        saved_env = dict(os.environ)
+        saved_streams = sys.stdout, sys.stderr
+        saved_argv = sys.argv
+        try:
+            # 帮助和错误信息中的程序名与直接执行时一致
+            sys.argv = [os.path.basename(patch_manager.__file__)] + argv
+            os.chdir(request.get("cwd") or saved_cwd)
+            if "env" in request:
+                # 整体替换为客户端的环境变量，子进程看到的PATH、CC等与直接执行时一致
+                os.environ.clear()
+                os.environ.update(request["env"])
+            sys.stdout = sys.stderr = writer
+            try:
+                exit_code = patch_manager.main(argv)
+            except SystemExit as e:
+                # argparse出错或--help时以SystemExit退出
+                exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+        finally:
+            sys.stdout, sys.stderr = saved_streams
+            sys.argv = saved_argv
+            os.chdir(saved_cwd)
+            os.environ.clear()
+            os.environ.update(saved_env)
+        if self.watcher is not None and self.warm.patch_lookup is not None:
+            self.watcher.sync_sources(self.warm.patch_lookup)
+        return exit_code or 0
+
+
+def _send_control(control):
+    """向常驻进程发送控制消息，未运行时返回None"""
+    if not os.path.exists(patch_manager.DAEMON_SOCKET_FILE):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(patch_manager.DAEMON_SOCKET_FILE)
+    except OSError:
+        client.close()
+        return None
+    with client, client.makefile("rwb") as stream:
+        stream.write(json.dumps({"control": control}).encode("utf-8") + b"\n")
+        stream.flush()
+        line = stream.readline()
+    return json.loads(line) if line else None
+
+
+def serve():
+    """在前台运行常驻进程，直到收到stop或被中断"""
+    socket_path = patch_manager.DAEMON_SOCKET_FILE
+    if _send_control("ping") is not None:
+        print(f"常驻进程已在运行: {socket_path}")
+        return 1
+    if os.path.exists(socket_path):
+        # 上次异常退出遗留的socket文件
+        os.unlink(socket_path)
+
+    try:
+        inotify = Inotify()
+    except (OSError, AttributeError) as e:
+        print(f"警告: inotify不可用({e})，补丁查找表和配置不会常驻内存")
+        inotify = None
+
+    warm = WarmCache(watching=inotify is not None)
+    watcher = None
+    if inotify is not None:
+        watcher = Watcher(warm, inotify)
+        watcher.watch_static()
+
+    # 预热：先注册监视再加载，避免加载期间的修改被遗漏
+    patch_manager._WARM_CACHE = warm
+    lookup = patch_manager.build_patch_index()
+    if watcher is not None:
+        watcher.sync_sources(lookup)
+        watcher.start()
+    warm.file_state_index = patch_manager.load_file_state_index()
+    patch_manager.get_state_db()
+    patch_manager.get_blob_store()
+
+    server = DaemonServer(socket_path, warm, watcher)
+    print(f"常驻进程已启动 (pid {os.getpid()}): {socket_path}")
+    print(f"已加载 {len(lookup)} 个补丁查找项，inotify: {'启用' if watcher else '未启用'}")
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if watcher is not None:
+            watcher.stop()
+            watcher.join()
+            inotify.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        patch_manager._WARM_CACHE = None
+    print("常驻进程已退出")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="补丁管理常驻进程")
+    subparsers = parser.add_subparsers(dest="command", help="子命令")
+
+    start_parser = subparsers.add_parser("start", help="启动常驻进程")
+    start_parser.add_argument("--detach", action="store_true", help="在后台运行")
+    subparsers.add_parser("stop", help="停止常驻进程")
+    subparsers.add_parser("status", help="查看常驻进程是否运行")
+
+    args = parser.parse_args()
+
+    if args.command == "start":
+        if args.detach:
+            if os.fork() > 0:
+                return 0
+            os.setsid()
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            os.close(devnull)
+        return serve()
+    elif args.command == "stop":
+        reply = _send_control("stop")
+        if reply is None:
+            print("常驻进程未运行")
+            return 1
+        print(f"已停止常驻进程 (pid {reply['pid']})")
+    elif args.command == "status":
+        reply = _send_control("ping")
+        if reply is None:
+            print("常驻进程未运行")
+            return 1
+        print(f"常驻进程运行中 (pid {reply['pid']}), inotify: {'启用' if reply['watching'] else '未启用'}")
+    else:
+        parser.print_help()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
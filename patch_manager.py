@@ -18,20 +18,86 @@ Chromium指纹补丁管理系统
 """
 
 import argparse
+import contextlib
+import copy
+import hashlib
+import io
 import json
 import os
+import queue
 import shutil
+import socket
 import subprocess
 import sys
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
+import apply_journal
+import blob_store
+import compile_check
+import diff_engine
+import ninja_deps
+import patch_bisect
+import patch_bundle
+import patch_rebase
+import src_index
+import state_db
+import trace_events
+
 # 全局配置
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 SRC_DIR = os.path.join(BASE_DIR, 'src')
 PATCHES_DIR = os.path.join(BASE_DIR, 'patches')
 CONFIG_DIR = os.path.join(BASE_DIR, 'configs')
 BACKUP_DIR = os.path.join(BASE_DIR, 'backups')
+OVERLAY_DIR = os.path.join(BASE_DIR, 'overlays')
+PATCH_INDEX_FILE = os.path.join(BASE_DIR, 'patches_index.json')
+PATCH_INDEX_VERSION = 1
+# 目标文件状态索引：记录stat信息与内容哈希，stat未变化时无需重新计算哈希
+FILE_STATE_INDEX_FILE = os.path.join(BASE_DIR, 'file_state_index.json')
+FILE_STATE_INDEX_VERSION = 1
+# mtime距当前时间小于该值的文件不写入索引，避免同一时间粒度内的修改被漏判
+FILE_STATE_RACY_NS = 2 * 1000 * 1000 * 1000
+# 应用/切换事务的预写日志，事务完成后删除
+APPLY_JOURNAL_FILE = os.path.join(BASE_DIR, 'apply_journal.jsonl')
+# 应用记录数据库（替代configs目录下的applied_/restored_记录文件）
+STATE_DB_FILE = os.path.join(BASE_DIR, 'state.db')
+# 预检结果缓存：(补丁哈希, 输入内容哈希) -> 是否可应用及输出内容哈希
+PLAN_CACHE_FILE = os.path.join(BASE_DIR, 'plan_cache.json')
+PLAN_CACHE_VERSION = 1
+PLAN_VERSION = 1
+# 共享目标文件的补丁两两组合的兼容性矩阵
+CONFLICT_MATRIX_FILE = os.path.join(BASE_DIR, 'patch_conflicts.json')
+CONFLICT_MATRIX_VERSION = 1
+# 常驻进程(patch_daemon.py)监听的Unix socket，存在时命令行会将命令转发给它
+DAEMON_SOCKET_FILE = os.path.join(BASE_DIR, '.patch_daemon.sock')
+# build_with_patches.py追加的构建历史：各阶段耗时及重建代价估算
+BUILD_HISTORY_FILE = os.path.join(BASE_DIR, 'build_history.jsonl')
+# estimate命令默认读取的ninja out目录（相对于src目录）
+DEFAULT_OUT_DIR = os.path.join('out', 'Default')
+# 从补丁包应用时，按需提取的补丁存放在 bundle_cache/<补丁包ID>/ 下
+BUNDLE_CACHE_DIR = os.path.join(BASE_DIR, 'bundle_cache')
+# 源码树路径索引（index-src命令生成，verify-mappings使用）
+SRC_INDEX_FILE = os.path.join(BASE_DIR, 'src_index.bin')
+# gen-build命令默认的ninja规则输出目录
+BUILD_RULES_DIR = os.path.join(BASE_DIR, 'build_rules')
+# check-compile命令的工作目录（变体目录、临时目标文件和编译结果缓存）
+CHECK_COMPILE_DIR = os.path.join(BASE_DIR, 'check_compile')
+# bisect命令的工作目录（每个并行槽位一个变体目录，以及测试日志和报告）
+BISECT_DIR = os.path.join(BASE_DIR, 'bisect')
+# rebase命令默认的输出目录
+REBASED_PATCHES_DIR = os.path.join(BASE_DIR, 'patches_rebased')
+
+# 备份模式: blob 将原始内容存入内容寻址存储；git 在内容与源码仓库HEAD一致时
+# 只记录git对象ID，还原时从源码仓库读取
+BACKUP_MODES = ['blob', 'git']
+BACKUP_MODE = os.environ.get('FP_BACKUP_MODE', 'blob')
+
+# 补丁模式（配置中的mode为default时不应用补丁），补丁文件名以 <模式>_ 开头
+PATCH_MODES = ['custom', 'random', 'noise', 'auto_replace']
 
 # 指纹类别
 FINGERPRINT_CATEGORIES = [
@@ -355,167 +421,2486 @@ def create_random_config():
     print(f"随机指纹配置已生成: {random_config_path}")
     return random_config_path
 
+# 常驻进程维护的内存缓存（patch_daemon.WarmCache），普通命令行调用时为None
+_WARM_CACHE = None
+
+_BLOB_STORE = None
+
+def get_blob_store():
+    """获取当前源码目录对应的备份存储"""
+    global _BLOB_STORE
+    if _BLOB_STORE is None or _BLOB_STORE.root != BACKUP_DIR or _BLOB_STORE.src_dir != SRC_DIR:
+        _BLOB_STORE = blob_store.BlobStore(BACKUP_DIR, SRC_DIR)
+    return _BLOB_STORE
+
+def get_backup_entry(file_path):
+    """查找文件的备份记录，兼容旧版按路径镜像的备份目录"""
+    rel_path = os.path.relpath(file_path, SRC_DIR)
+    store = get_blob_store()
+    entry = store.get_entry(rel_path)
+    if entry is None:
+        legacy_path = os.path.join(BACKUP_DIR, rel_path)
+        if os.path.isfile(legacy_path):
+            # 将旧版备份导入内容寻址存储
+            entry = {
+                "sha256": store.put_file(legacy_path),
+                "size": os.path.getsize(legacy_path)
+            }
+            store.set_entry(rel_path, entry)
+    return entry
+
 def backup_original_file(file_path):
-    """备份原始文件"""
+    """备份原始文件，返回备份记录"""
     rel_path = os.path.relpath(file_path, SRC_DIR)
-    backup_path = os.path.join(BACKUP_DIR, rel_path)
-    
-    # 确保备份目录存在
-    os.makedirs(os.path.dirname(backup_path), exist_ok=True)
     
-    # 如果备份文件不存在，则创建备份
-    if not os.path.exists(backup_path):
-        shutil.copy2(file_path, backup_path)
+    # 如果备份不存在，则创建备份
+    entry = get_backup_entry(file_path)
+    if entry is None:
+        with trace_events.span("backup", file=rel_path):
+            entry = get_blob_store().backup(file_path, rel_path, use_git=(BACKUP_MODE == 'git'))
+        trace_events.add("backup", bytes=entry.get("size", 0))
         print(f"已备份文件: {rel_path}")
     
-    return backup_path
+    return entry
+
+def pristine_file_path(file_path):
+    """返回包含目标文件原始内容的文件路径（必要时先创建备份）"""
+    return get_blob_store().pristine_path(backup_original_file(file_path), _rel_target(file_path))
 
 def restore_file(file_path):
     """从备份还原文件"""
     rel_path = os.path.relpath(file_path, SRC_DIR)
-    backup_path = os.path.join(BACKUP_DIR, rel_path)
+    entry = get_backup_entry(file_path)
     
-    if os.path.exists(backup_path):
-        shutil.copy2(backup_path, file_path)
-        print(f"已还原文件: {rel_path}")
+    if entry:
+        if os.path.exists(file_path) and blob_store.file_sha256(file_path) == entry["sha256"]:
+            print(f"文件内容未变化，跳过还原: {rel_path}")
+            return True
+        # 写入时使用当前时间作为mtime，避免mtime回退导致ninja漏掉重建
+        with trace_events.span("restore_file", file=rel_path):
+            method = get_blob_store().materialize(entry, file_path)
+        print(f"已还原文件: {rel_path} ({method})")
         return True
     else:
         print(f"警告: 未找到备份文件: {rel_path}")
         return False
 
-def apply_patch(patch_file, target_file):
-    """应用补丁到目标文件"""
+def read_pristine(file_path):
+    """读取目标文件的原始内容：存在备份时读取备份，否则读取当前文件"""
+    entry = get_backup_entry(file_path)
+    if entry:
+        return get_blob_store().read(entry, _rel_target(file_path))
+    return read_file_bytes(file_path)
+
+class TargetDriftError(Exception):
+    """目标文件既不是备份的原始内容，也不是应用记录中写入的内容"""
+
+def recorded_target_hashes():
+    """未还原记录中各目标文件写入后的内容哈希{相对路径: 哈希}，旧版记录为None"""
+    return {rel_path: digest for rel_path, (digest, _, _) in get_state_db().active_targets().items()}
+
+def checked_pristine(file_path, recorded, refresh_backup=False):
+    """读取目标文件的原始内容，读取前检查当前文件是否偏离
+
+    recorded为recorded_target_hashes()的结果。不在未还原记录中的文件应为原始
+    内容，与备份不一致说明源码已更新（例如同步了上游版本），重新备份当前内容；
+    仍在记录中的文件与备份及记录都不一致时说明被手工修改，抛出TargetDriftError，
+    以免覆盖修改。refresh_backup为True时将这类文件的当前内容作为新的原始内容。
+    """
+    rel_path = _rel_target(file_path)
+    entry = get_backup_entry(file_path)
+    if entry is None or not os.path.exists(file_path):
+        return read_pristine(file_path)
+    store = get_blob_store()
+    if rel_path in recorded:
+        if recorded[rel_path] is None:
+            # 旧版记录没有保存哈希，无法校验
+            return store.read(entry, rel_path)
+        digest = blob_store.file_sha256(file_path)
+        if digest in (entry["sha256"], recorded[rel_path]):
+            return store.read(entry, rel_path)
+        if not refresh_backup:
+            raise TargetDriftError(
+                f"{rel_path} 的当前内容既不是备份的原始内容，也不是应用记录中写入的内容（可能被手工修改），"
+                f"为避免覆盖修改未处理该文件；确认当前内容是新的原始内容后可加 --refresh-backup 重新备份")
+    new_entry = store.backup(file_path, rel_path, use_git=(BACKUP_MODE == 'git'))
+    if new_entry["sha256"] != entry["sha256"]:
+        print(f"{rel_path} 与备份的原始内容不一致（源码已更新），已重新备份当前内容")
+    return store.read(new_entry, rel_path)
+
+# 已解析补丁缓存: 补丁路径 -> ((mtime_ns, size), FilePatch列表)
+_PARSED_PATCHES = {}
+
+def load_patch(patch_file):
+    """解析补丁文件，同一补丁在进程内只解析一次"""
+    st = os.stat(patch_file)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _PARSED_PATCHES.get(patch_file)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    
+    with open(patch_file, "r", encoding="utf-8", errors="surrogateescape") as f:
+        file_patches = diff_engine.parse_patch(f.read())
+    _PARSED_PATCHES[patch_file] = (stamp, file_patches)
+    return file_patches
+
+# 补丁内容哈希缓存: 补丁路径 -> ((mtime_ns, size), 哈希)
+_PATCH_HASHES = {}
+
+def patch_sha256(patch_file):
+    """补丁文件的内容哈希，stat未变化时不重新计算"""
+    st = os.stat(patch_file)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _PATCH_HASHES.get(patch_file)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    digest = blob_store.file_sha256(patch_file)
+    _PATCH_HASHES[patch_file] = (stamp, digest)
+    return digest
+
+def _composed_key(base_content, patch_files):
+    parts = [hashlib.sha256(base_content).hexdigest()] + [patch_sha256(p) for p in patch_files]
+    return hashlib.sha256(":".join(parts).encode("ascii")).hexdigest()
+
+def load_composed(base_content, patch_files):
+    """查找补丁组合结果缓存，命中时返回组合后的内容，否则返回None"""
+    if len(patch_files) < 2:
+        return None
+    digest = get_state_db().get_composed(_composed_key(base_content, patch_files))
+    store = get_blob_store()
+    if digest is None or not store.has_blob(digest):
+        return None
+    return store.read_blob(digest)
+
+def store_composed(base_content, patch_files, content):
+    """保存补丁组合结果（内容存入blob存储，键为原始内容与有序补丁的哈希）"""
+    if len(patch_files) < 2:
+        return
+    digest = get_blob_store().put_bytes(content)
+    get_state_db().put_composed(_composed_key(base_content, patch_files), digest)
+
+def read_file_bytes(file_path):
+    """读取文件的全部字节"""
+    with open(file_path, "rb") as f:
+        return f.read()
+
+def write_file_bytes(file_path, data):
+    """写入文件：先写临时文件再原子替换，保留原文件权限"""
+    tmp_path = f"{file_path}.fp_tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    if os.path.exists(file_path):
+        shutil.copymode(file_path, tmp_path)
+    os.replace(tmp_path, file_path)
+
+def git_apply_patch(patch_file):
+    """使用git apply应用补丁（原生引擎无法应用时的后备方案）"""
     try:
-        # 备份原始文件
-        backup_original_file(target_file)
-        
-        # 使用git apply应用补丁
         cmd = ["git", "apply", "--ignore-whitespace", "--directory", os.path.dirname(SRC_DIR), patch_file]
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-        print(f"已应用补丁: {os.path.basename(patch_file)} 到 {os.path.relpath(target_file, SRC_DIR)}")
+        with trace_events.span("git_apply", patch=os.path.basename(patch_file)):
+            subprocess.run(cmd, check=True, capture_output=True, text=True)
         return True
     except subprocess.CalledProcessError as e:
         print(f"应用补丁失败: {e.stderr}")
         return False
+    except OSError as e:
+        print(f"应用补丁失败: 无法执行git: {e}")
+        return False
+
+def patch_content(content, patch_file, rel_path):
+    """在内存中将补丁应用到文件内容，失败时抛出diff_engine.PatchError"""
+    with trace_events.span("apply_patch", patch=os.path.basename(patch_file)):
+        file_patch = diff_engine.find_file_patch(load_patch(patch_file), rel_path)
+        if file_patch is None:
+            raise diff_engine.PatchError(f"补丁中没有针对 {rel_path} 的改动")
+        return diff_engine.apply_to_bytes(content, file_patch)
+
+def _patch_mode(filename):
+    """补丁文件名中的模式，文件名不以已知模式开头时返回None
+
+    补丁文件名格式为 <模式>_<名称>_<文件名>.patch，模式本身可能包含下划线
+    (例如 auto_replace)，因此按PATCH_MODES匹配最长的前缀。
+    """
+    matches = [mode for mode in PATCH_MODES if filename.startswith(f"{mode}_")]
+    return max(matches, key=len) if matches else None
+
+def _index_patch_file(patch_path, st):
+    """读取补丁文件，计算内容哈希并提取目标文件列表"""
+    with open(patch_path, "rb") as f:
+        data = f.read()
+    targets = diff_engine.patch_targets(data.decode("utf-8", errors="surrogateescape"))
+    return {
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "targets": targets
+    }
+
+def _save_json_atomic(path, data):
+    """以原子替换的方式保存JSON文件"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+@trace_events.traced("load_patch_index")
+def build_patch_index():
+    """加载补丁清单索引，按目录mtime增量更新
+
+    索引保存在PATCHES_DIR旁的patches_index.json中，记录每个补丁文件的
+    大小、mtime、内容哈希及其修改的目标文件。只有mtime发生变化的类别目录
+    会被重新扫描，且只有大小或mtime变化的补丁文件会被重新读取。
+    """
+    if _BUNDLE is not None:
+        return bundle_patch_index(_BUNDLE)
+    
+    warm = _WARM_CACHE
+    if warm is not None and warm.patch_lookup is not None:
+        # 常驻进程中补丁目录未发生变化，直接使用内存中的查找表
+        return warm.patch_lookup
+    
+    index = None
+    if os.path.exists(PATCH_INDEX_FILE):
+        try:
+            with open(PATCH_INDEX_FILE, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = None
+    if not index or index.get("version") != PATCH_INDEX_VERSION or index.get("patches_dir") != PATCHES_DIR:
+        index = {"version": PATCH_INDEX_VERSION, "patches_dir": PATCHES_DIR, "dirs": {}}
+    
+    old_dirs = index["dirs"]
+    new_dirs = {}
+    changed = False
+    
+    if os.path.isdir(PATCHES_DIR):
+        with os.scandir(PATCHES_DIR) as entries:
+            category_dirs = sorted((e.name, e.stat().st_mtime_ns) for e in entries if e.is_dir())
+    else:
+        category_dirs = []
+    
+    for category, dir_mtime in category_dirs:
+        old = old_dirs.get(category)
+        if old and old["mtime_ns"] == dir_mtime:
+            new_dirs[category] = old
+            continue
+        
+        # 目录内容有变化，重新扫描该类别目录
+        changed = True
+        old_files = old["files"] if old else {}
+        files = {}
+        category_dir = os.path.join(PATCHES_DIR, category)
+        with trace_events.span("scan_patch_dir", category=category), os.scandir(category_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".patch") or not entry.is_file():
+                    continue
+                st = entry.stat()
+                cached = old_files.get(entry.name)
+                if cached and cached["size"] == st.st_size and cached["mtime_ns"] == st.st_mtime_ns:
+                    files[entry.name] = cached
+                else:
+                    files[entry.name] = _index_patch_file(entry.path, st)
+        new_dirs[category] = {"mtime_ns": dir_mtime, "files": files}
+    
+    if set(new_dirs) != set(old_dirs):
+        changed = True
+    index["dirs"] = new_dirs
+    
+    if changed:
+        _save_json_atomic(PATCH_INDEX_FILE, index)
+    
+    # 构建内存查找表: (类别, 模式, 目标相对路径) -> 补丁信息
+    lookup = {}
+    for category, dir_info in new_dirs.items():
+        category_dir = os.path.join(PATCHES_DIR, category)
+        # 按文件名排序，保证同一键对应的补丁选择是确定的
+        for name in sorted(dir_info["files"]):
+            info = dir_info["files"][name]
+            entry = {
+                "path": os.path.join(category_dir, name),
+                "sha256": info["sha256"],
+                "size": info["size"],
+                "mtime_ns": info["mtime_ns"]
+            }
+            mode = _patch_mode(name)
+            if mode is None:
+                continue
+            for target in info["targets"]:
+                lookup.setdefault((category, mode, target), entry)
+    if warm is not None and warm.watching:
+        warm.patch_lookup = lookup
+    return lookup
+
+# 通过--bundle指定的补丁包（patch_bundle.PatchBundle），未指定时为None
+_BUNDLE = None
+
+def open_bundle(bundle_file):
+    """打开补丁包，之后的补丁查找和映射表都以补丁包为准"""
+    global _BUNDLE
+    close_bundle()
+    _BUNDLE = patch_bundle.PatchBundle(bundle_file)
+    print(f"使用补丁包: {bundle_file} (ID {_BUNDLE.bundle_id[:16]}，{len(_BUNDLE.entries)} 个补丁)")
+    return _BUNDLE
+
+def close_bundle():
+    global _BUNDLE
+    if _BUNDLE is not None:
+        _BUNDLE.close()
+        _BUNDLE = None
 
-def generate_patch(original_file, modified_file, patch_name, category):
-    """生成补丁文件"""
-    rel_path = os.path.relpath(original_file, SRC_DIR)
+def patch_file_mappings():
+    """当前生效的补丁映射表：使用补丁包时为包内的映射表"""
+    return _BUNDLE.mappings if _BUNDLE is not None else PATCH_FILE_MAPPINGS
+
+def bundle_patch_index(bundle):
+    """由补丁包清单构建查找表，补丁路径指向提取目录（在select_patches中按需提取）"""
+    extract_dir = os.path.join(BUNDLE_CACHE_DIR, bundle.bundle_id[:16])
+    lookup = {}
+    for rel_path in sorted(bundle.entries):
+        info = bundle.entries[rel_path]
+        category, name = rel_path.split("/", 1)
+        entry = {
+            "path": os.path.join(extract_dir, category, name),
+            "sha256": info["sha256"],
+            "size": info["size"],
+            "mtime_ns": None,
+            "bundle_path": rel_path
+        }
+        mode = _patch_mode(name)
+        if mode is None:
+            continue
+        for target in info["targets"]:
+            lookup.setdefault((category, mode, target), entry)
+    return lookup
+
+def current_patch_hashes(lookup):
+    """返回{补丁路径: 内容哈希}
+
+    索引按目录mtime失效，原地修改补丁文件不会触发重新扫描，因此这里逐个
+    比较补丁文件的stat信息，发生变化时重新计算哈希。
+    """
+    hashes = {}
+    for entry in lookup.values():
+        path = entry["path"]
+        if path in hashes:
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if st.st_size == entry["size"] and st.st_mtime_ns == entry["mtime_ns"]:
+            hashes[path] = entry["sha256"]
+        else:
+            hashes[path] = blob_store.file_sha256(path)
+    return hashes
+
+def find_patch(lookup, category, mode, rel_file):
+    """在补丁索引中精确查找补丁，未找到时返回None"""
+    return lookup.get((category, mode, rel_file.replace("\\", "/")))
+
+@trace_events.traced("load_file_state_index")
+def load_file_state_index():
+    """加载目标文件状态索引，格式不符或源码目录变化时返回空索引"""
+    index = None
+    if os.path.exists(FILE_STATE_INDEX_FILE):
+        try:
+            with open(FILE_STATE_INDEX_FILE, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = None
+    if not index or index.get("version") != FILE_STATE_INDEX_VERSION or index.get("src_dir") != SRC_DIR:
+        index = {"version": FILE_STATE_INDEX_VERSION, "src_dir": SRC_DIR, "files": {}}
+    return index
+
+@trace_events.traced("hash_files")
+def refresh_file_hashes(index, rel_paths, jobs=4):
+    """返回{相对路径: 内容哈希}，文件不存在时哈希为None
+
+    size、mtime_ns和inode均与索引一致的文件直接使用索引中的哈希，其余文件
+    并发重新计算并更新索引。返回值第二项表示索引是否发生变化。
+    """
+    files = index["files"]
+    hashes = {}
+    stale = []
+    changed = False
+    now_ns = time.time_ns()
+    for rel_path in rel_paths:
+        key = rel_path.replace(os.sep, "/")
+        try:
+            st = os.stat(os.path.join(SRC_DIR, rel_path))
+        except OSError:
+            hashes[rel_path] = None
+            if files.pop(key, None) is not None:
+                changed = True
+            continue
+        cached = files.get(key)
+        stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+        if cached and cached["stat"] == stamp:
+            hashes[rel_path] = cached["sha256"]
+        else:
+            stale.append((rel_path, key, stamp, now_ns - st.st_mtime_ns < FILE_STATE_RACY_NS))
+    
+    def hash_one(item):
+        return blob_store.file_sha256(os.path.join(SRC_DIR, item[0]))
+    
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for (rel_path, key, stamp, racy), digest in zip(stale, executor.map(hash_one, stale)):
+            hashes[rel_path] = digest
+            if racy:
+                # 刚修改过的文件，同一mtime内仍可能再次被修改，下次重新计算
+                if files.pop(key, None) is not None:
+                    changed = True
+            else:
+                files[key] = {"stat": stamp, "sha256": digest}
+                changed = True
+    return hashes, changed
+
+def file_hashes(rel_paths, jobs=4):
+    """通过状态索引获取文件哈希，索引有变化时写回磁盘
+
+    常驻进程中索引保存在内存里，不再每次读取索引文件。
+    """
+    warm = _WARM_CACHE
+    if warm is not None:
+        if warm.file_state_index is None or warm.file_state_index.get("src_dir") != SRC_DIR:
+            warm.file_state_index = load_file_state_index()
+        index = warm.file_state_index
+    else:
+        index = load_file_state_index()
+    hashes, changed = refresh_file_hashes(index, rel_paths, jobs)
+    if changed:
+        _save_json_atomic(FILE_STATE_INDEX_FILE, index)
+    return hashes
+
+def _patch_target(patch_files, target_file, base_content=None):
+    """以base_content（默认为当前文件内容）为基础依次应用补丁
+
+    返回(成功标志列表, 是否写入了文件)。结果与磁盘内容一致时不会写入文件，
+    从而保留其mtime。
+    """
+    rel_path = os.path.relpath(target_file, SRC_DIR)
+    if not os.path.exists(target_file):
+        print(f"应用补丁失败: 目标文件不存在: {rel_path}")
+        return [False] * len(patch_files), False
+    
+    # 备份原始文件
+    backup_original_file(target_file)
+    
+    on_disk = read_file_bytes(target_file)
+    content = on_disk if base_content is None else base_content
+    written = False
+    
+    # 多个补丁修改同一文件时，优先使用缓存的组合结果，一次写入
+    composed = load_composed(content, patch_files)
+    if composed is not None:
+        if composed != on_disk:
+            write_file_bytes(target_file, composed)
+            written = True
+        print(f"已应用 {len(patch_files)} 个补丁到 {rel_path}（组合结果来自缓存）")
+        return [True] * len(patch_files), written
+    
+    start_content = content
+    fell_back = False
+    results = []
+    for patch_file in patch_files:
+        try:
+            content = patch_content(content, patch_file, rel_path)
+            results.append(True)
+            print(f"已应用补丁: {os.path.basename(patch_file)} 到 {rel_path}")
+            continue
+        except (diff_engine.PatchError, OSError, UnicodeError) as e:
+            print(f"原生补丁引擎无法应用 {os.path.basename(patch_file)}: {e}，改用git apply")
+        
+        fell_back = True
+        if content != on_disk:
+            write_file_bytes(target_file, content)
+            written = True
+        ok = git_apply_patch(patch_file)
+        if ok:
+            print(f"已应用补丁: {os.path.basename(patch_file)} 到 {rel_path}")
+            written = True
+        results.append(ok)
+        content = on_disk = read_file_bytes(target_file)
+    
+    if content != on_disk:
+        write_file_bytes(target_file, content)
+        written = True
+        # 校验写回结果
+        if read_file_bytes(target_file) != content:
+            print(f"校验失败: {rel_path} 写入内容与预期不一致")
+            return [False] * len(patch_files), written
+    if not fell_back and all(results):
+        store_composed(start_content, patch_files, content)
+    return results, written
+
+def apply_patches_to_file(patch_files, target_file, base_content=None):
+    """将多个补丁依次应用到同一目标文件，只读取和写入一次
+
+    返回与patch_files一一对应的成功标志列表。原生引擎无法应用的补丁
+    会先写回已有结果，再退回到git apply。
+    """
+    return _patch_target(patch_files, target_file, base_content)[0]
+
+def apply_patch(patch_file, target_file):
+    """应用补丁到目标文件"""
+    return apply_patches_to_file([patch_file], target_file)[0]
+
+def _rewrite_diff_header(line, rel_path):
+    """将git diff文件头中的路径改写为相对于src目录的路径"""
+    if line.startswith(b"diff --git "):
+        return f"diff --git a/{rel_path} b/{rel_path}\n".encode("utf-8")
+    if line.startswith(b"--- "):
+        return f"--- a/{rel_path}\n".encode("utf-8")
+    if line.startswith(b"+++ "):
+        return f"+++ b/{rel_path}\n".encode("utf-8")
+    return line
+
+def generate_patch(original_file, modified_file, patch_name, category, file_tag=None):
+    """生成补丁文件
+
+    git diff的输出按行流式写入补丁文件，只改写文件头中的路径，补丁内容
+    本身不做任何替换。file_tag用于区分同一类别下同名的不同目标文件。
+    """
+    # 原始文件位于备份存储中，路径与文件名以修改后的文件为准
+    rel_path = os.path.relpath(modified_file, SRC_DIR).replace(os.sep, "/")
     patch_dir = os.path.join(PATCHES_DIR, category)
     os.makedirs(patch_dir, exist_ok=True)
     
-    patch_file = os.path.join(patch_dir, f"{patch_name}_{os.path.basename(original_file)}.patch")
+    file_name = os.path.basename(modified_file)
+    if file_tag:
+        file_name = f"{file_tag}_{file_name}"
+    patch_file = os.path.join(patch_dir, f"{patch_name}_{file_name}.patch")
+    tmp_path = f"{patch_file}.tmp"
     
     try:
         # 使用git diff生成补丁
         cmd = ["git", "diff", "--no-index", original_file, modified_file]
-        result = subprocess.run(cmd, check=False, capture_output=True, text=True)
+        size = 0
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as process, \
+                open(tmp_path, "wb") as f:
+            in_header = False
+            for line in process.stdout:
+                if line.startswith(b"diff --git "):
+                    in_header = True
+                elif line.startswith(b"@@"):
+                    in_header = False
+                if in_header:
+                    # 修改补丁文件中的路径，使其相对于src目录
+                    line = _rewrite_diff_header(line, rel_path)
+                f.write(line)
+                size += len(line)
         
-        # 保存补丁文件
-        with open(patch_file, "w", encoding="utf-8") as f:
-            # 修改补丁文件中的路径，使其相对于src目录
-            patch_content = result.stdout.replace(original_file, f"a/{rel_path}").replace(modified_file, f"b/{rel_path}")
-            f.write(patch_content)
+        if not size:
+            os.unlink(tmp_path)
+            print(f"文件未被修改，不生成补丁: {rel_path}")
+            return None
         
+        # 保存补丁文件
+        os.replace(tmp_path, patch_file)
         print(f"已生成补丁: {patch_file}")
         return patch_file
     except Exception as e:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
         print(f"生成补丁失败: {str(e)}")
         return None
 
-def apply_fingerprint_patches(config_file):
-    """根据配置文件应用指纹补丁"""
-    with open(config_file, "r", encoding="utf-8") as f:
-        config = json.load(f)
+def is_modified_from_backup(target_file, entry):
+    """判断文件是否与备份不同：先比较stat信息，必要时再计算哈希"""
+    try:
+        st = os.stat(target_file)
+    except OSError:
+        return False
+    if st.st_size != entry["size"]:
+        return True
+    if entry.get("mtime_ns") == st.st_mtime_ns:
+        # 大小与mtime均与备份时一致，视为未修改
+        return False
+    return blob_store.file_sha256(target_file) != entry["sha256"]
+
+def find_modified_targets(categories):
+    """查找映射表中与备份内容不同的文件，返回[(类别, 目标文件), ...]
+
+    同一文件被多个类别映射时，只归属于categories中的第一个类别。
+    """
+    owners = {}
+    for category in categories:
+        for rel_file in PATCH_FILE_MAPPINGS.get(category, []):
+            if rel_file in owners:
+                if owners[rel_file] != category:
+                    print(f"提示: {rel_file} 同时属于 {owners[rel_file]} 和 {category}，补丁将生成到 {owners[rel_file]}")
+                continue
+            owners[rel_file] = category
     
-    print(f"正在应用指纹配置: {config['fingerprint_id']}")
+    modified = []
+    for rel_file, category in owners.items():
+        target_file = os.path.join(SRC_DIR, rel_file)
+        entry = get_backup_entry(target_file)
+        if entry is None:
+            continue
+        if is_modified_from_backup(target_file, entry):
+            modified.append((category, target_file))
+    return modified
+
+def generate_all_patches(name, mode, categories=None, jobs=4):
+    """为所有相对备份有改动的映射文件批量并行生成补丁"""
+    categories = categories or FINGERPRINT_CATEGORIES
+    modified = find_modified_targets(categories)
+    if not modified:
+        print("未发现相对备份有改动的映射文件")
+        return []
     
-    # 记录已应用的补丁
-    applied_patches = []
+    print(f"发现 {len(modified)} 个有改动的文件，开始生成补丁")
+    patch_name = f"{mode}_{name}"
+    
+    # 同一类别下文件名相同的目标（例如两个screen.cc）以上级目录名区分
+    basenames = {}
+    for category, target_file in modified:
+        key = (category, os.path.basename(target_file))
+        basenames[key] = basenames.get(key, 0) + 1
     
-    # 遍历每个指纹类别
-    for category, settings in config["settings"].items():
+    def generate_one(item):
+        category, target_file = item
+        file_tag = None
+        if basenames[(category, os.path.basename(target_file))] > 1:
+            file_tag = os.path.basename(os.path.dirname(target_file))
+        return generate_patch(pristine_file_path(target_file), target_file, patch_name, category, file_tag)
+    
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        patch_files = [p for p in executor.map(generate_one, modified) if p]
+    
+    print(f"批量生成完成，共生成 {len(patch_files)} 个补丁")
+    return patch_files
+
+def rebase_all_patches(from_src, to_src, output_dir=None, jobs=4):
+    """将所有补丁从旧版源码变基到新版源码，存在冲突或需要人工确认的补丁时返回1
+
+    刷新后的补丁按类别目录结构写入output_dir（默认patches_rebased，指定为
+    patches目录时原地更新），冲突报告保存为output_dir/rebase_report.json。
+    """
+    output_dir = output_dir or REBASED_PATCHES_DIR
+    for src in (from_src, to_src):
+        if not os.path.isdir(src):
+            print(f"错误: 源码目录不存在: {src}")
+            return 1
+    
+    patch_files = sorted({entry["path"] for entry in build_patch_index().values()})
+    print(f"正在将 {len(patch_files)} 个补丁从 {from_src} 变基到 {to_src}")
+    
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(executor.map(lambda p: patch_rebase.rebase_patch(p, from_src, to_src), patch_files))
+    
+    counts = {}
+    report = []
+    for result in results:
+        patch_rebase.write_rebased(result, PATCHES_DIR, output_dir)
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+        report.append({
+            "patch_file": os.path.relpath(result["patch_file"], PATCHES_DIR),
+            "status": result["status"],
+            "targets": [
+                {k: v for k, v in target.items() if k != "conflict_content"}
+                for target in result["targets"]
+            ]
+        })
+    
+    os.makedirs(output_dir, exist_ok=True)
+    report_file = os.path.join(output_dir, "rebase_report.json")
+    _save_json_atomic(report_file, {
+        "from_src": os.path.abspath(from_src),
+        "to_src": os.path.abspath(to_src),
+        "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "counts": counts,
+        "patches": report
+    })
+    
+    labels = {
+        patch_rebase.STATUS_UNCHANGED: "上游未变化",
+        patch_rebase.STATUS_MERGED: "三方合并",
+        patch_rebase.STATUS_REAPPLIED: "直接应用",
+        patch_rebase.STATUS_REVIEW: "需确认",
+        patch_rebase.STATUS_CONFLICT: "冲突"
+    }
+    for entry in report:
+        if entry["status"] not in (patch_rebase.STATUS_CONFLICT, patch_rebase.STATUS_REVIEW):
+            continue
+        for target in entry["targets"]:
+            if target["status"] == patch_rebase.STATUS_CONFLICT:
+                print(f"冲突: {entry['patch_file']} -> {target['target']}: {target['detail']}")
+                if target.get("conflict_file"):
+                    print(f"      合并结果: {target['conflict_file']}")
+            elif target["status"] == patch_rebase.STATUS_REVIEW:
+                print(f"需确认: {entry['patch_file']} -> {target['target']}: {target['detail']}")
+    print("变基完成: " + "，".join(f"{labels[k]} {counts.get(k, 0)} 个" for k in labels))
+    print(f"补丁已写入: {output_dir}，报告: {report_file}")
+    return 1 if counts.get(patch_rebase.STATUS_CONFLICT) or counts.get(patch_rebase.STATUS_REVIEW) else 0
+
+def load_config(config_file):
+    """读取指纹配置文件"""
+    warm = _WARM_CACHE
+    key = os.path.abspath(config_file)
+    if warm is not None and warm.watching and os.path.dirname(key) == CONFIG_DIR:
+        # 常驻进程只缓存configs目录中的配置，该目录受inotify监视
+        if key not in warm.configs:
+            with open(config_file, "r", encoding="utf-8") as f:
+                warm.configs[key] = json.load(f)
+        return copy.deepcopy(warm.configs[key])
+    with open(config_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def select_patches(config, patch_index=None, verbose=True):
+    """根据配置解析需要应用的补丁，返回[(类别, 目标文件, 补丁文件), ...]"""
+    if patch_index is None:
+        patch_index = build_patch_index()
+    selected = []
+    
+    # 按FINGERPRINT_CATEGORIES的固定顺序遍历指纹类别，与配置文件中的键顺序无关，
+    # 同一文件上的多个补丁总是以相同顺序应用
+    for category, settings in sorted(config["settings"].items(), key=lambda item: _category_rank(item[0])):
         if not settings.get("enabled", True):
-            print(f"跳过禁用的指纹类别: {category}")
+            if verbose:
+                print(f"跳过禁用的指纹类别: {category}")
             continue
         
         mode = settings.get("mode", "default")
         if mode == "default":
-            print(f"跳过使用默认设置的指纹类别: {category}")
+            if verbose:
+                print(f"跳过使用默认设置的指纹类别: {category}")
             continue
         
-        print(f"应用 {category} 指纹补丁 (模式: {mode})")
+        if verbose:
+            print(f"应用 {category} 指纹补丁 (模式: {mode})")
         
-        # 获取该类别需要修改的文件列表
-        target_files = PATCH_FILE_MAPPINGS.get(category, [])
+        # 获取该类别需要修改的文件列表（使用补丁包时以包内的映射表为准）
+        target_files = patch_file_mappings().get(category, [])
         
         for rel_file in target_files:
             # 构建完整的文件路径
             target_file = os.path.join(SRC_DIR, rel_file)
             
-            # 查找对应的补丁文件
-            patch_dir = os.path.join(PATCHES_DIR, category)
-            patch_files = [f for f in os.listdir(patch_dir) if f.endswith(".patch") and f.startswith(mode)]
-            
-            # 筛选出针对当前文件的补丁
-            file_patches = [f for f in patch_files if os.path.basename(rel_file) in f]
+            # 通过补丁索引精确查找对应的补丁文件
+            patch = find_patch(patch_index, category, mode, rel_file)
             
-            if file_patches:
-                patch_file = os.path.join(patch_dir, file_patches[0])
-                if apply_patch(patch_file, target_file):
-                    applied_patches.append({
-                        "category": category,
-                        "target_file": target_file,
-                        "patch_file": patch_file
-                    })
-            else:
+            if patch:
+                if "bundle_path" in patch:
+                    # 只提取本次需要的补丁
+                    _BUNDLE.extract(patch["bundle_path"], patch["path"])
+                selected.append((category, target_file, patch["path"]))
+            elif verbose:
                 print(f"警告: 未找到 {category} 类别下针对 {rel_file} 的 {mode} 模式补丁")
     
-    # 保存应用记录
-    record_file = os.path.join(CONFIG_DIR, f"applied_{config['fingerprint_id']}.json")
-    with open(record_file, "w", encoding="utf-8") as f:
-        json.dump({
-            "fingerprint_id": config['fingerprint_id'],
-            "applied_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "patches": applied_patches
-        }, f, indent=2, ensure_ascii=False)
+    return selected
+
+def group_patches_by_target(selected):
+    """按目标文件分组，组内保持类别顺序，返回{目标文件: [补丁文件, ...]}"""
+    groups = {}
+    for category, target_file, patch_file in selected:
+        groups.setdefault(target_file, []).append(patch_file)
+    return groups
+
+def available_modes(patch_index):
+    """返回{类别: 补丁索引中存在的模式集合}"""
+    modes = {}
+    for category, mode, _ in patch_index:
+        modes.setdefault(category, set()).add(mode)
+    return modes
+
+def validate_config(config, patch_index):
+    """检查配置的结构、类别和模式，返回(错误列表, 警告列表)"""
+    errors = []
+    warnings = []
+    if not config.get("fingerprint_id"):
+        errors.append("配置缺少fingerprint_id")
+    settings = config.get("settings")
+    if not isinstance(settings, dict):
+        errors.append("配置缺少settings")
+        return errors, warnings
     
-    print(f"指纹补丁应用完成，共应用 {len(applied_patches)} 个补丁")
-    return record_file
+    modes = available_modes(patch_index)
+    for category, category_settings in settings.items():
+        if category not in FINGERPRINT_CATEGORIES:
+            errors.append(f"未知的指纹类别: {category}")
+            continue
+        if not isinstance(category_settings, dict):
+            errors.append(f"{category} 的设置必须是对象")
+            continue
+        mode = category_settings.get("mode", "default")
+        if not category_settings.get("enabled", True) or mode == "default":
+            continue
+        if mode not in PATCH_MODES:
+            errors.append(f"{category} 的模式 {mode} 无效，可选: default, {', '.join(PATCH_MODES)}")
+            continue
+        if mode not in modes.get(category, ()):
+            candidates = sorted(modes.get(category, ()))
+            errors.append(f"{category} 类别下没有 {mode} 模式的补丁"
+                          + (f"，可用模式: {', '.join(candidates)}" if candidates else ""))
+            continue
+        missing = [
+            rel_file for rel_file in PATCH_FILE_MAPPINGS.get(category, [])
+            if find_patch(patch_index, category, mode, rel_file) is None
+        ]
+        if missing:
+            warnings.append(f"{category} ({mode}) 缺少针对以下文件的补丁: {', '.join(missing)}")
+    return errors, warnings
 
-def restore_all_patches():
-    """还原所有已应用的补丁"""
-    # 查找最新的应用记录
-    record_files = [f for f in os.listdir(CONFIG_DIR) if f.startswith("applied_") and f.endswith(".json")]
-    if not record_files:
-        print("未找到补丁应用记录，无需还原")
-        return
+def load_plan_cache():
+    cache = None
+    if os.path.exists(PLAN_CACHE_FILE):
+        try:
+            with open(PLAN_CACHE_FILE, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = None
+    if not cache or cache.get("version") != PLAN_CACHE_VERSION:
+        cache = {"version": PLAN_CACHE_VERSION, "steps": {}}
+    return cache
+
+def check_target_plan(target_file, patches, base_sha256, cache_steps):
+    """检查一组补丁能否依次应用到目标文件的原始内容上
+
+    patches为[(补丁文件, 补丁哈希), ...]。每一步的结果按(补丁哈希, 输入内容哈希)
+    缓存，全部命中时无需读取任何文件。无法应用的补丁被跳过，后续补丁基于
+    跳过后的内容继续检查。返回(每一步的结果列表, 最终内容哈希, 是否有新的缓存项)。
+    """
+    rel_path = os.path.relpath(target_file, SRC_DIR)
     
-    # 按修改时间排序，获取最新的记录
-    record_files.sort(key=lambda f: os.path.getmtime(os.path.join(CONFIG_DIR, f)), reverse=True)
-    record_file = os.path.join(CONFIG_DIR, record_files[0])
+    # 先尝试完全从缓存得到结果
+    steps = []
+    digest = base_sha256
+    for patch_file, patch_sha in patches:
+        cached = cache_steps.get(f"{patch_sha}:{digest}")
+        if cached is None:
+            break
+        steps.append({"ok": cached["ok"], "error": cached.get("error"), "cached": True})
+        digest = cached["output"]
+    else:
+        return steps, digest, False
     
-    with open(record_file, "r", encoding="utf-8") as f:
-        record = json.load(f)
+    # 有未命中的步骤，从原始内容重新计算整条链
+    steps = []
+    content = read_pristine(target_file)
+    digest = hashlib.sha256(content).hexdigest()
+    for patch_file, patch_sha in patches:
+        key = f"{patch_sha}:{digest}"
+        try:
+            content = patch_content(content, patch_file, rel_path)
+            result = {"ok": True, "output": hashlib.sha256(content).hexdigest()}
+        except (diff_engine.PatchError, OSError, UnicodeError) as e:
+            result = {"ok": False, "output": digest, "error": str(e)}
+        cache_steps[key] = result
+        steps.append({"ok": result["ok"], "error": result.get("error"), "cached": False})
+        digest = result["output"]
+    return steps, digest, True
+
+def pristine_sha256(rel_paths, jobs=4):
+    """返回{相对路径: 原始内容哈希}：有备份时取备份记录，否则当前文件即原始内容"""
+    hashes = {}
+    unbacked = []
+    for rel_path in rel_paths:
+        entry = get_backup_entry(os.path.join(SRC_DIR, rel_path))
+        if entry:
+            hashes[rel_path] = entry["sha256"]
+        else:
+            unbacked.append(rel_path)
+    hashes.update(file_hashes(unbacked, jobs))
+    return hashes
+
+def build_plan(config, jobs=4):
+    """生成预检计划：校验配置、解析补丁并并发检查可应用性，不修改源码树"""
+    patch_index = build_patch_index()
+    errors, warnings = validate_config(config, patch_index)
+    plan = {
+        "version": PLAN_VERSION,
+        "fingerprint_id": config.get("fingerprint_id"),
+        "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "src_dir": SRC_DIR,
+        "config": config,
+        "ok": False,
+        "errors": errors,
+        "warnings": warnings,
+        "targets": []
+    }
+    if errors:
+        return plan
     
-    print(f"正在还原指纹 {record['fingerprint_id']} 的补丁")
+    patch_hashes = current_patch_hashes(patch_index)
+    categories = {}
+    selected = select_patches(config, patch_index, verbose=False)
+    for category, target_file, patch_file in selected:
+        categories[(target_file, patch_file)] = category
+    groups = group_patches_by_target(selected)
     
-    restored_count = 0
+    base_hashes = {
+        os.path.join(SRC_DIR, rel_path): digest
+        for rel_path, digest in pristine_sha256(
+            [os.path.relpath(t, SRC_DIR) for t in groups], jobs).items()
+    }
+    
+    cache = load_plan_cache()
+    
+    def check(item):
+        target_file, patch_files = item
+        if base_hashes[target_file] is None:
+            return None, None, False
+        return check_target_plan(target_file, [(p, patch_hashes[p]) for p in patch_files],
+                                 base_hashes[target_file], cache["steps"])
+    
+    items = list(groups.items())
+    cache_changed = False
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for (target_file, patch_files), (steps, result_sha256, changed) in zip(items, executor.map(check, items)):
+            cache_changed = cache_changed or changed
+            rel_path = _rel_target(target_file)
+            if steps is None:
+                errors.append(f"目标文件不存在: {rel_path}")
+                steps = [{"ok": False, "error": "目标文件不存在", "cached": False}] * len(patch_files)
+            for patch_file, step in zip(patch_files, steps):
+                if not step["ok"] and step["error"] != "目标文件不存在":
+                    errors.append(f"{os.path.basename(patch_file)} 无法应用到 {rel_path}: {step['error']}")
+            plan["targets"].append({
+                "target": rel_path,
+                "base_sha256": base_hashes[target_file],
+                "result_sha256": result_sha256,
+                "patches": [
+                    {
+                        "category": categories[(target_file, patch_file)],
+                        "patch_file": patch_file,
+                        "sha256": patch_hashes[patch_file],
+                        "ok": step["ok"],
+                        "cached": step["cached"],
+                        "error": step["error"]
+                    }
+                    for patch_file, step in zip(patch_files, steps)
+                ]
+            })
+    if cache_changed:
+        _save_json_atomic(PLAN_CACHE_FILE, cache)
+    
+    plan["ok"] = not errors
+    return plan
+
+def show_plan(config_file, output=None, as_json=False, jobs=4):
+    """输出预检计划（可保存为文件供apply --plan使用），计划有错误时返回1"""
+    plan = build_plan(load_config(config_file), jobs)
+    if output:
+        _save_json_atomic(output, plan)
+    
+    if as_json:
+        print(json.dumps(plan, indent=2, ensure_ascii=False))
+    else:
+        patch_count = sum(len(t["patches"]) for t in plan["targets"])
+        cached_count = sum(1 for t in plan["targets"] for p in t["patches"] if p["cached"])
+        print(f"指纹配置: {plan['fingerprint_id']}")
+        print(f"共 {len(plan['targets'])} 个目标文件，{patch_count} 个补丁（{cached_count} 个检查结果来自缓存）")
+        for warning in plan["warnings"]:
+            print(f"警告: {warning}")
+        for error in plan["errors"]:
+            print(f"错误: {error}")
+        print("预检通过，可以应用" if plan["ok"] else "预检未通过")
+        if output:
+            print(f"计划已保存: {output}，可运行: python {sys.argv[0]} apply --plan={output}")
+    return 0 if plan["ok"] else 1
+
+def load_plan(plan_file):
+    """读取预检计划并确认补丁和原始文件自生成计划后未发生变化
+
+    返回(配置, [(类别, 目标文件, 补丁文件), ...])，计划无效或已过期时返回(None, None)。
+    """
+    with open(plan_file, "r", encoding="utf-8") as f:
+        plan = json.load(f)
+    if plan.get("version") != PLAN_VERSION or plan.get("src_dir") != SRC_DIR:
+        print("错误: 计划文件版本或源码目录不匹配，请重新运行plan")
+        return None, None
+    if not plan["ok"]:
+        print("错误: 计划未通过预检，拒绝应用")
+        return None, None
+    
+    patch_hashes = current_patch_hashes(build_patch_index())
+    selected = []
+    for target in plan["targets"]:
+        target_file = os.path.join(SRC_DIR, target["target"])
+        if pristine_sha256([target["target"]])[target["target"]] != target["base_sha256"]:
+            print(f"错误: {target['target']} 的原始内容已变化，请重新运行plan")
+            return None, None
+        for patch in target["patches"]:
+            if patch_hashes.get(patch["patch_file"]) != patch["sha256"]:
+                print(f"错误: 补丁 {patch['patch_file']} 已变化，请重新运行plan")
+                return None, None
+            selected.append((patch["category"], target_file, patch["patch_file"]))
+    return plan["config"], selected
+
+def _category_rank(category):
+    if category in FINGERPRINT_CATEGORIES:
+        return FINGERPRINT_CATEGORIES.index(category)
+    return len(FINGERPRINT_CATEGORIES)
+
+def shared_target_patches(lookup):
+    """返回{目标相对路径: [(类别, 补丁文件), ...]}，只包含被多个类别的补丁修改的文件"""
+    by_target = {}
+    for (category, _, target), entry in lookup.items():
+        patches = by_target.setdefault(target, {})
+        patches.setdefault(entry["path"], category)
+    shared = {}
+    for target, patches in by_target.items():
+        if len(set(patches.values())) < 2:
+            continue
+        shared[target] = sorted(((c, p) for p, c in patches.items()),
+                                key=lambda item: (_category_rank(item[0]), item[1]))
+    return shared
+
+def _pair_key(sha_a, sha_b):
+    return f"{sha_a}:{sha_b}"
+
+def load_conflict_matrix():
+    matrix = None
+    if os.path.exists(CONFLICT_MATRIX_FILE):
+        try:
+            with open(CONFLICT_MATRIX_FILE, "r", encoding="utf-8") as f:
+                matrix = json.load(f)
+        except (OSError, ValueError):
+            matrix = None
+    if not matrix or matrix.get("version") != CONFLICT_MATRIX_VERSION or matrix.get("src_dir") != SRC_DIR:
+        matrix = {"version": CONFLICT_MATRIX_VERSION, "src_dir": SRC_DIR, "targets": {}}
+    return matrix
+
+def build_conflict_matrix(jobs=4):
+    """为修改同一文件的不同类别补丁两两计算兼容性矩阵
+
+    对每一对补丁(a, b)（按类别顺序，a先应用），分别检查a、b单独以及a之后
+    再应用b能否成功。a、b单独都能应用而组合失败时记为冲突。检查结果复用
+    plan的步骤缓存，矩阵按(补丁哈希, 补丁哈希)保存在patch_conflicts.json中，
+    补丁和原始文件未变化的组合不会重新计算。
+    """
+    lookup = build_patch_index()
+    patch_hashes = current_patch_hashes(lookup)
+    shared = shared_target_patches(lookup)
+    base_hashes = pristine_sha256(list(shared), jobs)
+    
+    old_targets = load_conflict_matrix()["targets"]
+    matrix = {"version": CONFLICT_MATRIX_VERSION, "src_dir": SRC_DIR, "targets": {}}
+    todo = []
+    for rel_path, patches in shared.items():
+        base = base_hashes[rel_path]
+        if base is None:
+            continue
+        old = old_targets.get(rel_path, {})
+        old_pairs = old.get("pairs", {}) if old.get("base_sha256") == base else {}
+        pairs = {}
+        for i, (category_a, patch_a) in enumerate(patches):
+            for category_b, patch_b in patches[i + 1:]:
+                if category_a == category_b:
+                    continue
+                key = _pair_key(patch_hashes[patch_a], patch_hashes[patch_b])
+                if key in old_pairs:
+                    pairs[key] = old_pairs[key]
+                else:
+                    pairs[key] = None
+                    todo.append((rel_path, key, category_a, patch_a, category_b, patch_b))
+        matrix["targets"][rel_path] = {"base_sha256": base, "pairs": pairs}
+    
+    cache = load_plan_cache()
+    
+    def check(item):
+        rel_path, _, category_a, patch_a, category_b, patch_b = item
+        target_file = os.path.join(SRC_DIR, rel_path)
+        base = base_hashes[rel_path]
+        sha_a, sha_b = patch_hashes[patch_a], patch_hashes[patch_b]
+        pair_steps, _, changed_pair = check_target_plan(
+            target_file, [(patch_a, sha_a), (patch_b, sha_b)], base, cache["steps"])
+        alone_steps, _, changed_alone = check_target_plan(
+            target_file, [(patch_b, sha_b)], base, cache["steps"])
+        conflict = pair_steps[0]["ok"] and alone_steps[0]["ok"] and not pair_steps[1]["ok"]
+        entry = {
+            "patches": [patch_a, patch_b],
+            "categories": [category_a, category_b],
+            "ok": pair_steps[0]["ok"] and pair_steps[1]["ok"],
+            "conflict": conflict,
+            "error": pair_steps[1]["error"] if conflict else None
+        }
+        return entry, changed_pair or changed_alone
+    
+    cache_changed = False
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for item, (entry, changed) in zip(todo, executor.map(check, todo)):
+            matrix["targets"][item[0]]["pairs"][item[1]] = entry
+            cache_changed = cache_changed or changed
+    if cache_changed:
+        _save_json_atomic(PLAN_CACHE_FILE, cache)
+    if matrix["targets"] != old_targets:
+        _save_json_atomic(CONFLICT_MATRIX_FILE, matrix)
+    return matrix, len(todo)
+
+def show_conflicts(as_json=False, jobs=4):
+    """计算并输出兼容性矩阵中的冲突，存在冲突时返回1"""
+    matrix, computed = build_conflict_matrix(jobs)
+    conflicts = [
+        (rel_path, entry)
+        for rel_path, info in sorted(matrix["targets"].items())
+        for entry in info["pairs"].values()
+        if entry["conflict"]
+    ]
+    if as_json:
+        print(json.dumps(matrix, indent=2, ensure_ascii=False))
+    else:
+        pair_count = sum(len(info["pairs"]) for info in matrix["targets"].values())
+        print(f"共 {len(matrix['targets'])} 个被多个类别修改的文件，{pair_count} 对补丁组合"
+              f"（本次计算 {computed} 对）")
+        for rel_path, entry in conflicts:
+            print(f"冲突: {rel_path}: {os.path.basename(entry['patches'][0])} ({entry['categories'][0]}) + "
+                  f"{os.path.basename(entry['patches'][1])} ({entry['categories'][1]}): {entry['error']}")
+        if not conflicts:
+            print("未发现冲突")
+    return 1 if conflicts else 0
+
+def find_known_conflicts(groups):
+    """按已保存的兼容性矩阵检查本次要应用的补丁组合，返回冲突描述列表
+
+    只读取矩阵，不做新的计算；矩阵中没有的组合（例如补丁已修改）视为无冲突。
+    """
+    if not os.path.exists(CONFLICT_MATRIX_FILE):
+        return []
+    targets = load_conflict_matrix()["targets"]
+    conflicts = []
+    for target_file, patch_files in groups.items():
+        if len(patch_files) < 2:
+            continue
+        info = targets.get(_rel_target(target_file))
+        if not info:
+            continue
+        hashes = [patch_sha256(p) for p in patch_files]
+        for i in range(len(patch_files)):
+            for j in range(i + 1, len(patch_files)):
+                entry = info["pairs"].get(_pair_key(hashes[i], hashes[j]))
+                if entry and entry["conflict"]:
+                    conflicts.append(f"{_rel_target(target_file)}: {os.path.basename(patch_files[i])} 与 "
+                                     f"{os.path.basename(patch_files[j])} 无法组合 ({entry['error']})")
+    return conflicts
+
+def reject_conflicts(groups):
+    """存在已知冲突时输出并返回True"""
+    conflicts = find_known_conflicts(groups)
+    for conflict in conflicts:
+        print(f"错误: {conflict}")
+    if conflicts:
+        print("补丁组合存在冲突，未修改任何文件（可使用--ignore-conflicts跳过该检查）")
+    return bool(conflicts)
+
+def _apply_target_group(target_file, patch_files, recorded=None, refresh_backup=False, drifted=None):
+    """处理单个目标文件的备份、应用与校验，出错时不影响其他文件
+
+    总是从原始内容开始按顺序应用补丁，结果只取决于(原始内容, 有序补丁列表)，
+    与之前的应用历史无关，相同配置总是得到逐字节相同的文件，编译器缓存
+    （ccache/sccache）可以命中。recorded不为None时先按checked_pristine检查文件
+    是否偏离，偏离的文件不做处理并加入drifted。返回(成功标志列表, 是否写入)。
+    """
+    rel_path = os.path.relpath(target_file, SRC_DIR)
+    try:
+        with trace_events.span("apply_target", file=rel_path, patches=len(patch_files)):
+            if recorded is None:
+                base_content = read_pristine(target_file)
+            else:
+                base_content = checked_pristine(target_file, recorded, refresh_backup)
+            return _patch_target(patch_files, target_file, base_content)
+    except TargetDriftError as e:
+        print(f"错误: {e}")
+        if drifted is not None:
+            drifted.append(rel_path)
+        return [False] * len(patch_files), False
+    except Exception as e:
+        print(f"处理 {rel_path} 时出错: {e}")
+        return [False] * len(patch_files), False
+
+def _journal_key(target_file):
+    return os.path.relpath(target_file, SRC_DIR).replace(os.sep, "/")
+
+def begin_transaction(command, config):
+    """开始新事务或继续同一配置未完成的事务
+
+    config为None时继续日志中记录的事务。返回(配置, 已完成条目, 是否为继续)，
+    存在其他未完成事务时返回(None, None, False)。
+    """
+    state = apply_journal.load(APPLY_JOURNAL_FILE)
+    if state is None:
+        if config is None:
+            print("没有未完成的事务可以继续")
+            return None, None, False
+        return config, {}, False
+    if config is not None and (state.command != command or state.fingerprint_id != config["fingerprint_id"]):
+        print(f"错误: 存在未完成的{state.command}事务 ({state.fingerprint_id})，"
+              f"请先运行 `{state.command} --resume` 继续，或运行 restore 回滚")
+        return None, None, False
+    print(f"继续未完成的{command}事务: {state.fingerprint_id}，"
+          f"已完成 {len(state.done)}/{len(state.targets)} 个文件")
+    return state.config, state.done, True
+
+def run_journaled(command, config, groups, worker, jobs=1, done=None, resumed=False):
+    """逐个目标文件执行worker，并将每一步写入预写日志
+
+    worker(目标文件, 补丁列表, resumed)返回(成功标志列表, 是否写入)。日志中已
+    完成且内容哈希与磁盘一致的文件直接沿用记录的结果。返回(成功集合, 写入文件数,
+    日志)，调用方写入应用记录后提交日志。
+    被中断时已完成的步骤保留在日志中，日志文件不会被删除。
+    """
+    done = done or {}
+    journal = apply_journal.ApplyJournal(APPLY_JOURNAL_FILE)
+    journal.begin(command, config, sorted(_journal_key(t) for t in groups), resume=resumed)
+    
+    succeeded = set()
+    written_count = 0
+    pending = []
+    for target_file, patch_files in groups.items():
+        previous = done.get(_journal_key(target_file))
+        if previous:
+            results, digest = previous
+            current = blob_store.file_sha256(target_file) if os.path.exists(target_file) else None
+            if current == digest:
+                for patch_file, ok in zip(patch_files, results):
+                    if ok:
+                        succeeded.add((target_file, patch_file))
+                continue
+        pending.append((target_file, patch_files))
+    if resumed:
+        print(f"跳过 {len(groups) - len(pending)} 个已完成的文件")
+    
+    def finish(target_file, patch_files, outcome):
+        nonlocal written_count
+        results, written = outcome
+        if written:
+            written_count += 1
+        digest = blob_store.file_sha256(target_file) if os.path.exists(target_file) else None
+        journal.record_done(_journal_key(target_file), list(results), digest)
+        for patch_file, ok in zip(patch_files, results):
+            if ok:
+                succeeded.add((target_file, patch_file))
+    
+    try:
+        if jobs > 1 and len(pending) > 1:
+            executor = ThreadPoolExecutor(max_workers=jobs)
+            try:
+                futures = {
+                    executor.submit(worker, target_file, patch_files, resumed): (target_file, patch_files)
+                    for target_file, patch_files in pending
+                }
+                for future in as_completed(futures):
+                    target_file, patch_files = futures[future]
+                    finish(target_file, patch_files, future.result())
+            finally:
+                # 中断时取消尚未开始的文件，等待正在写入的文件完成
+                executor.shutdown(wait=True, cancel_futures=True)
+        else:
+            for target_file, patch_files in pending:
+                finish(target_file, patch_files, worker(target_file, patch_files, resumed))
+    except BaseException:
+        journal.close()
+        print(f"{command}被中断，已完成的步骤已记录到 {APPLY_JOURNAL_FILE}；"
+              f"可运行 `{command} --resume` 继续，或运行 restore 回滚")
+        raise
+    return succeeded, written_count, journal
+
+def apply_fingerprint_patches(config_file, jobs=1, resume=False, plan_file=None, ignore_conflicts=False,
+                              refresh_backup=False):
+    """根据配置文件应用指纹补丁
+
+    jobs大于1时，按目标文件分组后在线程池中并发处理，共享同一文件的
+    多个补丁始终在同一组内按顺序应用。每处理完一个文件都会写入预写日志，
+    中断后可以继续（resume为True时使用日志中的配置）或通过restore回滚。
+    指定plan_file时直接使用预检计划中解析好的补丁。每个文件都从原始内容应用。
+    兼容性矩阵中记录为冲突的补丁组合会在修改任何文件之前被拒绝。
+    被手工修改的目标文件不会被覆盖（见checked_pristine），此时其余文件照常
+    应用并写入记录，但返回None。
+    """
+    planned = None
+    if plan_file:
+        config, planned = load_plan(plan_file)
+        if config is None:
+            return None
+    else:
+        config = None if resume and not config_file else load_config(config_file)
+    config, done, resumed = begin_transaction("apply", config)
+    if config is None:
+        return None
+    
+    print(f"正在应用指纹配置: {config['fingerprint_id']}")
+    
+    # 待应用的补丁列表: (类别, 目标文件, 补丁文件)
+    if planned is not None and not resumed:
+        selected = planned
+    else:
+        selected = select_patches(config, verbose=not resumed)
+    groups = group_patches_by_target(selected)
+    if not resumed and not ignore_conflicts and reject_conflicts(groups):
+        return None
+    
+    # 继续被中断的事务时，未完成的文件可能已写入一半的结果，不做偏离检查
+    recorded = None if resumed else recorded_target_hashes()
+    drifted = []
+    succeeded, _, journal = run_journaled(
+        "apply", config, groups,
+        lambda target_file, patch_files, _: _apply_target_group(target_file, patch_files, recorded,
+                                                                refresh_backup, drifted),
+        jobs=jobs, done=done, resumed=resumed)
+    
+    # 记录已应用的补丁
+    applied_patches = _build_applied_list(selected, succeeded)
+    
+    record_id = write_applied_record(config, applied_patches)
+    journal.commit()
+    
+    print(f"指纹补丁应用完成，共应用 {len(applied_patches)} 个补丁")
+    if drifted:
+        print(f"错误: {len(drifted)} 个文件已偏离，未应用补丁: {', '.join(sorted(drifted))}")
+        return None
+    return record_id
+
+def _build_applied_list(selected, succeeded):
+    """按选择顺序生成应用记录中的补丁列表"""
+    return [
+        {
+            "category": category,
+            "target_file": target_file,
+            "patch_file": patch_file
+        }
+        for category, target_file, patch_file in selected
+        if (target_file, patch_file) in succeeded
+    ]
+
+_STATE_DB = None
+_STATE_DB_LOCK = threading.Lock()
+
+def get_state_db():
+    """获取应用记录数据库，首次打开时导入旧版JSON记录"""
+    global _STATE_DB
+    with _STATE_DB_LOCK:
+        if _STATE_DB is None or _STATE_DB.path != STATE_DB_FILE:
+            _STATE_DB = state_db.StateDB(STATE_DB_FILE)
+            migrated = _STATE_DB.migrate_json_records(CONFIG_DIR, SRC_DIR)
+            if migrated:
+                print(f"已将 {migrated} 条旧版应用记录导入 {STATE_DB_FILE}")
+    return _STATE_DB
+
+def _rel_target(target_file):
+    return os.path.relpath(target_file, SRC_DIR).replace(os.sep, "/")
+
+@trace_events.traced("write_record")
+def write_applied_record(config, applied_patches, command="apply"):
+    """保存应用记录，同时记录每个目标文件应用后的内容哈希，供status校验，返回记录ID"""
+    rel_targets = list(dict.fromkeys(_rel_target(p["target_file"]) for p in applied_patches))
+    target_hashes = file_hashes(rel_targets)
+    return get_state_db().add_apply(
+        config['fingerprint_id'],
+        command,
+        [(p["category"], _rel_target(p["target_file"]), p["patch_file"]) for p in applied_patches],
+        target_hashes
+    )
+
+def find_latest_record():
+    """查找最新的未还原应用记录，返回(记录ID, 记录内容)，不存在时返回(None, None)"""
+    db = get_state_db()
+    latest = db.latest_active()
+    if latest is None:
+        return None, None
+    record = db.get_apply(latest["id"])
     for patch_info in record["patches"]:
-        target_file = patch_info["target_file"]
+        patch_info["target_file"] = os.path.join(SRC_DIR, patch_info["target"])
+    return record["id"], record
+
+def active_target_files():
+    """所有未还原记录涉及的目标文件（绝对路径）"""
+    return [os.path.join(SRC_DIR, rel_path) for rel_path in get_state_db().active_targets()]
+
+def mark_record_restored(record_id):
+    """记录中的所有目标文件都已是原始内容时将记录标记为已还原，返回是否标记"""
+    record = get_state_db().get_apply(record_id)
+    for rel_path in dict.fromkeys(p["target"] for p in record["patches"]):
+        target_file = os.path.join(SRC_DIR, rel_path)
+        entry = get_backup_entry(target_file)
+        if entry is None or not os.path.exists(target_file) or blob_store.file_sha256(target_file) != entry["sha256"]:
+            print(f"错误: {rel_path} 尚未还原，应用记录 {record_id} 保持有效")
+            return False
+    get_state_db().mark_restored([record_id])
+    return True
+
+def _restore_targets(target_files):
+    """逐个还原目标文件，返回(还原的文件数, 无法还原的文件列表)"""
+    restored_count = 0
+    failed = []
+    for target_file in target_files:
         if restore_file(target_file):
             restored_count += 1
+        else:
+            failed.append(os.path.relpath(target_file, SRC_DIR))
+    return restored_count, failed
+
+def rollback_journal():
+    """按预写日志回滚未完成的事务
+
+    返回(还原的文件数, 无法还原的文件列表)，没有未完成事务时返回(None, [])。
+    有文件无法还原时保留日志，以便修复后再次回滚。
+    """
+    state = apply_journal.load(APPLY_JOURNAL_FILE)
+    if state is None:
+        return None, []
+    print(f"正在回滚未完成的{state.command}事务: {state.fingerprint_id}")
+    restored_count, failed = _restore_targets(os.path.join(SRC_DIR, rel_path) for rel_path in state.targets)
+    if failed:
+        print(f"错误: {len(failed)} 个文件无法还原，保留预写日志 {APPLY_JOURNAL_FILE}")
+        return restored_count, failed
+    apply_journal.remove(APPLY_JOURNAL_FILE)
+    print(f"事务回滚完成，共还原 {restored_count} 个文件")
+    return restored_count, failed
+
+@trace_events.traced("restore")
+def restore_all_patches():
+    """还原所有已应用的补丁（先回滚未完成的事务）
+
+    返回还原的文件数；有文件无法还原时返回None，此时应用记录保持有效，
+    修复问题后可以再次执行restore。
+    """
+    rolled_back, failed = rollback_journal()
+    
+    # 所有未还原的应用记录（可能有多条先后应用、互相重叠的记录）
+    db = get_state_db()
+    record_ids = db.active_ids()
+    if not record_ids:
+        if rolled_back is None:
+            print("未找到补丁应用记录，无需还原")
+        return None if failed else (rolled_back or 0)
+    
+    fingerprints = list(dict.fromkeys(db.get_apply(i)["fingerprint_id"] for i in record_ids))
+    print(f"正在还原指纹 {', '.join(fingerprints)} 的补丁")
+    
+    # 同一文件可能被多个类别或多条记录的补丁修改，只需还原一次
+    restored_count, target_failed = _restore_targets(active_target_files())
+    failed.extend(target_failed)
+    if failed:
+        # 只要有文件未还原，应用记录就保持有效，避免之后再也无法还原这些文件
+        print(f"错误: {len(failed)} 个文件无法还原，应用记录保持有效: {', '.join(failed[:10])}"
+              + (" ..." if len(failed) > 10 else ""))
+        print(f"已还原 {restored_count} 个文件，修复问题后请重新运行 restore")
+        return None
     
     print(f"补丁还原完成，共还原 {restored_count} 个文件")
     
-    # 重命名记录文件，标记为已还原
-    restored_record = record_file.replace("applied_", "restored_")
-    os.rename(record_file, restored_record)
+    db.mark_restored(record_ids)
     
     return restored_count
 
-def main():
+# status命令输出的文件状态
+STATUS_LABELS = {
+    "pristine": "原始",
+    "patched": "已打补丁",
+    "drifted": "已偏离",
+    "missing": "缺失"
+}
+
+def collect_target_status(jobs=4):
+    """检查映射表及未还原应用记录中所有目标文件的状态
+
+    返回(最新记录, [(相对路径, 状态, 说明), ...])。状态含义：
+      pristine  与备份的原始内容一致（或从未被备份、也不在应用记录中）
+      patched   与最后一次修改该文件的未还原记录中写入后的内容一致
+      drifted   既不是原始内容，也不是记录中的内容（手工修改或补丁未完整应用）
+      missing   文件不存在
+    只有stat信息变化的文件才会重新计算哈希。
+    """
+    _, record = find_latest_record()
+    recorded = {}
+    legacy_targets = {}
+    for rel_path, (digest, _, fingerprint_id) in get_state_db().active_targets().items():
+        if digest is None:
+            # 旧版记录没有保存哈希，只能知道哪些文件被打过补丁
+            legacy_targets[rel_path] = fingerprint_id
+        else:
+            recorded[rel_path] = (digest, fingerprint_id)
+    
+    rel_paths = []
+    for category in FINGERPRINT_CATEGORIES:
+        rel_paths.extend(PATCH_FILE_MAPPINGS.get(category, []))
+    rel_paths.extend(recorded)
+    rel_paths.extend(legacy_targets)
+    rel_paths = sorted(set(rel_paths))
+    
+    hashes = file_hashes(rel_paths, jobs)
+    store = get_blob_store()
+    results = []
+    for rel_path in rel_paths:
+        digest = hashes[rel_path]
+        entry = store.get_entry(rel_path)
+        if digest is None:
+            results.append((rel_path, "missing", ""))
+        elif rel_path in recorded:
+            if digest == recorded[rel_path][0]:
+                results.append((rel_path, "patched", recorded[rel_path][1]))
+            elif entry and digest == entry["sha256"]:
+                results.append((rel_path, "drifted", "记录中已打补丁，但当前为原始内容"))
+            else:
+                results.append((rel_path, "drifted", "内容与应用记录不一致"))
+        elif entry and digest != entry["sha256"]:
+            if rel_path in legacy_targets:
+                results.append((rel_path, "patched", f"{legacy_targets[rel_path]}（旧版记录，未校验哈希）"))
+            else:
+                results.append((rel_path, "drifted", "内容与备份不一致，且不在应用记录中"))
+        else:
+            results.append((rel_path, "pristine", "" if entry else "无备份"))
+    return record, results
+
+def show_status(as_json=False, verbose=False, jobs=4):
+    """输出目标文件状态，存在偏离或缺失的文件时返回1"""
+    record, results = collect_target_status(jobs)
+    counts = {state: 0 for state in STATUS_LABELS}
+    for _, state, _ in results:
+        counts[state] += 1
+    
+    if as_json:
+        print(json.dumps({
+            "fingerprint_id": record["fingerprint_id"] if record else None,
+            "counts": counts,
+            "files": [
+                {"file": rel_path, "state": state, "detail": detail}
+                for rel_path, state, detail in results
+            ]
+        }, indent=2, ensure_ascii=False))
+    else:
+        pending = apply_journal.load(APPLY_JOURNAL_FILE)
+        if pending:
+            print(f"存在未完成的{pending.command}事务: {pending.fingerprint_id}"
+                  f"（已完成 {len(pending.done)}/{len(pending.targets)} 个文件），可使用 --resume 继续或 restore 回滚")
+        if record:
+            print(f"最新应用记录: {record['fingerprint_id']} ({record['applied_time']})")
+        else:
+            print("未找到补丁应用记录")
+        for rel_path, state, detail in results:
+            if state == "pristine" and not verbose:
+                continue
+            line = f"  {STATUS_LABELS[state]:<6} {rel_path}"
+            print(f"{line}  {detail}" if detail else line)
+        print("，".join(f"{STATUS_LABELS[state]} {count} 个" for state, count in counts.items()))
+    
+    return 1 if counts["drifted"] or counts["missing"] else 0
+
+def show_history(limit=20, rel_file=None):
+    """按时间倒序输出应用记录，可只显示修改过某个文件的记录"""
+    target = rel_file.replace("\\", "/") if rel_file else None
+    rows = get_state_db().history(limit, target)
+    if not rows:
+        print("没有应用记录")
+        return
+    for row in rows:
+        status = f"已还原 ({row['restored_time']})" if row["restored"] else "生效中"
+        print(f"#{row['id']:<5} {row['applied_time']}  {row['command']:<6} {row['fingerprint_id']}  "
+              f"{row['patch_count']} 个补丁  {status}")
+
+def active_patch_set():
+    """源码树当前生效的补丁集合{目标相对路径: (补丁文件, ...)}，后应用的记录覆盖先前的"""
+    db = get_state_db()
+    patch_set = {}
+    for apply_id in db.active_ids():
+        groups = {}
+        for patch_info in db.get_apply(apply_id)["patches"]:
+            groups.setdefault(patch_info["target"], []).append(patch_info["patch_file"])
+        patch_set.update((target, tuple(patch_files)) for target, patch_files in groups.items())
+    return patch_set
+
+def config_patch_set(config, patch_index):
+    """配置的补丁集合，返回({目标相对路径: (补丁文件, ...)}, {目标相对路径: {类别, ...}})"""
+    selected = select_patches(config, patch_index, verbose=False)
+    patch_set = {
+        _rel_target(target_file): tuple(patch_files)
+        for target_file, patch_files in group_patches_by_target(selected).items()
+    }
+    categories = {}
+    for category, target_file, _ in selected:
+        categories.setdefault(_rel_target(target_file), set()).add(category)
+    return patch_set, categories
+
+def estimate_rebuild(config_file=None, from_config=None, out_dir=None, as_json=False):
+    """根据ninja构建记录估算切换到config_file需要重新编译的目标文件数和编译耗时
+
+    未指定config_file时，分别估算修改每个类别全部目标文件的代价。
+    """
+    out_dir = os.path.join(SRC_DIR, out_dir or DEFAULT_OUT_DIR)
+    lookup = build_patch_index()
+    
+    if config_file:
+        new_set, categories = config_patch_set(load_config(config_file), lookup)
+        if from_config:
+            old_set, old_categories = config_patch_set(load_config(from_config), lookup)
+            for rel_path, cats in old_categories.items():
+                categories.setdefault(rel_path, set()).update(cats)
+        else:
+            old_set = active_patch_set()
+            for rel_path in old_set:
+                # 当前生效的补丁按所在类别目录归类
+                for patch_file in old_set[rel_path]:
+                    categories.setdefault(rel_path, set()).add(os.path.basename(os.path.dirname(patch_file)))
+        changed = sorted(t for t in set(new_set) | set(old_set) if new_set.get(t) != old_set.get(t))
+        by_category = {}
+        for rel_path in changed:
+            for category in categories.get(rel_path, ()):
+                by_category.setdefault(category, []).append(rel_path)
+    else:
+        by_category = {category: list(files) for category, files in patch_file_mappings().items()}
+        changed = sorted({t for files in by_category.values() for t in files})
+    
+    model = ninja_deps.BuildCostModel(out_dir, SRC_DIR, changed)
+    if not model.available:
+        print(f"警告: {out_dir} 中没有.ninja_deps/.ninja_log，无法估算")
+        return 1
+    
+    rows = []
+    for category in sorted(by_category, key=_category_rank):
+        files = by_category[category]
+        objects, seconds = model.estimate(files)
+        rows.append({"category": category, "files": len(files), "objects": objects, "seconds": round(seconds, 1)})
+    rows.sort(key=lambda row: row["seconds"], reverse=True)
+    total_objects, total_seconds = model.estimate(changed)
+    ratio = ninja_deps.wall_time_ratio(ninja_deps.load_history(BUILD_HISTORY_FILE, limit=20))
+    
+    result = {
+        "out_dir": out_dir,
+        "changed_files": changed,
+        "categories": rows,
+        "files": {rel_path: len(model.objects.get(rel_path, ())) for rel_path in changed},
+        "total": {"objects": total_objects, "seconds": round(total_seconds, 1)},
+        "wall_seconds": round(total_seconds * ratio, 1) if ratio else None
+    }
+    if as_json:
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+        return 0
+    
+    print("类别" + " " * 18 + " 文件数" + "   目标文件数" + "    编译CPU秒")
+    for row in rows:
+        print(f"{row['category']:<22} {row['files']:>6} {row['objects']:>12} {row['seconds']:>12.1f}")
+    print(f"合计（去重）: {len(changed)} 个文件，{total_objects} 个目标文件，编译CPU时间约 {total_seconds:.1f} 秒")
+    if ratio:
+        print(f"按最近的构建记录换算，预计构建耗时约 {total_seconds * ratio / 60:.1f} 分钟")
+    unknown = [rel_path for rel_path in changed if rel_path not in model.objects]
+    if unknown:
+        print(f"注意: {len(unknown)} 个文件在构建记录中没有依赖信息（未参与该out目录的构建或尚未构建）")
+    return 0
+
+def pack_bundle(output):
+    """将patches目录和映射表打包为单个补丁包"""
+    digest, count = patch_bundle.pack(PATCHES_DIR, PATCH_FILE_MAPPINGS, FINGERPRINT_CATEGORIES, output)
+    print(f"已打包 {count} 个补丁: {output}")
+    print(f"SHA-256: {digest}")
+
+def unpack_bundle(bundle_file, output_dir=None):
+    """将补丁包中的全部补丁解到output_dir（默认patches目录）"""
+    output_dir = output_dir or PATCHES_DIR
+    bundle = patch_bundle.PatchBundle(bundle_file)
+    try:
+        count = bundle.unpack(output_dir)
+        if bundle.mappings != PATCH_FILE_MAPPINGS:
+            print("警告: 补丁包中的映射表与当前patch_manager.py中的PATCH_FILE_MAPPINGS不一致")
+    finally:
+        bundle.close()
+    print(f"已解出 {count} 个补丁到: {output_dir}")
+
+def verify_bundle(bundle_file):
+    """校验补丁包，存在错误时返回1"""
+    try:
+        bundle = patch_bundle.PatchBundle(bundle_file)
+    except patch_bundle.BundleError as e:
+        print(f"错误: {e}")
+        return 1
+    try:
+        errors, digest = bundle.verify()
+        count = len(bundle.entries)
+        bundle_id = bundle.bundle_id
+    finally:
+        bundle.close()
+    for error in errors:
+        print(f"错误: {error}")
+    print(f"补丁包ID: {bundle_id}")
+    print(f"SHA-256: {digest}")
+    print(f"共 {count} 个补丁，{'校验失败' if errors else '校验通过'}")
+    return 1 if errors else 0
+
+def index_source_tree(jobs=8):
+    """生成或增量刷新源码树路径索引"""
+    if not os.path.isdir(SRC_DIR):
+        print(f"错误: 源码目录不存在: {SRC_DIR}")
+        return 1
+    start = time.time()
+    with trace_events.span("index_src"):
+        stats = src_index.build_index(SRC_DIR, SRC_INDEX_FILE, jobs)
+    print(f"已索引 {stats['dirs']} 个目录、{stats['files']} 个文件（重新扫描 {stats['scanned']} 个目录），"
+          f"耗时 {time.time() - start:.2f} 秒: {SRC_INDEX_FILE}")
+    return 0
+
+def verify_mappings(as_json=False, refresh=False, jobs=8):
+    """按源码路径索引检查映射表中的每个路径，缺失时推荐最接近的路径，存在缺失时返回1"""
+    if refresh or not os.path.exists(SRC_INDEX_FILE):
+        if index_source_tree(jobs):
+            return 1
+    index = src_index.SrcIndex(SRC_INDEX_FILE)
+    try:
+        mappings = patch_file_mappings()
+        rel_paths = sorted({rel for files in mappings.values() for rel in files})
+        sizes = {rel: index.lookup(rel) for rel in rel_paths}
+        missing = [rel for rel in rel_paths if sizes[rel] is None]
+        same_name = index.find_basenames({os.path.basename(rel) for rel in missing}) if missing else {}
+        suggestions = {
+            rel: src_index.suggest(index, rel, same_name.get(os.path.basename(rel), []))
+            for rel in missing
+        }
+    finally:
+        index.close()
+    
+    categories = {}
+    for category, files in mappings.items():
+        for rel in files:
+            categories.setdefault(rel, []).append(category)
+    
+    if as_json:
+        print(json.dumps({
+            "index": SRC_INDEX_FILE,
+            "files": [
+                {"file": rel, "categories": categories[rel], "size": sizes[rel],
+                 "suggestions": suggestions.get(rel, [])}
+                for rel in rel_paths
+            ]
+        }, indent=2, ensure_ascii=False))
+    else:
+        for rel in rel_paths:
+            if sizes[rel] is None:
+                print(f"  缺失     {rel}  ({', '.join(categories[rel])})")
+                for candidate in suggestions[rel]:
+                    print(f"           可能是: {candidate}")
+            else:
+                print(f"  存在     {rel}  {sizes[rel]} 字节")
+        print(f"共 {len(rel_paths)} 个映射路径，存在 {len(rel_paths) - len(missing)} 个，缺失 {len(missing)} 个"
+              f"（文件大小来自索引，源码有改动时请先执行 index-src）")
+    return 1 if missing else 0
+
+def _ninja_escape(path):
+    """转义ninja build语句中的路径"""
+    return path.replace("$", "$$").replace(" ", "$ ").replace(":", "$:")
+
+def _depfile_escape(path):
+    return path.replace("\\", "/").replace(" ", "\\ ")
+
+def ninja_apply(config_file, stamp_file, depfile, jobs=4):
+    """在ninja中执行的补丁步骤：切换到配置，写出depfile，结果有变化时才更新stamp
+
+    depfile列出配置文件、选中的补丁文件和目标文件的原始内容（备份对象），
+    其中任一变化时ninja才会再次执行该步骤。配合restat，stamp内容未变时
+    依赖它的编译步骤不会被判定为需要重建。
+    """
+    config = load_config(config_file)
+    selected = select_patches(config, verbose=False)
+    record_id = switch_fingerprint_config(config_file, jobs=jobs)
+    if record_id is None:
+        return 1
+    record = get_state_db().get_apply(record_id)
+    
+    groups = group_patches_by_target(selected)
+    store = get_blob_store()
+    inputs = [os.path.abspath(config_file), os.path.abspath(__file__)]
+    inputs.extend(dict.fromkeys(patch_file for _, _, patch_file in selected))
+    for target_file in sorted(groups):
+        entry = get_backup_entry(target_file)
+        if entry is not None:
+            inputs.append(store.pristine_path(entry, _rel_target(target_file)))
+    with open(depfile, "w", encoding="utf-8") as f:
+        f.write(f"{_depfile_escape(stamp_file)}: " + " \\\n  ".join(_depfile_escape(p) for p in inputs) + "\n")
+    
+    stamp = json.dumps({"fingerprint_id": config["fingerprint_id"], "targets": record["target_hashes"]},
+                       sort_keys=True, indent=1) + "\n"
+    try:
+        with open(stamp_file, "r", encoding="utf-8") as f:
+            unchanged = f.read() == stamp
+    except OSError:
+        unchanged = False
+    if not unchanged:
+        os.makedirs(os.path.dirname(os.path.abspath(stamp_file)), exist_ok=True)
+        with open(stamp_file, "w", encoding="utf-8") as f:
+            f.write(stamp)
+    if len(record["patches"]) != len(selected):
+        print(f"错误: {len(selected) - len(record['patches'])} 个补丁未能应用")
+        return 1
+    return 0
+
+NINJA_RULES = """# 由 patch_manager.py gen-build 生成，请勿手工修改
+# 在out目录的build.ninja中 subninja 本文件，或直接执行：
+#   ninja -C {out_dir} -f {ninja_name}
+# 被补丁修改的源码文件声明为输出，配合restat，内容未变化的文件不会触发重建。
+
+fp_python = {python}
+fp_patch_manager = {script}
+
+rule fp_apply
+  command = "$fp_python" "$fp_patch_manager" ninja-apply --config "$fp_config" --stamp "$fp_stamp" --depfile "$fp_stamp.d" --jobs {jobs}
+  depfile = $fp_stamp.d
+  deps = gcc
+  restat = 1
+  description = 应用指纹补丁 $fp_name
+
+build {outputs}: fp_apply {inputs} | {script_escaped}
+  fp_config = {config}
+  fp_stamp = {stamp}
+  fp_name = {name}
+
+build fingerprint_patches: phony {stamp_escaped}
+"""
+
+def generate_build_rules(config_file, out_dir=None, output_dir=None, jobs=4):
+    """生成ninja规则，使补丁步骤成为构建图中的一个增量步骤
+
+    被补丁修改的源码文件声明为规则的输出，编译步骤因此排在补丁步骤之后。
+    GN的action只能输出到out目录，无法把源码文件声明为输出，编译目标与补丁
+    步骤之间没有可靠的先后关系，所以不提供GN模板。
+    """
+    config = load_config(config_file)
+    config_file = os.path.abspath(config_file)
+    out_dir = os.path.join(SRC_DIR, out_dir or DEFAULT_OUT_DIR)
+    output_dir = output_dir or BUILD_RULES_DIR
+    os.makedirs(output_dir, exist_ok=True)
+    
+    selected = select_patches(config, verbose=False)
+    targets = sorted(group_patches_by_target(selected))
+    patch_files = list(dict.fromkeys(patch_file for _, _, patch_file in selected))
+    stamp = os.path.join(out_dir, "gen", "fingerprint_patches.stamp")
+    script = os.path.abspath(__file__)
+    
+    ninja_file = os.path.join(output_dir, "fingerprint_patches.ninja")
+    with open(ninja_file, "w", encoding="utf-8") as f:
+        f.write(NINJA_RULES.format(
+            out_dir=out_dir,
+            ninja_name=ninja_file,
+            python=sys.executable,
+            script=script,
+            script_escaped=_ninja_escape(script),
+            jobs=jobs,
+            outputs=" ".join(_ninja_escape(p) for p in [stamp] + targets),
+            inputs=" ".join(_ninja_escape(p) for p in [config_file] + patch_files),
+            config=config_file,
+            stamp=stamp,
+            stamp_escaped=_ninja_escape(stamp),
+            name=config["fingerprint_id"]
+        ))
+    
+    print(f"已生成ninja规则: {ninja_file}（{len(targets)} 个目标文件，{len(patch_files)} 个补丁）")
+    return 0
+
+def _switch_target(target_file, patch_files, recorded=None, refresh_backup=False, failed=None):
+    """将单个目标文件切换到新配置下的有效内容，返回(成功标志列表, 是否写入)
+
+    recorded不为None时先按checked_pristine检查文件是否偏离。文件已偏离或处理
+    出错时将相对路径加入failed（补丁列表为空时无法从返回值看出失败）。
+    """
+    rel_path = os.path.relpath(target_file, SRC_DIR)
+    try:
+        with trace_events.span("switch_target", file=rel_path, patches=len(patch_files)):
+            if not patch_files and not os.path.exists(target_file):
+                return [], False
+            if recorded is None:
+                pristine = read_pristine(target_file)
+            else:
+                pristine = checked_pristine(target_file, recorded, refresh_backup)
+            if not patch_files:
+                # 新配置不再修改该文件，仅在内容不同于原始文件时还原
+                if read_file_bytes(target_file) == pristine:
+                    return [], False
+                write_file_bytes(target_file, pristine)
+                print(f"已还原文件: {rel_path}")
+                return [], True
+            return _patch_target(patch_files, target_file, pristine)
+    except TargetDriftError as e:
+        print(f"错误: {e}")
+    except Exception as e:
+        print(f"处理 {rel_path} 时出错: {e}")
+    if failed is not None:
+        failed.append(rel_path)
+    return [False] * len(patch_files), False
+
+def switch_fingerprint_config(config_file, jobs=1, resume=False, ignore_conflicts=False, refresh_backup=False):
+    """以最小改动切换到新的指纹配置
+
+    对新旧配置涉及的每个目标文件，在内存中基于原始内容计算新配置下的
+    有效内容，仅当字节内容发生变化时才写入文件。未变化的文件保留原有
+    mtime，使ninja的重建范围只包含真正改变的文件。与apply相同，每一步
+    都会写入预写日志，被手工修改的目标文件不会被覆盖。
+    有目标文件未能切换时，旧配置的应用记录保持有效（这些文件可能仍是旧配置
+    的内容，restore需要还原它们），并返回None。
+    """
+    config = None if resume and not config_file else load_config(config_file)
+    config, done, resumed = begin_transaction("switch", config)
+    if config is None:
+        return None
+    print(f"正在切换到指纹配置: {config['fingerprint_id']}")
+    
+    db = get_state_db()
+    old_record_ids = db.active_ids()
+    old_targets = active_target_files()
+    
+    selected = select_patches(config, verbose=False)
+    groups = group_patches_by_target(selected)
+    if not resumed and not ignore_conflicts and reject_conflicts(groups):
+        return None
+    for target_file in old_targets:
+        groups.setdefault(target_file, [])
+    
+    # 继续被中断的事务时，未完成的文件可能已写入一半的结果，不做偏离检查
+    recorded = None if resumed else recorded_target_hashes()
+    failed = []
+    succeeded, written_count, journal = run_journaled(
+        "switch", config, groups,
+        lambda target_file, patch_files, _: _switch_target(target_file, patch_files, recorded,
+                                                           refresh_backup, failed),
+        jobs=jobs, done=done, resumed=resumed)
+    failed.extend(
+        _rel_target(target_file) for target_file, patch_files in groups.items()
+        if patch_files and not all((target_file, p) in succeeded for p in patch_files)
+    )
+    failed = sorted(set(failed))
+    
+    applied_patches = _build_applied_list(selected, succeeded)
+    if not failed:
+        db.mark_restored(old_record_ids)
+    record_id = write_applied_record(config, applied_patches, command="switch")
+    journal.commit()
+    
+    print(f"配置切换完成，共应用 {len(applied_patches)} 个补丁，"
+          f"写入 {written_count} 个文件，{len(groups) - written_count} 个文件内容未变化")
+    if failed:
+        print(f"错误: {len(failed)} 个文件未能切换，旧配置的应用记录保持有效: {', '.join(failed[:10])}"
+              + (" ..." if len(failed) > 10 else ""))
+        return None
+    return record_id
+
+def compute_effective_content(target_file, patch_files):
+    """在内存中计算目标文件应用补丁后的内容，不修改源码树
+
+    返回(内容, 成功标志列表)，无法应用的补丁会被跳过。
+    """
+    rel_path = os.path.relpath(target_file, SRC_DIR)
+    pristine = read_pristine(target_file)
+    composed = load_composed(pristine, patch_files)
+    if composed is not None:
+        return composed, [True] * len(patch_files)
+    
+    content = pristine
+    results = []
+    for patch_file in patch_files:
+        try:
+            content = patch_content(content, patch_file, rel_path)
+            results.append(True)
+        except (diff_engine.PatchError, OSError, UnicodeError) as e:
+            print(f"无法应用补丁 {os.path.basename(patch_file)} 到 {rel_path}: {e}")
+            results.append(False)
+    if all(results):
+        store_composed(pristine, patch_files, content)
+    return content, results
+
+def _overlay_real_dirs(rel_files):
+    """补丁文件所在的全部祖先目录（含根目录""），这些目录在影子树中为真实目录"""
+    real_dirs = {""}
+    for rel_file in rel_files:
+        parent = os.path.dirname(rel_file)
+        while parent and parent not in real_dirs:
+            real_dirs.add(parent)
+            parent = os.path.dirname(parent)
+    return real_dirs
+
+def _build_shadow_tree(overlay_dir, contents):
+    """构建稀疏影子树：补丁路径上的目录为真实目录，其余条目为指向src的符号链接
+
+    contents为{相对路径: 内容}。已存在的影子树会被增量更新，内容未变化的
+    补丁文件不会被重写。
+    """
+    real_dirs = _overlay_real_dirs(contents)
+    written = 0
+    
+    for rel_dir in sorted(real_dirs):
+        src_dir = os.path.join(SRC_DIR, rel_dir)
+        dst_dir = os.path.join(overlay_dir, rel_dir)
+        if os.path.islink(dst_dir):
+            os.unlink(dst_dir)
+        os.makedirs(dst_dir, exist_ok=True)
+        
+        with os.scandir(src_dir) as entries:
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                dst_path = os.path.join(dst_dir, entry.name)
+                if rel_path in real_dirs:
+                    continue
+                if rel_dir == "" and entry.name == "out":
+                    # 每个变体使用独立的输出目录
+                    if os.path.islink(dst_path):
+                        os.unlink(dst_path)
+                    os.makedirs(dst_path, exist_ok=True)
+                    continue
+                if rel_path in contents:
+                    data = contents[rel_path]
+                    if os.path.islink(dst_path):
+                        os.unlink(dst_path)
+                    elif os.path.isfile(dst_path) and read_file_bytes(dst_path) == data:
+                        continue
+                    write_file_bytes(dst_path, data)
+                    shutil.copymode(entry.path, dst_path)
+                    written += 1
+                    continue
+                if os.path.islink(dst_path):
+                    if os.readlink(dst_path) == entry.path:
+                        continue
+                    os.unlink(dst_path)
+                elif os.path.isdir(dst_path):
+                    shutil.rmtree(dst_path)
+                elif os.path.lexists(dst_path):
+                    os.unlink(dst_path)
+                os.symlink(entry.path, dst_path, target_is_directory=entry.is_dir())
+    return written
+
+def _build_worktree(overlay_dir, contents):
+    """基于git worktree构建变体目录，再写入补丁后的文件"""
+    if not os.path.exists(os.path.join(overlay_dir, ".git")):
+        cmd = ["git", "-C", SRC_DIR, "worktree", "add", "--detach", overlay_dir, "HEAD"]
+        subprocess.run(cmd, check=True, capture_output=True, text=True)
+    else:
+        # 复用已有工作区：先还原上一次写入的补丁文件
+        subprocess.run(["git", "-C", overlay_dir, "checkout", "--", "."], check=True, capture_output=True, text=True)
+    
+    written = 0
+    for rel_path, data in contents.items():
+        dst_path = os.path.join(overlay_dir, rel_path)
+        if os.path.isfile(dst_path) and read_file_bytes(dst_path) == data:
+            continue
+        write_file_bytes(dst_path, data)
+        written += 1
+    return written
+
+def materialize_overlay(config_file, overlay_dir=None, method="shadow", jobs=1, selected=None, verbose=True):
+    """将配置对应的补丁结果写入独立的变体目录，不修改原始src目录
+
+    method为shadow时构建稀疏影子树（符号链接+补丁后的文件副本），为worktree
+    时使用git worktree。每个变体拥有独立的out目录，可与其他变体并行构建，
+    且无需执行restore。指定selected时只应用其中的补丁（用于bisect）。
+    """
+    config = load_config(config_file)
+    if overlay_dir is None:
+        overlay_dir = os.path.join(OVERLAY_DIR, config["fingerprint_id"])
+    overlay_dir = os.path.abspath(overlay_dir)
+    if verbose:
+        print(f"正在为指纹配置 {config['fingerprint_id']} 构建变体目录: {overlay_dir}")
+    
+    if selected is None:
+        selected = select_patches(config, verbose=False)
+    groups = group_patches_by_target(selected)
+    
+    contents = {}
+    succeeded = set()
+    
+    def collect(target_file, patch_files, outcome):
+        content, results = outcome
+        contents[os.path.relpath(target_file, SRC_DIR)] = content
+        for patch_file, ok in zip(patch_files, results):
+            if ok:
+                succeeded.add((target_file, patch_file))
+    
+    if jobs > 1 and len(groups) > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(compute_effective_content, target_file, patch_files): (target_file, patch_files)
+                for target_file, patch_files in groups.items()
+                if os.path.exists(target_file)
+            }
+            for future in as_completed(futures):
+                target_file, patch_files = futures[future]
+                collect(target_file, patch_files, future.result())
+    else:
+        for target_file, patch_files in groups.items():
+            if os.path.exists(target_file):
+                collect(target_file, patch_files, compute_effective_content(target_file, patch_files))
+    
+    os.makedirs(overlay_dir, exist_ok=True)
+    if method == "worktree":
+        written = _build_worktree(overlay_dir, contents)
+    else:
+        written = _build_shadow_tree(overlay_dir, contents)
+    
+    # 记录变体信息
+    applied_patches = _build_applied_list(selected, succeeded)
+    _save_json_atomic(os.path.join(overlay_dir, ".fp_overlay.json"), {
+        "fingerprint_id": config["fingerprint_id"],
+        "method": method,
+        "src_dir": SRC_DIR,
+        "created_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "patches": applied_patches
+    })
+    
+    if verbose:
+        print(f"变体目录构建完成，共应用 {len(applied_patches)} 个补丁，写入 {written} 个文件")
+    return overlay_dir
+
+def _link_out_dir(tree_dir, out_dir):
+    """在变体目录中建立与out目录同路径的真实目录，其中的条目链接到原out目录
+
+    编译命令中的相对路径（如../../base/time/time.cc）在该目录下执行时解析到
+    变体目录，而gen等生成文件仍来自原out目录。
+    """
+    rel_out = os.path.relpath(out_dir, SRC_DIR)
+    path = tree_dir
+    for part in rel_out.split(os.sep):
+        path = os.path.join(path, part)
+        if os.path.islink(path):
+            os.unlink(path)
+        os.makedirs(path, exist_ok=True)
+    with os.scandir(out_dir) as entries:
+        for entry in entries:
+            dst_path = os.path.join(path, entry.name)
+            if os.path.islink(dst_path):
+                if os.readlink(dst_path) == entry.path:
+                    continue
+                os.unlink(dst_path)
+            elif os.path.lexists(dst_path):
+                continue
+            os.symlink(entry.path, dst_path, target_is_directory=entry.is_dir())
+    return path
+
+def _select_compile_units(entries, rel_targets, out_dir, max_per_header):
+    """选出需要编译的翻译单元
+
+    被补丁修改的源文件直接编译其全部编译命令；被修改的头文件通过.ninja_deps
+    找到包含它的目标文件，已选中的翻译单元包含该头文件时不再额外选择，否则按
+    上次编译耗时从短到长最多选max_per_header个。返回([(编译条目, 相关的补丁
+    文件相对路径集合), ...], 没有可编译翻译单元的文件列表)。
+    """
+    by_file = {}
+    by_output = {}
+    for entry in entries:
+        by_file.setdefault(entry["file"], []).append(entry)
+        if entry["output"]:
+            by_output[entry["output"]] = entry
+    
+    model = ninja_deps.BuildCostModel(out_dir, SRC_DIR, rel_targets)
+    # 目标文件 -> 它依赖的被补丁修改的文件
+    output_deps = {}
+    for rel_path, outputs in model.objects.items():
+        for output in outputs:
+            output_deps.setdefault(os.path.normpath(os.path.join(out_dir, output)), set()).add(rel_path)
+    
+    units = {}
+    for rel_path in rel_targets:
+        for entry in by_file.get(os.path.join(SRC_DIR, rel_path), ()):
+            units[id(entry)] = (entry, {rel_path} | output_deps.get(entry["output"], set()))
+    
+    uncovered = []
+    for rel_path in rel_targets:
+        if any(rel_path in patched for _, patched in units.values()):
+            continue
+        outputs = sorted(os.path.normpath(os.path.join(out_dir, o)) for o in model.objects.get(rel_path, ()))
+        candidates = [by_output[o] for o in outputs if o in by_output]
+        if not candidates:
+            uncovered.append(rel_path)
+            continue
+        candidates.sort(key=lambda e: model.durations.get(
+            os.path.relpath(e["output"], out_dir).replace(os.sep, "/"), model.default_seconds))
+        for entry in candidates[:max_per_header]:
+            units[id(entry)] = (entry, output_deps.get(entry["output"], set()) | {rel_path})
+    return list(units.values()), uncovered
+
+def check_compile(config_file, out_dir=None, jobs=8, max_per_header=2, timeout=None, as_json=False):
+    """只编译受配置中补丁影响的翻译单元，按补丁报告编译结果，存在失败时返回1
+
+    补丁结果写入check_compile/tree下的变体目录，不修改src；编译命令取自out目录的
+    compile_commands.json，目标文件输出到临时目录。编译结果按(编译命令, 输入
+    内容哈希)缓存，输入包括.ninja_deps中记录的翻译单元全部依赖。
+    """
+    config = load_config(config_file)
+    out_dir = os.path.join(SRC_DIR, out_dir or DEFAULT_OUT_DIR)
+    db_file = os.path.join(out_dir, "compile_commands.json")
+    if not os.path.exists(db_file):
+        print(f"错误: 找不到 {db_file}，请先执行 gn gen --export-compile-commands {os.path.relpath(out_dir, SRC_DIR)}")
+        return 1
+    entries = compile_check.load_compile_commands(db_file)
+    
+    selected = select_patches(config, verbose=False)
+    groups = group_patches_by_target(selected)
+    # 输出JSON时进度信息写到stderr
+    progress = sys.stderr if as_json else sys.stdout
+    with contextlib.redirect_stdout(progress):
+        tree_dir = materialize_overlay(config_file, os.path.join(CHECK_COMPILE_DIR, "tree"), jobs=jobs)
+    tree_out_dir = _link_out_dir(tree_dir, out_dir)
+    with open(os.path.join(tree_dir, ".fp_overlay.json"), "r", encoding="utf-8") as f:
+        applied = {(p["target_file"], p["patch_file"]) for p in json.load(f)["patches"]}
+    
+    rel_targets = sorted(_rel_target(t) for t in groups if os.path.exists(t))
+    units, uncovered = _select_compile_units(entries, rel_targets, out_dir, max_per_header)
+    
+    def content_sha256(path):
+        return hashlib.sha256(read_file_bytes(path)).hexdigest()
+    
+    hashes = {rel_path: content_sha256(os.path.join(tree_dir, rel_path)) for rel_path in rel_targets}
+    
+    def dep_input(path):
+        """依赖文件在缓存键中的(路径, 内容哈希)，src中的文件使用相对路径，不存在的文件哈希为None"""
+        if path.startswith(SRC_DIR + os.sep):
+            rel_path = _rel_target(path)
+            if rel_path in hashes:
+                return rel_path, hashes[rel_path]
+        else:
+            rel_path = path
+        try:
+            hashes[rel_path] = content_sha256(path)
+        except OSError:
+            hashes[rel_path] = None
+        return rel_path, hashes[rel_path]
+    
+    # 翻译单元上次编译时的全部依赖（头文件、生成文件等），其内容变化时缓存失效
+    unit_deps = ninja_deps.read_output_deps(out_dir, [e["output"] for e, _ in units if e["output"]])
+    cache = compile_check.CompileCache(os.path.join(CHECK_COMPILE_DIR, "cache.json"))
+    obj_dir = os.path.join(CHECK_COMPILE_DIR, "obj")
+    os.makedirs(obj_dir, exist_ok=True)
+    
+    def run_unit(entry, key):
+        suffix = os.path.splitext(entry["output"] or "")[1] or ".o"
+        obj_path = os.path.join(obj_dir, key[:16] + suffix)
+        arguments = compile_check.rebase_arguments(
+            compile_check.redirect_outputs(entry["arguments"], obj_path), SRC_DIR, tree_dir)
+        directory = entry["directory"]
+        if directory == out_dir:
+            cwd = tree_out_dir
+        elif directory.startswith(SRC_DIR + os.sep):
+            cwd = os.path.join(tree_dir, os.path.relpath(directory, SRC_DIR))
+        else:
+            cwd = directory
+        with trace_events.span("compile_unit", file=os.path.relpath(entry["file"], SRC_DIR)):
+            result = compile_check.compile_unit(arguments, cwd, timeout)
+        for path in (obj_path, obj_path + ".d"):
+            if os.path.exists(path):
+                os.unlink(path)
+        return result
+    
+    results = []
+    pending = []
+    for entry, patched in units:
+        inputs = {rel_path: hashes[rel_path] for rel_path in patched}
+        rel_file = os.path.relpath(entry["file"], SRC_DIR).replace(os.sep, "/")
+        if rel_file not in patched and os.path.exists(entry["file"]):
+            inputs[rel_file] = content_sha256(entry["file"])
+        for dep in unit_deps.get(entry["output"], ()):
+            rel_path, sha = dep_input(dep)
+            inputs.setdefault(rel_path, sha)
+        inputs = list(inputs.items())
+        key = compile_check.cache_key(entry["arguments"], entry["directory"], inputs)
+        unit = {"file": rel_file, "object": entry["output"], "patched_files": sorted(patched)}
+        results.append(unit)
+        cached = cache.get(key)
+        if cached is not None:
+            unit.update(cached, cached_result=True)
+        else:
+            pending.append((unit, entry, key))
+    
+    print(f"需要编译 {len(pending)} 个翻译单元（另有 {len(results) - len(pending)} 个结果来自缓存）", file=progress)
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {executor.submit(run_unit, entry, key): (unit, key) for unit, entry, key in pending}
+        for future in as_completed(futures):
+            unit, key = futures[future]
+            result = future.result()
+            cache.put(key, result)
+            unit.update(result, cached_result=False)
+            if not result["ok"]:
+                print(f"编译失败: {unit['file']}", file=progress)
+    cache.save()
+    
+    # 按补丁汇总：翻译单元编译失败时，归因于它依赖的全部被修改文件上的补丁
+    failed_by_target = {}
+    checked_targets = set()
+    for unit in results:
+        for rel_path in unit["patched_files"]:
+            checked_targets.add(rel_path)
+            if not unit["ok"]:
+                failed_by_target.setdefault(rel_path, []).append(unit["file"])
+    patch_rows = []
+    for category, target_file, patch_file in selected:
+        rel_path = _rel_target(target_file)
+        if (target_file, patch_file) not in applied:
+            status = "apply_failed"
+        elif rel_path in failed_by_target:
+            status = "compile_failed"
+        elif rel_path in checked_targets:
+            status = "ok"
+        else:
+            status = "unchecked"
+        patch_rows.append({
+            "category": category,
+            "patch": f"{os.path.basename(os.path.dirname(patch_file))}/{os.path.basename(patch_file)}",
+            "target": rel_path,
+            "status": status,
+            "failed_units": failed_by_target.get(rel_path, [])
+        })
+    
+    failed = any(row["status"] in ("apply_failed", "compile_failed") for row in patch_rows)
+    if as_json:
+        print(json.dumps({"out_dir": out_dir, "units": results, "patches": patch_rows,
+                          "uncovered": uncovered}, indent=2, ensure_ascii=False))
+        return 1 if failed else 0
+    
+    for unit in results:
+        if not unit["ok"]:
+            print(f"\n{unit['file']}（相关文件: {', '.join(unit['patched_files'])}）")
+            for line in unit["output"].splitlines():
+                print(f"    {line}")
+    labels = {"ok": "通过", "compile_failed": "编译失败", "apply_failed": "应用失败", "unchecked": "未检查"}
+    print()
+    for row in patch_rows:
+        label = labels[row["status"]]
+        print(f"  {label}{' ' * (10 - 2 * len(label))}{row['patch']}  ->  {row['target']}")
+        for rel_file in row["failed_units"]:
+            print(f"           编译失败: {rel_file}")
+    counts = {status: sum(1 for row in patch_rows if row["status"] == status) for status in labels}
+    print(f"共 {len(results)} 个翻译单元，失败 {sum(1 for u in results if not u['ok'])} 个；"
+          f"补丁: " + "，".join(f"{labels[s]} {counts[s]}" for s in labels))
+    if uncovered:
+        print(f"注意: {len(uncovered)} 个文件在compile_commands.json和.ninja_deps中找不到对应的翻译单元，未检查")
+    return 1 if failed else 0
+
+def bisect_patches(config_file, test_cmd, jobs=4, timeout=None):
+    """在配置的有效补丁集合中查找使测试命令失败的最小补丁子集
+
+    每个子集写入bisect/slot<N>下的变体目录，在该目录中通过shell执行test_cmd，
+    返回值非0视为失败。槽位目录在各轮之间复用，变体目录只改写内容变化的文件，
+    槽位中的out目录也会保留，测试命令中的增量构建可以复用上一次的结果。
+    找到失败子集时返回1，无法定位时返回2，完整补丁集合测试通过时返回0。
+    """
+    config = load_config(config_file)
+    selected = select_patches(config, verbose=False)
+    if not selected:
+        print("配置中没有需要应用的补丁")
+        return 0
+    jobs = max(1, jobs)
+    log_dir = os.path.join(BISECT_DIR, "logs")
+    shutil.rmtree(log_dir, ignore_errors=True)
+    os.makedirs(log_dir)
+    slots = queue.Queue()
+    for i in range(jobs):
+        slots.put(os.path.join(BISECT_DIR, f"slot{i}"))
+    materialize_lock = threading.Lock()
+    tests = []
+    
+    def run_subset(subset):
+        """应用子集并执行测试，返回True表示测试失败"""
+        entries = [selected[i] for i in subset]
+        slot = slots.get()
+        try:
+            # 变体目录的生成共用补丁解析和组合缓存，逐个进行；测试命令并行执行
+            with materialize_lock:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    materialize_overlay(config_file, slot, jobs=1, selected=entries, verbose=False)
+                with open(os.path.join(slot, ".fp_overlay.json"), "r", encoding="utf-8") as f:
+                    applied = len(json.load(f)["patches"])
+                test_id = len(tests)
+                tests.append(None)
+            log_file = os.path.join(log_dir, f"{test_id:04d}.log")
+            start = time.time()
+            if applied != len(entries):
+                # 子集中有补丁依赖被拆开的其他补丁而无法应用，结果不确定，按未失败处理
+                failed, returncode = False, None
+            else:
+                env = dict(os.environ, FP_OVERLAY_DIR=slot)
+                with open(log_file, "w", encoding="utf-8", errors="replace") as log, \
+                        trace_events.span("bisect_test", patches=len(entries)):
+                    try:
+                        returncode = subprocess.run(test_cmd, shell=True, cwd=slot, env=env, stdout=log,
+                                                    stderr=subprocess.STDOUT, timeout=timeout).returncode
+                    except subprocess.TimeoutExpired:
+                        log.write(f"\n测试超时（{timeout} 秒）\n")
+                        returncode = -1
+                failed = returncode != 0
+            tests[test_id] = {
+                "patches": len(entries),
+                "applied": applied,
+                "returncode": returncode,
+                "failed": failed,
+                "seconds": round(time.time() - start, 1),
+                "log": log_file
+            }
+            return failed
+        finally:
+            slots.put(slot)
+    
+    def run_tests(subsets):
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(run_subset, subsets))
+    
+    def on_round(round_no, granularity, size, count):
+        print(f"第 {round_no} 轮: 当前集合 {size} 个补丁，分为 {granularity} 份，测试 {count} 个子集")
+    
+    print(f"共 {len(selected)} 个补丁，使用 {jobs} 个并行槽位: {BISECT_DIR}")
+    start = time.time()
+    full_failed, empty_failed = run_tests([tuple(range(len(selected))), ()])
+    if not full_failed:
+        print("完整补丁集合测试通过，无需二分")
+        return 0
+    if empty_failed:
+        print("不应用任何补丁时测试同样失败，失败与补丁无关")
+        return 2
+    
+    minimal, rounds, _ = patch_bisect.ddmin(list(range(len(selected))), run_tests, on_round)
+    culprits = [selected[i] for i in minimal]
+    report = {
+        "fingerprint_id": config["fingerprint_id"],
+        "test_cmd": test_cmd,
+        "patch_count": len(selected),
+        "rounds": rounds,
+        "tests": tests,
+        "seconds": round(time.time() - start, 1),
+        "culprits": [
+            {"category": category, "target": _rel_target(target_file), "patch_file": patch_file}
+            for category, target_file, patch_file in culprits
+        ]
+    }
+    _save_json_atomic(os.path.join(BISECT_DIR, "report.json"), report)
+    
+    print()
+    if len(culprits) == 1:
+        print("导致测试失败的补丁:")
+    else:
+        print(f"以下 {len(culprits)} 个补丁同时应用时测试失败，去掉其中任意一个都会通过:")
+    for category, target_file, patch_file in culprits:
+        print(f"  {category:<22} {os.path.basename(patch_file)}  ->  {_rel_target(target_file)}")
+    print(f"共 {rounds} 轮，执行 {len(tests)} 次测试，耗时 {report['seconds']:.1f} 秒")
+    print(f"测试日志: {log_dir}，报告: {os.path.join(BISECT_DIR, 'report.json')}")
+    return 1
+
+def forward_to_daemon(argv):
+    """常驻进程运行时将命令转发给它执行并输出结果，返回退出码
+
+    常驻进程未运行、无法连接或设置了FP_NO_DAEMON时返回None，由调用方在本进程执行。
+    """
+    if os.environ.get("FP_NO_DAEMON") or not os.path.exists(DAEMON_SOCKET_FILE):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(DAEMON_SOCKET_FILE)
+    except OSError:
+        client.close()
+        return None
+    
+    request = {
+        "argv": argv,
+        "cwd": os.getcwd(),
+        # check-compile、bisect --test-cmd等会启动子进程，需要客户端的PATH和编译器相关变量
+        "env": dict(os.environ)
+    }
+    with client, client.makefile("rwb") as stream:
+        stream.write(json.dumps(request, ensure_ascii=False).encode("utf-8") + b"\n")
+        stream.flush()
+        for line in stream:
+            message = json.loads(line)
+            if "out" in message:
+                sys.stdout.write(message["out"])
+                sys.stdout.flush()
+            elif "exit" in message:
+                return message["exit"]
+    print("警告: 常驻进程连接中断，命令可能未完成")
+    return 1
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Chromium指纹补丁管理系统")
+    parser.add_argument("--trace", metavar="OUT_JSON", help="将各阶段耗时写入Chrome trace-event JSON（可用Perfetto查看）")
     subparsers = parser.add_subparsers(dest="command", help="子命令")
     
     # 创建目录结构命令
@@ -525,6 +2910,42 @@ def main():
     apply_parser = subparsers.add_parser("apply", help="应用指纹补丁")
     apply_parser.add_argument("--config", help="指纹配置文件路径")
     apply_parser.add_argument("--random", action="store_true", help="使用随机指纹配置")
+    apply_parser.add_argument("--jobs", "-j", type=int, default=1, help="并发处理的目标文件数（默认1）")
+    apply_parser.add_argument("--backup-mode", choices=BACKUP_MODES, help="备份模式（默认blob）")
+    apply_parser.add_argument("--resume", action="store_true", help="继续被中断的应用事务")
+    apply_parser.add_argument("--plan", help="按plan命令生成的计划文件应用")
+    apply_parser.add_argument("--ignore-conflicts", action="store_true", help="不按兼容性矩阵拒绝冲突的补丁组合")
+    apply_parser.add_argument("--refresh-backup", action="store_true",
+                              help="目标文件已偏离时，将当前内容作为新的原始内容重新备份后再应用")
+    apply_parser.add_argument("--bundle", help="从补丁包读取补丁和映射表（只提取需要的补丁）")
+    
+    # 预检计划命令
+    plan_parser = subparsers.add_parser("plan", help="校验配置并检查补丁能否应用（不修改src）")
+    plan_parser.add_argument("--config", required=True, help="指纹配置文件路径")
+    plan_parser.add_argument("--output", "-o", help="保存计划文件的路径，供apply --plan使用")
+    plan_parser.add_argument("--json", action="store_true", help="以JSON格式输出计划")
+    plan_parser.add_argument("--jobs", "-j", type=int, default=4, help="并发检查的目标文件数（默认4）")
+    
+    # 切换配置命令
+    switch_parser = subparsers.add_parser("switch", help="以最小改动切换到新的指纹配置")
+    switch_parser.add_argument("--config", help="新的指纹配置文件路径")
+    switch_parser.add_argument("--jobs", "-j", type=int, default=1, help="并发处理的目标文件数（默认1）")
+    switch_parser.add_argument("--backup-mode", choices=BACKUP_MODES, help="备份模式（默认blob）")
+    switch_parser.add_argument("--resume", action="store_true", help="继续被中断的切换事务")
+    switch_parser.add_argument("--ignore-conflicts", action="store_true", help="不按兼容性矩阵拒绝冲突的补丁组合")
+    switch_parser.add_argument("--refresh-backup", action="store_true",
+                               help="目标文件已偏离时，将当前内容作为新的原始内容重新备份后再切换")
+    switch_parser.add_argument("--bundle", help="从补丁包读取补丁和映射表（只提取需要的补丁）")
+    
+    # 构建变体目录命令
+    overlay_parser = subparsers.add_parser("overlay", help="在独立的变体目录中应用补丁（不修改src）")
+    overlay_parser.add_argument("--config", help="指纹配置文件路径")
+    overlay_parser.add_argument("--random", action="store_true", help="使用随机指纹配置")
+    overlay_parser.add_argument("--dir", help="变体目录（默认overlays/<fingerprint_id>）")
+    overlay_parser.add_argument("--method", choices=["shadow", "worktree"], default="shadow",
+                                help="shadow: 符号链接影子树；worktree: git worktree")
+    overlay_parser.add_argument("--jobs", "-j", type=int, default=1, help="并发处理的目标文件数（默认1）")
+    overlay_parser.add_argument("--bundle", help="从补丁包读取补丁和映射表（只提取需要的补丁）")
     
     # 还原补丁命令
     restore_parser = subparsers.add_parser("restore", help="还原已应用的补丁")
@@ -532,20 +2953,160 @@ def main():
     # 生成补丁命令
     generate_parser = subparsers.add_parser("generate", help="生成新的补丁")
     generate_parser.add_argument("--name", required=True, help="补丁名称")
-    generate_parser.add_argument("--category", required=True, choices=FINGERPRINT_CATEGORIES, help="指纹类别")
-    generate_parser.add_argument("--file", required=True, help="要生成补丁的文件路径（相对于src目录）")
-    generate_parser.add_argument("--mode", required=True, help="补丁模式（例如：custom, random）")
+    generate_parser.add_argument("--category", nargs="+", choices=FINGERPRINT_CATEGORIES,
+                                 help="指纹类别（--all模式下可指定多个，默认全部类别）")
+    generate_parser.add_argument("--file", help="要生成补丁的文件路径（相对于src目录）")
+    generate_parser.add_argument("--mode", required=True, choices=PATCH_MODES, help="补丁模式")
+    generate_parser.add_argument("--modified", action="store_true", help="文件已修改完成，生成补丁")
+    generate_parser.add_argument("--all", action="store_true", help="为所有相对备份有改动的映射文件批量生成补丁")
+    generate_parser.add_argument("--jobs", "-j", type=int, default=4, help="批量生成时的并发数（默认4）")
+    
+    # 补丁变基命令
+    rebase_parser = subparsers.add_parser("rebase", help="将补丁从旧版源码迁移到新版源码")
+    rebase_parser.add_argument("--from-src", required=True, help="补丁当前对应的旧版源码目录")
+    rebase_parser.add_argument("--to-src", required=True, help="新版源码目录")
+    rebase_parser.add_argument("--output", "-o", help="刷新后补丁的输出目录（默认patches_rebased）")
+    rebase_parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count() or 4, help="并发处理的补丁数")
+    
+    # 兼容性矩阵命令
+    conflicts_parser = subparsers.add_parser("conflicts", help="计算修改同一文件的补丁两两之间的兼容性矩阵")
+    conflicts_parser.add_argument("--json", action="store_true", help="以JSON格式输出完整矩阵")
+    conflicts_parser.add_argument("--jobs", "-j", type=int, default=4, help="并发检查数（默认4）")
+    
+    # 检查文件状态命令
+    status_parser = subparsers.add_parser("status", help="检查映射文件是原始、已打补丁、已偏离还是缺失")
+    status_parser.add_argument("--json", action="store_true", help="以JSON格式输出")
+    status_parser.add_argument("--verbose", "-v", action="store_true", help="同时列出原始状态的文件")
+    status_parser.add_argument("--jobs", "-j", type=int, default=4, help="并发计算哈希的线程数（默认4）")
+    
+    # 查看应用历史命令
+    history_parser = subparsers.add_parser("history", help="查看补丁应用历史")
+    history_parser.add_argument("--limit", "-n", type=int, default=20, help="显示的记录数（默认20）")
+    history_parser.add_argument("--file", help="只显示修改过该文件的记录（相对于src目录）")
+    
+    # 补丁包命令
+    bundle_parser = subparsers.add_parser("bundle", help="补丁包的打包、解包与校验")
+    bundle_subparsers = bundle_parser.add_subparsers(dest="bundle_command", help="补丁包操作")
+    pack_parser = bundle_subparsers.add_parser("pack", help="将patches目录和映射表打包为单个文件")
+    pack_parser.add_argument("--output", "-o", required=True, help="补丁包输出路径")
+    unpack_parser = bundle_subparsers.add_parser("unpack", help="解出补丁包中的全部补丁")
+    unpack_parser.add_argument("bundle_file", help="补丁包路径")
+    unpack_parser.add_argument("--output", "-o", help="输出目录（默认patches目录）")
+    verify_parser = bundle_subparsers.add_parser("verify", help="校验补丁包的完整性并输出哈希")
+    verify_parser.add_argument("bundle_file", help="补丁包路径")
+    
+    # 源码路径索引命令
+    index_src_parser = subparsers.add_parser("index-src", help="并行遍历源码目录，生成或增量刷新路径索引")
+    index_src_parser.add_argument("--jobs", "-j", type=int, default=8, help="并发扫描目录的线程数（默认8）")
+    verify_mappings_parser = subparsers.add_parser("verify-mappings", help="按路径索引检查映射表中的路径是否存在")
+    verify_mappings_parser.add_argument("--json", action="store_true", help="以JSON格式输出")
+    verify_mappings_parser.add_argument("--refresh", action="store_true", help="检查前先增量刷新路径索引")
+    verify_mappings_parser.add_argument("--jobs", "-j", type=int, default=8, help="刷新索引时的扫描线程数（默认8）")
+    
+    # 构建图集成命令
+    gen_build_parser = subparsers.add_parser("gen-build", help="生成ninja规则，由ninja增量执行补丁步骤")
+    gen_build_parser.add_argument("--config", required=True, help="指纹配置文件路径")
+    gen_build_parser.add_argument("--out-dir", help=f"ninja out目录，相对于src目录（默认{DEFAULT_OUT_DIR}）")
+    gen_build_parser.add_argument("--output", "-o", help="ninja规则的输出目录（默认build_rules）")
+    gen_build_parser.add_argument("--jobs", "-j", type=int, default=4, help="补丁步骤并发处理的目标文件数（默认4）")
+    ninja_apply_parser = subparsers.add_parser("ninja-apply", help="由ninja调用的补丁步骤（切换配置并写出depfile）")
+    ninja_apply_parser.add_argument("--config", required=True, help="指纹配置文件路径")
+    ninja_apply_parser.add_argument("--stamp", required=True, help="stamp文件路径（构建图中的输出）")
+    ninja_apply_parser.add_argument("--depfile", required=True, help="depfile路径")
+    ninja_apply_parser.add_argument("--jobs", "-j", type=int, default=4, help="并发处理的目标文件数（默认4）")
+    
+    # 编译检查命令
+    check_compile_parser = subparsers.add_parser("check-compile", help="只编译受补丁影响的翻译单元，按补丁报告编译结果")
+    check_compile_parser.add_argument("--config", required=True, help="指纹配置文件路径")
+    check_compile_parser.add_argument("--out-dir", help=f"包含compile_commands.json的out目录，相对于src目录（默认{DEFAULT_OUT_DIR}）")
+    check_compile_parser.add_argument("--jobs", "-j", type=int, default=8, help="并发编译数（默认8）")
+    check_compile_parser.add_argument("--max-per-header", type=int, default=2,
+                                      help="每个被修改的头文件最多额外编译的翻译单元数（默认2）")
+    check_compile_parser.add_argument("--timeout", type=int, help="单个翻译单元的编译超时秒数")
+    check_compile_parser.add_argument("--json", action="store_true", help="以JSON格式输出")
+    check_compile_parser.add_argument("--bundle", help="从补丁包读取补丁和映射表（只提取需要的补丁）")
+    
+    # 补丁二分定位命令
+    bisect_parser = subparsers.add_parser("bisect", help="查找使测试命令失败的最小补丁子集")
+    bisect_parser.add_argument("--config", required=True, help="指纹配置文件路径")
+    bisect_parser.add_argument("--test-cmd", required=True,
+                               help="在变体目录中执行的测试命令，返回非0表示失败（环境变量FP_OVERLAY_DIR为变体目录）")
+    bisect_parser.add_argument("--jobs", "-j", type=int, default=4, help="并行测试的子集数（默认4）")
+    bisect_parser.add_argument("--timeout", type=int, help="单次测试的超时秒数，超时视为失败")
+    bisect_parser.add_argument("--bundle", help="从补丁包读取补丁和映射表（只提取需要的补丁）")
+    
+    # 估算重建代价命令
+    estimate_parser = subparsers.add_parser("estimate", help="根据ninja构建记录估算配置变化引发的重新编译")
+    estimate_parser.add_argument("--config", help="目标指纹配置文件（不指定时按类别估算修改全部目标文件的代价）")
+    estimate_parser.add_argument("--from-config", help="起始指纹配置文件（默认为源码树当前生效的补丁）")
+    estimate_parser.add_argument("--out-dir", help=f"ninja out目录，相对于src目录（默认{DEFAULT_OUT_DIR}）")
+    estimate_parser.add_argument("--json", action="store_true", help="以JSON格式输出")
     
     # 生成配置模板命令
     template_parser = subparsers.add_parser("template", help="生成指纹配置模板")
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     
+    global BACKUP_MODE
+    BACKUP_MODE = getattr(args, "backup_mode", None) or os.environ.get('FP_BACKUP_MODE', 'blob')
+    
+    close_bundle()
+    if getattr(args, "bundle", None):
+        try:
+            open_bundle(args.bundle)
+        except (OSError, patch_bundle.BundleError) as e:
+            print(f"错误: 无法打开补丁包: {e}")
+            return 1
+    
+    if args.trace:
+        trace_events.start(args.trace, "patch_manager")
+    try:
+        with trace_events.span(args.command or "help", cat="command"):
+            return dispatch_command(args, parser, bundle_parser)
+    finally:
+        if args.trace:
+            trace_events.stop()
+            print(f"已写入trace: {args.trace}")
+
+def dispatch_command(args, parser, bundle_parser):
+    """执行解析后的子命令，返回退出码"""
     if args.command == "create_structure":
         setup_directories()
         generate_config_template()
     
     elif args.command == "apply":
+        if args.random:
+            config_file = create_random_config()
+        elif args.config:
+            config_file = args.config
+        elif args.resume or args.plan:
+            config_file = None
+        else:
+            print("错误: 必须指定配置文件路径或使用--random参数")
+            return 1
+        
+        if not apply_fingerprint_patches(config_file, jobs=args.jobs, resume=args.resume, plan_file=args.plan,
+                                         ignore_conflicts=args.ignore_conflicts, refresh_backup=args.refresh_backup):
+            return 1
+    
+    elif args.command == "rebase":
+        return rebase_all_patches(args.from_src, args.to_src, args.output, jobs=args.jobs)
+    
+    elif args.command == "conflicts":
+        return show_conflicts(as_json=args.json, jobs=args.jobs)
+    
+    elif args.command == "plan":
+        return show_plan(args.config, args.output, as_json=args.json, jobs=args.jobs)
+    
+    elif args.command == "switch":
+        if not args.config and not args.resume:
+            print("错误: 必须指定配置文件路径或使用--resume参数")
+            return 1
+        if not switch_fingerprint_config(args.config, jobs=args.jobs, resume=args.resume,
+                                         ignore_conflicts=args.ignore_conflicts, refresh_backup=args.refresh_backup):
+            return 1
+    
+    elif args.command == "overlay":
         if args.random:
             config_file = create_random_config()
         elif args.config:
@@ -554,12 +3115,22 @@ def main():
             print("错误: 必须指定配置文件路径或使用--random参数")
             return 1
         
-        apply_fingerprint_patches(config_file)
+        materialize_overlay(config_file, args.dir, method=args.method, jobs=args.jobs)
     
     elif args.command == "restore":
-        restore_all_patches()
+        if restore_all_patches() is None:
+            return 1
     
     elif args.command == "generate":
+        if args.all:
+            generate_all_patches(args.name, args.mode, args.category, jobs=args.jobs)
+            return 0
+        
+        if not args.file or not args.category or len(args.category) != 1:
+            print("错误: 单文件模式必须指定--file和一个--category")
+            return 1
+        args.category = args.category[0]
+        
         # 构建完整的文件路径
         target_file = os.path.join(SRC_DIR, args.file)
         if not os.path.exists(target_file):
@@ -567,16 +3138,59 @@ def main():
             return 1
         
         # 备份原始文件
-        backup_file = backup_original_file(target_file)
+        backup_file = pristine_file_path(target_file)
         
         print(f"请修改文件 {target_file} 后再次运行此命令以生成补丁")
         print(f"修改完成后，运行: python {sys.argv[0]} generate --name={args.name} --category={args.category} --file={args.file} --mode={args.mode} --modified")
         
         # 检查是否已修改
-        if hasattr(args, "modified") and args.modified:
+        if args.modified:
             patch_name = f"{args.mode}_{args.name}"
             generate_patch(backup_file, target_file, patch_name, args.category)
     
+    elif args.command == "status":
+        return show_status(as_json=args.json, verbose=args.verbose, jobs=args.jobs)
+    
+    elif args.command == "history":
+        show_history(args.limit, args.file)
+    
+    elif args.command == "bundle":
+        if args.bundle_command == "verify":
+            return verify_bundle(args.bundle_file)
+        try:
+            if args.bundle_command == "pack":
+                pack_bundle(args.output)
+            elif args.bundle_command == "unpack":
+                unpack_bundle(args.bundle_file, args.output)
+            else:
+                bundle_parser.print_help()
+                return 1
+        except (OSError, patch_bundle.BundleError) as e:
+            print(f"错误: {e}")
+            return 1
+    
+    elif args.command == "index-src":
+        return index_source_tree(args.jobs)
+    
+    elif args.command == "verify-mappings":
+        return verify_mappings(as_json=args.json, refresh=args.refresh, jobs=args.jobs)
+    
+    elif args.command == "gen-build":
+        return generate_build_rules(args.config, args.out_dir, args.output, jobs=args.jobs)
+    
+    elif args.command == "ninja-apply":
+        return ninja_apply(args.config, args.stamp, args.depfile, jobs=args.jobs)
+    
+    elif args.command == "check-compile":
+        return check_compile(args.config, args.out_dir, jobs=args.jobs, max_per_header=args.max_per_header,
+                             timeout=args.timeout, as_json=args.json)
+    
+    elif args.command == "bisect":
+        return bisect_patches(args.config, args.test_cmd, jobs=args.jobs, timeout=args.timeout)
+    
+    elif args.command == "estimate":
+        return estimate_rebuild(args.config, args.from_config, args.out_dir, as_json=args.json)
+    
     elif args.command == "template":
         generate_config_template()
     
@@ -587,4 +3201,8 @@ def main():
     return 0
 
 if __name__ == "__main__":
-    sys.exit(main())
\ No newline at end of file
+    try:
+        exit_code = forward_to_daemon(sys.argv[1:])
+        sys.exit(main() if exit_code is None else exit_code)
+    except KeyboardInterrupt:
+        sys.exit(130)
\ No newline at end of file
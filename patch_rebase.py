@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+补丁批量变基
+
+将针对旧版Chromium源码生成的补丁迁移到新版源码，对每个补丁的每个目标文件：
+1. 新旧版本中目标文件内容哈希相同：补丁无需改动，直接沿用
+2. 补丁能应用到旧版本：以旧版本为共同祖先，用 git merge-file 做三方合并，
+   合并无冲突时基于新版本重新生成补丁
+3. 补丁无法应用到旧版本（补丁本身已与旧版本不一致）：直接在新版本上
+   应用（允许行偏移），成功时重新生成补丁；上下文不完全匹配时再忽略
+   至多REVIEW_FUZZ行首尾上下文，这样生成的补丁标记为需要人工确认；
+   三方合并冲突时，只接受上下文完全匹配的直接应用结果
+4. 其他情况记为冲突，带冲突标记的合并结果保存下来供手工处理
+
+各补丁之间相互独立，在线程池中并行处理。
+"""
+
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+
+import diff_engine
+
+# 每个目标文件的处理结果
+STATUS_UNCHANGED = "unchanged"   # 上游内容未变化
+STATUS_MERGED = "merged"         # 三方合并成功
+STATUS_REAPPLIED = "reapplied"   # 在新版本上直接应用成功（上下文完全匹配）
+STATUS_REVIEW = "review"         # 忽略部分上下文后才能应用，需要人工确认
+STATUS_CONFLICT = "conflict"     # 需要手工处理
+
+# 直接应用失败时允许忽略的首尾上下文行数
+REVIEW_FUZZ = 2
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def merge_file(current, base, other):
+    """调用 git merge-file 做三方合并，返回(合并结果, 是否有冲突)
+
+    current为新版本内容，base为旧版本内容，other为旧版本应用补丁后的内容。
+    """
+    with tempfile.TemporaryDirectory(prefix="fp_rebase_") as tmp_dir:
+        paths = []
+        for name, data in (("current", current), ("base", base), ("other", other)):
+            path = os.path.join(tmp_dir, name)
+            with open(path, "wb") as f:
+                f.write(data)
+            paths.append(path)
+        result = subprocess.run(
+            ["git", "merge-file", "-p", "-L", "new", "-L", "old", "-L", "patched"] + paths,
+            capture_output=True)
+    if result.returncode < 0 or result.returncode > 127:
+        raise OSError(f"git merge-file 执行失败: {result.stderr.decode('utf-8', errors='replace')}")
+    return result.stdout, result.returncode != 0
+
+
+def rebase_target(file_patch, rel_path, from_src, to_src):
+    """变基单个目标文件，返回(状态, 新补丁文本或None, 说明, 冲突内容或None)"""
+    old_path = os.path.join(from_src, rel_path)
+    new_path = os.path.join(to_src, rel_path)
+    if not os.path.isfile(new_path):
+        return STATUS_CONFLICT, None, "目标文件在新版本中不存在", None
+    new_data = _read(new_path)
+    old_data = _read(old_path) if os.path.isfile(old_path) else None
+
+    if old_data is not None and hashlib.sha256(old_data).digest() == hashlib.sha256(new_data).digest():
+        return STATUS_UNCHANGED, None, "", None
+
+    patched_old = None
+    if old_data is not None:
+        try:
+            patched_old = diff_engine.apply_to_bytes(old_data, file_patch)
+        except (diff_engine.PatchError, UnicodeError):
+            patched_old = None
+
+    if patched_old is not None:
+        try:
+            merged, conflicted = merge_file(new_data, old_data, patched_old)
+        except OSError as e:
+            merged, conflicted = None, True
+            reason = str(e)
+        else:
+            reason = "三方合并存在冲突"
+        if merged is not None and not conflicted:
+            return STATUS_MERGED, diff_engine.make_patch(new_data, merged, rel_path), "", None
+        # 合并冲突时，只接受上下文完全匹配（允许行偏移、不允许fuzz）的直接应用
+        try:
+            patched_new = diff_engine.apply_to_bytes(new_data, file_patch, fuzz=0)
+        except (diff_engine.PatchError, UnicodeError):
+            return STATUS_CONFLICT, None, reason, merged
+        return STATUS_REAPPLIED, diff_engine.make_patch(new_data, patched_new, rel_path), "", None
+
+    # 补丁无法应用到旧版本，尝试直接在新版本上应用
+    try:
+        patched_new = diff_engine.apply_to_bytes(new_data, file_patch)
+    except (diff_engine.PatchError, UnicodeError):
+        pass
+    else:
+        return STATUS_REAPPLIED, diff_engine.make_patch(new_data, patched_new, rel_path), "", None
+    try:
+        patched_new = diff_engine.apply_to_bytes(new_data, file_patch, fuzz=REVIEW_FUZZ)
+    except (diff_engine.PatchError, UnicodeError) as e:
+        return STATUS_CONFLICT, None, f"补丁无法应用到旧版本，也无法应用到新版本: {e}", None
+    return (STATUS_REVIEW, diff_engine.make_patch(new_data, patched_new, rel_path),
+            f"忽略了部分上下文（fuzz {REVIEW_FUZZ}）才能应用，请确认补丁块位置", None)
+
+
+def rebase_patch(patch_file, from_src, to_src):
+    """变基一个补丁文件（可能包含多个目标文件）
+
+    返回{"patch_file", "status", "targets": [...], "content"}。所有目标文件都无需
+    改动时status为unchanged、content为None；任一目标冲突时status为conflict。
+    """
+    with open(patch_file, "r", encoding="utf-8", errors="surrogateescape") as f:
+        file_patches = diff_engine.parse_patch(f.read())
+
+    targets = []
+    pieces = []
+    changed = False
+    for file_patch in file_patches:
+        rel_path = file_patch.path
+        try:
+            status, text, detail, conflict_content = rebase_target(file_patch, rel_path, from_src, to_src)
+        except OSError as e:
+            status, text, detail, conflict_content = STATUS_CONFLICT, None, str(e), None
+        targets.append({
+            "target": rel_path,
+            "status": status,
+            "detail": detail,
+            "conflict_content": conflict_content
+        })
+        if status == STATUS_UNCHANGED:
+            # 上游未变化，原补丁内容仍然有效
+            pieces.append(None)
+        else:
+            changed = True
+            pieces.append(text)
+
+    if changed and not any(t["status"] == STATUS_CONFLICT for t in targets):
+        # 部分目标未变化：未变化的目标从新版本内容重新生成，保证补丁完整
+        for i, (file_patch, target) in enumerate(zip(file_patches, targets)):
+            if pieces[i] is not None:
+                continue
+            try:
+                data = _read(os.path.join(to_src, file_patch.path))
+                pieces[i] = diff_engine.make_patch(data, diff_engine.apply_to_bytes(data, file_patch),
+                                                   file_patch.path)
+            except (diff_engine.PatchError, UnicodeError, OSError) as e:
+                target["status"] = STATUS_CONFLICT
+                target["detail"] = f"无法在新版本上重新生成补丁: {e}"
+
+    if not file_patches:
+        status = STATUS_CONFLICT
+        targets.append({"target": None, "status": STATUS_CONFLICT, "detail": "补丁中没有文件改动",
+                        "conflict_content": None})
+    elif any(t["status"] == STATUS_CONFLICT for t in targets):
+        status = STATUS_CONFLICT
+    elif not changed:
+        status = STATUS_UNCHANGED
+    elif any(t["status"] == STATUS_REVIEW for t in targets):
+        status = STATUS_REVIEW
+    elif any(t["status"] == STATUS_REAPPLIED for t in targets):
+        status = STATUS_REAPPLIED
+    else:
+        status = STATUS_MERGED
+
+    content = "".join(pieces) if status in (STATUS_MERGED, STATUS_REAPPLIED, STATUS_REVIEW) else None
+    return {"patch_file": patch_file, "status": status, "targets": targets, "content": content}
+
+
+def write_rebased(result, patches_dir, output_dir):
+    """将变基结果写入output_dir（保持类别目录结构），返回写入的补丁路径
+
+    未变化的补丁原样复制；冲突的补丁不写入新补丁，带冲突标记的合并结果
+    保存在output_dir/conflicts/下。
+    """
+    rel_patch = os.path.relpath(result["patch_file"], patches_dir)
+    dest = os.path.join(output_dir, rel_patch)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+    if result["status"] == STATUS_CONFLICT:
+        for target in result["targets"]:
+            if target["conflict_content"] is None:
+                continue
+            conflict_file = os.path.join(output_dir, "conflicts", rel_patch, target["target"])
+            os.makedirs(os.path.dirname(conflict_file), exist_ok=True)
+            with open(conflict_file, "wb") as f:
+                f.write(target["conflict_content"])
+            target["conflict_file"] = conflict_file
+        return None
+
+    if result["content"] is None:
+        if os.path.abspath(result["patch_file"]) != os.path.abspath(dest):
+            shutil.copyfile(result["patch_file"], dest)
+        return dest
+
+    tmp_path = f"{dest}.tmp"
+    with open(tmp_path, "w", encoding="utf-8", errors="surrogateescape", newline="") as f:
+        f.write(result["content"])
+    os.replace(tmp_path, dest)
+    return dest
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+源码树路径索引
+
+并行遍历源码目录一次，将全部目录和文件保存为紧凑、有序、可直接mmap查询的
+二进制索引，用于快速校验映射表中的路径。
+
+文件布局（整数均为小端）：
+  头部      魔数 b"FPSRCIDX"、版本、目录数、文件数、字符串区长度
+  目录表    按目录相对路径字节序排列，每项(路径偏移, 路径长度, mtime_ns, 首个文件序号, 文件数)
+  文件表    按所在目录在目录表中的顺序分组、组内按文件名排序，每项(名称偏移, 名称长度, 大小)
+  字符串区  目录路径和文件名（UTF-8，surrogateescape）
+
+查找一个路径时先在目录表中二分查找所在目录，再在该目录的文件范围内二分查找
+文件名，只会访问映射中的少数几页。
+
+增量刷新：逐层并行stat目录，mtime与索引一致的目录直接沿用索引中的文件列表
+和子目录，只有mtime变化（增删或重命名了直接子项）的目录才重新scandir。目录内
+文件被原地修改时目录mtime不变，因此索引中的文件大小可能过时，需要准确大小时
+应重新stat。
+"""
+
+import difflib
+import mmap
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+MAGIC = b"FPSRCIDX"
+VERSION = 1
+
+_HEADER = struct.Struct("<8sIIIQ")
+_DIR = struct.Struct("<IIqII")
+_FILE = struct.Struct("<IIQ")
+
+# 不纳入索引的目录（任意层级）
+SKIP_DIR_NAMES = {".git", ".svn", "__pycache__"}
+# 只在源码根目录下跳过的目录（构建输出）
+SKIP_TOP_DIRS = {"out"}
+
+
+def _encode(path):
+    return path.encode("utf-8", errors="surrogateescape")
+
+
+def _decode(data):
+    return data.decode("utf-8", errors="surrogateescape")
+
+
+def _scan_dir(src_dir, rel_dir):
+    """扫描一个目录，返回(mtime_ns, [(文件名, 大小), ...], [子目录相对路径, ...])"""
+    path = os.path.join(src_dir, rel_dir) if rel_dir else src_dir
+    files = []
+    subdirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name in SKIP_DIR_NAMES or (not rel_dir and entry.name in SKIP_TOP_DIRS):
+                        continue
+                    subdirs.append(f"{rel_dir}/{entry.name}" if rel_dir else entry.name)
+                elif entry.is_file():
+                    files.append((entry.name, entry.stat().st_size))
+            except OSError:
+                continue
+    return os.stat(path).st_mtime_ns, files, subdirs
+
+
+class SrcIndex(object):
+    """以mmap方式打开的路径索引"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.dir_count, self.file_count, strings_size = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError(f"不是有效的源码路径索引: {path}")
+        self._dirs_start = _HEADER.size
+        self._files_start = self._dirs_start + self.dir_count * _DIR.size
+        self._strings_start = self._files_start + self.file_count * _FILE.size
+        if self._strings_start + strings_size != len(self._map):
+            self._map.close()
+            raise ValueError(f"源码路径索引不完整: {path}")
+
+    def close(self):
+        self._map.close()
+
+    def _string(self, offset, length):
+        start = self._strings_start + offset
+        return self._map[start:start + length]
+
+    def _dir(self, i):
+        path_off, path_len, mtime_ns, first, count = _DIR.unpack_from(self._map, self._dirs_start + i * _DIR.size)
+        return self._string(path_off, path_len), mtime_ns, first, count
+
+    def _file(self, i):
+        name_off, name_len, size = _FILE.unpack_from(self._map, self._files_start + i * _FILE.size)
+        return self._string(name_off, name_len), size
+
+    def _find_dir(self, rel_dir):
+        """二分查找目录，返回目录序号或None"""
+        key = _encode(rel_dir)
+        lo, hi = 0, self.dir_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._dir(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.dir_count and self._dir(lo)[0] == key:
+            return lo
+        return None
+
+    def has_dir(self, rel_dir):
+        return self._find_dir(rel_dir.replace("\\", "/").strip("/")) is not None
+
+    def lookup(self, rel_path):
+        """返回文件大小，文件不在索引中时返回None"""
+        rel_dir, name = os.path.split(rel_path.replace("\\", "/"))
+        i = self._find_dir(rel_dir.replace("\\", "/"))
+        if i is None:
+            return None
+        _, _, first, count = self._dir(i)
+        key = _encode(name)
+        lo, hi = first, first + count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._file(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < first + count:
+            found, size = self._file(lo)
+            if found == key:
+                return size
+        return None
+
+    def dir_files(self, rel_dir):
+        """目录中的文件[(文件名, 大小), ...]，目录不在索引中时返回None"""
+        i = self._find_dir(rel_dir.replace("\\", "/").strip("/"))
+        if i is None:
+            return None
+        _, _, first, count = self._dir(i)
+        return [(_decode(name), size) for name, size in (self._file(j) for j in range(first, first + count))]
+
+    def iter_dirs(self):
+        """按顺序返回(目录相对路径, mtime_ns, [(文件名, 大小), ...])"""
+        for i in range(self.dir_count):
+            path, mtime_ns, first, count = self._dir(i)
+            yield _decode(path), mtime_ns, [
+                (_decode(name), size) for name, size in (self._file(j) for j in range(first, first + count))
+            ]
+
+    def find_basenames(self, names):
+        """在整个索引中查找同名文件，返回{文件名: [相对路径, ...]}"""
+        wanted = {_encode(name): name for name in names}
+        result = {}
+        for i in range(self.dir_count):
+            path, _, first, count = self._dir(i)
+            for j in range(first, first + count):
+                name = self._file(j)[0]
+                if name in wanted:
+                    rel_dir = _decode(path)
+                    name = wanted[name]
+                    result.setdefault(name, []).append(f"{rel_dir}/{name}" if rel_dir else name)
+        return result
+
+
+def write_index(index_path, dirs):
+    """写入索引，dirs为{目录相对路径: (mtime_ns, [(文件名, 大小), ...])}"""
+    strings = bytearray()
+    offsets = {}
+
+    def intern(data):
+        offset = offsets.get(data)
+        if offset is None:
+            offset = offsets[data] = len(strings)
+            strings.extend(data)
+        return offset
+
+    dir_records = []
+    file_records = []
+    for rel_dir in sorted(dirs, key=_encode):
+        mtime_ns, files = dirs[rel_dir]
+        path = _encode(rel_dir)
+        first = len(file_records)
+        for name, size in sorted(files, key=lambda item: _encode(item[0])):
+            data = _encode(name)
+            file_records.append(_FILE.pack(intern(data), len(data), size))
+        dir_records.append(_DIR.pack(intern(path), len(path), mtime_ns, first, len(file_records) - first))
+
+    tmp_path = f"{index_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(dir_records), len(file_records), len(strings)))
+        f.write(b"".join(dir_records))
+        f.write(b"".join(file_records))
+        f.write(strings)
+    os.replace(tmp_path, index_path)
+
+
+def build_index(src_dir, index_path, jobs=8):
+    """遍历src_dir并写入索引，已有索引时只重新扫描mtime变化的目录
+
+    返回{"dirs": 目录数, "files": 文件数, "scanned": 重新扫描的目录数}。
+    """
+    # 旧索引: 目录 -> (mtime_ns, 文件列表)，以及父目录 -> 子目录列表
+    old = {}
+    children = {}
+    if os.path.exists(index_path):
+        try:
+            index = SrcIndex(index_path)
+        except (OSError, ValueError):
+            index = None
+        if index is not None:
+            try:
+                for rel_dir, mtime_ns, files in index.iter_dirs():
+                    old[rel_dir] = (mtime_ns, files)
+                    if rel_dir:
+                        children.setdefault(os.path.dirname(rel_dir), []).append(rel_dir)
+            finally:
+                index.close()
+
+    def visit(rel_dir):
+        path = os.path.join(src_dir, rel_dir) if rel_dir else src_dir
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        cached = old.get(rel_dir)
+        if cached and cached[0] == mtime_ns:
+            return mtime_ns, cached[1], children.get(rel_dir, []), False
+        try:
+            mtime_ns, files, subdirs = _scan_dir(src_dir, rel_dir)
+        except OSError:
+            return None
+        return mtime_ns, files, subdirs, True
+
+    dirs = {}
+    scanned = 0
+    level = [""]
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        # 逐层并行处理，每层的子目录组成下一层
+        while level:
+            next_level = []
+            for rel_dir, result in zip(level, executor.map(visit, level)):
+                if result is None:
+                    continue
+                mtime_ns, files, subdirs, rescanned = result
+                dirs[rel_dir] = (mtime_ns, files)
+                scanned += rescanned
+                next_level.extend(subdirs)
+            level = next_level
+
+    write_index(index_path, dirs)
+    return {"dirs": len(dirs), "files": sum(len(files) for _, files in dirs.values()), "scanned": scanned}
+
+
+def suggest(index, rel_path, same_name, limit=3):
+    """为不存在的路径推荐最接近的现有路径
+
+    优先在其他目录中查找同名文件，按路径相似度排序；没有同名文件时，在最近的
+    仍然存在的上级目录中按文件名相似度查找。
+    """
+    rel_path = rel_path.replace("\\", "/")
+    if same_name:
+        return sorted(same_name, key=lambda p: difflib.SequenceMatcher(None, rel_path, p).ratio(),
+                      reverse=True)[:limit]
+    rel_dir, name = os.path.split(rel_path)
+    while True:
+        files = index.dir_files(rel_dir)
+        if files is not None:
+            names = difflib.get_close_matches(name, [n for n, _ in files], n=limit, cutoff=0.6)
+            return [f"{rel_dir}/{n}" if rel_dir else n for n in names]
+        if not rel_dir:
+            return []
+        rel_dir = os.path.dirname(rel_dir)
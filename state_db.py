@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+补丁应用状态数据库
+
+以SQLite保存每次apply/switch的应用记录，替代configs目录下的
+applied_<id>.json / restored_<id>.json文件。所有查询都走索引：
+1. 查找最新的未还原记录：applies(restored, id)
+2. 查找所有未还原记录涉及的目标文件：applied_targets(apply_id)
+3. 查询某个目标文件的历史：applied_targets(target, apply_id)
+
+此外composed_results表缓存补丁组合结果：(原始内容哈希, 有序补丁哈希)的摘要
+-> 组合后内容在blob存储中的哈希。
+
+同一源码树上可能先后存在多条未还原的记录（例如对不同配置多次apply），
+restore会还原所有未还原记录涉及的文件，不再只处理最新的一条。
+
+首次打开数据库时，会将configs目录中已有的JSON记录导入数据库。
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS applies (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    fingerprint_id TEXT NOT NULL,
+    command TEXT NOT NULL,
+    applied_time TEXT NOT NULL,
+    restored INTEGER NOT NULL DEFAULT 0,
+    restored_time TEXT
+);
+CREATE INDEX IF NOT EXISTS applies_restored ON applies(restored, id);
+CREATE INDEX IF NOT EXISTS applies_fingerprint ON applies(fingerprint_id, id);
+CREATE TABLE IF NOT EXISTS applied_patches (
+    apply_id INTEGER NOT NULL REFERENCES applies(id),
+    seq INTEGER NOT NULL,
+    category TEXT NOT NULL,
+    target TEXT NOT NULL,
+    patch_file TEXT NOT NULL,
+    PRIMARY KEY (apply_id, seq)
+);
+CREATE TABLE IF NOT EXISTS applied_targets (
+    apply_id INTEGER NOT NULL REFERENCES applies(id),
+    target TEXT NOT NULL,
+    sha256 TEXT,
+    PRIMARY KEY (apply_id, target)
+);
+CREATE INDEX IF NOT EXISTS applied_targets_target ON applied_targets(target, apply_id);
+CREATE TABLE IF NOT EXISTS composed_results (
+    key TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    created TEXT NOT NULL
+);
+"""
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class StateDB(object):
+    """应用记录数据库，目标文件以相对于src目录的路径保存"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+            self._conn.execute("INSERT OR IGNORE INTO meta(key, value) VALUES ('schema_version', ?)",
+                               (str(SCHEMA_VERSION),))
+
+    def close(self):
+        self._conn.close()
+
+    # ----- 写入 -----
+
+    def add_apply(self, fingerprint_id, command, patches, target_hashes, applied_time=None, restored_time=None):
+        """新增一条应用记录，返回记录ID
+
+        patches为[(类别, 目标相对路径, 补丁文件), ...]，target_hashes为
+        {目标相对路径: 应用后的内容哈希或None}。
+        """
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO applies(fingerprint_id, command, applied_time, restored, restored_time) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (fingerprint_id, command, applied_time or _now(),
+                 1 if restored_time else 0, restored_time))
+            apply_id = cursor.lastrowid
+            self._conn.executemany(
+                "INSERT INTO applied_patches(apply_id, seq, category, target, patch_file) VALUES (?, ?, ?, ?, ?)",
+                [(apply_id, seq, category, target, patch_file)
+                 for seq, (category, target, patch_file) in enumerate(patches)])
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO applied_targets(apply_id, target, sha256) VALUES (?, ?, ?)",
+                [(apply_id, target, digest) for target, digest in target_hashes.items()])
+            return apply_id
+
+    def mark_restored(self, apply_ids):
+        """将记录标记为已还原"""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE applies SET restored = 1, restored_time = ? WHERE id = ?",
+                [(_now(), apply_id) for apply_id in apply_ids])
+
+    # ----- 查询 -----
+
+    def active_ids(self):
+        """所有未还原记录的ID，按应用顺序排列"""
+        with self._lock:
+            rows = self._conn.execute("SELECT id FROM applies WHERE restored = 0 ORDER BY id").fetchall()
+        return [row["id"] for row in rows]
+
+    def latest_active(self):
+        """最新的未还原记录，不存在时返回None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM applies WHERE restored = 0 ORDER BY id DESC LIMIT 1").fetchone()
+        return dict(row) if row else None
+
+    def get_apply(self, apply_id):
+        """读取完整的应用记录：{id, fingerprint_id, ..., patches, target_hashes}"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM applies WHERE id = ?", (apply_id,)).fetchone()
+            if row is None:
+                return None
+            record = dict(row)
+            record["patches"] = [
+                {"category": p["category"], "target": p["target"], "patch_file": p["patch_file"]}
+                for p in self._conn.execute(
+                    "SELECT category, target, patch_file FROM applied_patches WHERE apply_id = ? ORDER BY seq",
+                    (apply_id,))
+            ]
+            record["target_hashes"] = {
+                t["target"]: t["sha256"]
+                for t in self._conn.execute(
+                    "SELECT target, sha256 FROM applied_targets WHERE apply_id = ?", (apply_id,))
+            }
+        return record
+
+    def active_targets(self):
+        """所有未还原记录涉及的目标文件
+
+        返回{目标相对路径: (应用后的内容哈希, 记录ID, fingerprint_id)}，同一文件被
+        多条记录修改时以最后一条为准。
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT t.target, t.sha256, a.id, a.fingerprint_id "
+                "FROM applies a JOIN applied_targets t ON t.apply_id = a.id "
+                "WHERE a.restored = 0 ORDER BY a.id").fetchall()
+        return {row["target"]: (row["sha256"], row["id"], row["fingerprint_id"]) for row in rows}
+
+    def history(self, limit=20, target=None):
+        """按时间倒序返回最近的记录摘要，可按目标文件过滤"""
+        with self._lock:
+            if target is None:
+                rows = self._conn.execute(
+                    "SELECT a.*, (SELECT COUNT(*) FROM applied_patches p WHERE p.apply_id = a.id) AS patch_count "
+                    "FROM applies a ORDER BY a.id DESC LIMIT ?", (limit,)).fetchall()
+            else:
+                rows = self._conn.execute(
+                    "SELECT a.*, (SELECT COUNT(*) FROM applied_patches p WHERE p.apply_id = a.id) AS patch_count "
+                    "FROM applied_targets t JOIN applies a ON a.id = t.apply_id "
+                    "WHERE t.target = ? ORDER BY t.apply_id DESC LIMIT ?", (target, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    # ----- 补丁组合结果缓存 -----
+
+    def get_composed(self, key):
+        """查找补丁组合结果的内容哈希，未缓存时返回None"""
+        with self._lock:
+            row = self._conn.execute("SELECT sha256 FROM composed_results WHERE key = ?", (key,)).fetchone()
+        return row["sha256"] if row else None
+
+    def put_composed(self, key, sha256):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO composed_results(key, sha256, created) VALUES (?, ?, ?)",
+                               (key, sha256, _now()))
+
+    # ----- 旧版JSON记录导入 -----
+
+    def migrate_json_records(self, config_dir, src_dir):
+        """导入configs目录中旧版的applied_/restored_记录，只执行一次，返回导入条数"""
+        with self._lock:
+            done = self._conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone()
+        if done:
+            return 0
+
+        records = []
+        if os.path.isdir(config_dir):
+            for name in os.listdir(config_dir):
+                if not name.endswith(".json"):
+                    continue
+                if name.startswith("applied_"):
+                    restored = False
+                elif name.startswith("restored_"):
+                    restored = True
+                else:
+                    continue
+                path = os.path.join(config_dir, name)
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        record = json.load(f)
+                    records.append((os.path.getmtime(path), restored, record))
+                except (OSError, ValueError):
+                    continue
+
+        # 按文件修改时间顺序导入，保持记录的先后关系
+        for mtime, restored, record in sorted(records, key=lambda r: r[0]):
+            patches = [
+                (p["category"], os.path.relpath(p["target_file"], src_dir).replace(os.sep, "/"), p["patch_file"])
+                for p in record.get("patches", [])
+            ]
+            target_hashes = {target: None for _, target, _ in patches}
+            target_hashes.update(record.get("target_hashes", {}))
+            restored_time = datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M:%S") if restored else None
+            self.add_apply(record.get("fingerprint_id", "unknown"), "apply", patches, target_hashes,
+                           applied_time=record.get("applied_time"), restored_time=restored_time)
+
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('json_migrated', ?)", (_now(),))
+        return len(records)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+"""测试用的临时工作目录：将patch_manager的全局路径指向临时目录"""
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import patch_manager
+
+# 以BASE_DIR为基础的全局路径及其在临时目录中的名称
+_PATHS = {
+    "SRC_DIR": "src",
+    "PATCHES_DIR": "patches",
+    "CONFIG_DIR": "configs",
+    "BACKUP_DIR": "backups",
+    "OVERLAY_DIR": "overlays",
+    "PATCH_INDEX_FILE": "patches_index.json",
+    "FILE_STATE_INDEX_FILE": "file_state_index.json",
+    "APPLY_JOURNAL_FILE": "apply_journal.jsonl",
+    "STATE_DB_FILE": "state.db",
+    "PLAN_CACHE_FILE": "plan_cache.json",
+    "CONFLICT_MATRIX_FILE": "patch_conflicts.json",
+    "DAEMON_SOCKET_FILE": ".patch_daemon.sock",
+    "BUILD_HISTORY_FILE": "build_history.jsonl",
+    "BUNDLE_CACHE_DIR": "bundle_cache",
+    "SRC_INDEX_FILE": "src_index.bin",
+    "BUILD_RULES_DIR": "build_rules",
+    "CHECK_COMPILE_DIR": "check_compile",
+    "BISECT_DIR": "bisect",
+    "REBASED_PATCHES_DIR": "patches_rebased",
+}
+
+
+def make_patch(rel_path, old, new):
+    return patch_manager.diff_engine.make_patch(old.encode("utf-8"), new.encode("utf-8"), rel_path)
+
+
+class SandboxTestCase(unittest.TestCase):
+    """每个测试使用独立的src、patches、configs和备份目录"""
+
+    # {类别: [目标相对路径, ...]}
+    MAPPINGS = {}
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for name, rel in _PATHS.items():
+            patcher = mock.patch.object(patch_manager, name, os.path.join(self.root, rel))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(patch_manager, "PATCH_FILE_MAPPINGS", self.MAPPINGS)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for rel in ("src", "patches", "configs"):
+            os.makedirs(os.path.join(self.root, rel))
+        self.addCleanup(self._reset_caches)
+        self.addCleanup(shutil.rmtree, self.root, True)
+
+    def _reset_caches(self):
+        if patch_manager._STATE_DB is not None:
+            patch_manager._STATE_DB.close()
+            patch_manager._STATE_DB = None
+        if patch_manager._BLOB_STORE is not None:
+            patch_manager._BLOB_STORE.close()
+            patch_manager._BLOB_STORE = None
+        patch_manager._PARSED_PATCHES.clear()
+        patch_manager._PATCH_HASHES.clear()
+
+    def src_path(self, rel_path):
+        return os.path.join(patch_manager.SRC_DIR, rel_path)
+
+    def write_src(self, rel_path, text):
+        path = self.src_path(rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            f.write(text)
+        return path
+
+    def read_src(self, rel_path):
+        with open(self.src_path(rel_path), "r", encoding="utf-8", newline="") as f:
+            return f.read()
+
+    def write_patch(self, category, name, text):
+        path = os.path.join(patch_manager.PATCHES_DIR, category, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            f.write(text)
+        return path
+
+    def write_config(self, name, modes):
+        """modes为{类别: 模式}"""
+        config = {
+            "fingerprint_mode": "fixed",
+            "fingerprint_id": name,
+            "settings": {category: {"enabled": True, "mode": mode, "params": {}} for category, mode in modes.items()}
+        }
+        path = os.path.join(patch_manager.CONFIG_DIR, f"{name}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(config, f)
+        return path
+
+    def quiet(self, func, *args, **kwargs):
+        """执行func并丢弃输出，返回(结果, 输出文本)"""
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            result = func(*args, **kwargs)
+        return result, out.getvalue()
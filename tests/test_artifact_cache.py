@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+"""artifact_cache的回归测试"""
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import artifact_cache
+
+
+class EvictTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.out = os.path.join(self.tmp, "out")
+        os.makedirs(self.out)
+        self.cache = artifact_cache.ArtifactCache(os.path.join(self.tmp, "cache"), 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _store(self, key, size):
+        with open(os.path.join(self.out, "chrome"), "wb") as f:
+            f.write(b"x" * size)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return self.cache.store(key, self.out, ["chrome"])
+
+    def _keys(self):
+        return set(self.cache._load_index()["entries"])
+
+    def test_new_entry_survives_eviction(self):
+        self.assertTrue(self._store("a" * 64, 60))
+        self.assertTrue(self._store("b" * 64, 60))
+        self.assertEqual(self._keys(), {"b" * 64})
+
+    def test_oversized_entry_is_rejected(self):
+        self.assertTrue(self._store("a" * 64, 60))
+        self.assertFalse(self._store("b" * 64, 200))
+        self.assertEqual(self._keys(), {"a" * 64})
+        self.assertFalse(os.path.exists(os.path.join(self.cache.root, "b" * 64)))
+
+
+if __name__ == "__main__":
+    unittest.main()
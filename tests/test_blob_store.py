@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+"""blob_store的回归测试"""
+
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import blob_store
+
+
+class BackupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, "src")
+        os.makedirs(self.src)
+        self.file = os.path.join(self.src, "a.cc")
+        self._write(b"original\n")
+        self.store = blob_store.BlobStore(os.path.join(self.tmp, "backups"), self.src)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _write(self, data):
+        with open(self.file, "wb") as f:
+            f.write(data)
+
+    def test_known_patched_content_keeps_entry(self):
+        entry = self.store.backup(self.file, "a.cc")
+        self._write(b"patched\n")
+        patched = hashlib.sha256(b"patched\n").hexdigest()
+        self.assertEqual(self.store.backup(self.file, "a.cc", known_hashes={patched}), entry)
+        self.assertEqual(self.store.read(entry), b"original\n")
+
+    def test_updated_source_refreshes_entry(self):
+        self.store.backup(self.file, "a.cc")
+        self._write(b"upstream update\n")
+        entry = self.store.backup(self.file, "a.cc")
+        self.assertEqual(self.store.read(entry), b"upstream update\n")
+        self.assertEqual(self.store.get_entry("a.cc"), entry)
+
+    def test_missing_git_object_is_reported(self):
+        entry = {"sha256": hashlib.sha256(b"x").hexdigest(), "size": 1, "git_oid": "0" * 40}
+        subprocess.run(["git", "init", "-q", self.src], check=True)
+        with self.assertRaises(blob_store.BackupMissingError) as ctx:
+            self.store.read(entry, "a.cc")
+        self.assertIn("a.cc", str(ctx.exception))
+        self.assertIn("0" * 40, str(ctx.exception))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+"""check-compile在小型合成项目上的回归测试（需要g++）"""
+
+import json
+import os
+import re
+import shutil
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sandbox import SandboxTestCase, make_patch
+import ninja_deps
+import patch_manager
+
+HEADER = "#pragma once\nint Now();\n"
+PATCHED_HEADER = "#pragma once\nint Now();\ninline int Spoofed() { return 42; }\n"
+SOURCE = '#include "base/time/time.h"\n#include "generated.h"\nint Now() { return GENERATED; }\n'
+
+
+def write_ninja_deps(path, records):
+    """写入v4格式的.ninja_deps，records为[(输出路径, [依赖路径, ...]), ...]"""
+    data = bytearray(ninja_deps.DEPS_SIGNATURE + struct.pack("<I", 4))
+    ids = {}
+
+    def path_id(p):
+        if p not in ids:
+            raw = p.encode("utf-8")
+            raw += b"\0" * (-len(raw) % 4)
+            data.extend(struct.pack("<I", len(raw) + 4) + raw + struct.pack("<I", ~len(ids) & 0xFFFFFFFF))
+            ids[p] = len(ids)
+        return ids[p]
+
+    for output, deps in records:
+        out_id = path_id(output)
+        dep_ids = [path_id(d) for d in deps]
+        data.extend(struct.pack("<I", (12 + 4 * len(dep_ids)) | 0x80000000))
+        data.extend(struct.pack("<iQ", out_id, 0) + struct.pack(f"<{len(dep_ids)}i", *dep_ids))
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+@unittest.skipUnless(shutil.which("g++"), "需要g++")
+class CheckCompileCacheTest(SandboxTestCase):
+    MAPPINGS = {"language": ["base/time/time.h"]}
+
+    def setUp(self):
+        super().setUp()
+        self.write_src("base/time/time.h", HEADER)
+        self.write_src("base/time/time.cc", SOURCE)
+        self.write_src("out/Default/gen/generated.h", "#define GENERATED 1\n")
+        self.out_dir = self.src_path("out/Default")
+        with open(os.path.join(self.out_dir, "compile_commands.json"), "w", encoding="utf-8") as f:
+            json.dump([{
+                "directory": self.out_dir,
+                "file": "../../base/time/time.cc",
+                "command": "g++ -I../.. -Igen -c ../../base/time/time.cc -o obj/base/time/time.o"
+            }], f)
+        write_ninja_deps(os.path.join(self.out_dir, ".ninja_deps"), [
+            ("obj/base/time/time.o", ["../../base/time/time.cc", "../../base/time/time.h", "gen/generated.h"])
+        ])
+        self.write_patch("language", "custom_lang_time.h.patch", make_patch("base/time/time.h", HEADER, PATCHED_HEADER))
+        self.config = self.write_config("lang", {"language": "custom"})
+
+    def _compiled(self):
+        """执行check-compile，返回实际编译（未命中缓存）的翻译单元数"""
+        exit_code, output = self.quiet(patch_manager.check_compile, self.config, jobs=1)
+        self.assertEqual(exit_code, 0, output)
+        return int(re.search(r"需要编译 (\d+) 个翻译单元", output).group(1))
+
+    def test_output_deps_resolve_to_absolute_paths(self):
+        output = os.path.join(self.out_dir, "obj/base/time/time.o")
+        deps = ninja_deps.read_output_deps(self.out_dir, [output])
+        self.assertEqual(deps[output], [self.src_path("base/time/time.cc"), self.src_path("base/time/time.h"),
+                                        self.src_path("out/Default/gen/generated.h")])
+
+    def test_second_run_is_cached(self):
+        self.assertEqual(self._compiled(), 1)
+        self.assertEqual(self._compiled(), 0)
+
+    def test_unpatched_dependency_change_invalidates_cache(self):
+        self.assertEqual(self._compiled(), 1)
+        self.write_src("out/Default/gen/generated.h", "#define GENERATED 2\n")
+        self.assertEqual(self._compiled(), 1)
+        self.assertEqual(self._compiled(), 0)
+
+    def test_patch_change_invalidates_cache(self):
+        self.assertEqual(self._compiled(), 1)
+        self.write_patch("language", "custom_lang_time.h.patch",
+                         make_patch("base/time/time.h", HEADER, PATCHED_HEADER.replace("42", "7")))
+        patch_manager._PARSED_PATCHES.clear()
+        patch_manager._PATCH_HASHES.clear()
+        self.assertEqual(self._compiled(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""diff_engine的回归测试"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import diff_engine
+
+
+def _git_style_patch(rel_path, hunk_header, body_lines):
+    return f"--- a/{rel_path}\n+++ b/{rel_path}\n{hunk_header}\n" + "".join(line + "\n" for line in body_lines)
+
+
+class LineBreakTest(unittest.TestCase):
+    """上下文行中的\\f、U+2028等字符不能被当作换行"""
+
+    def _check_separator(self, separator):
+        old = f"int a;\nint b;{separator}// tail\nint c;\n".encode("utf-8")
+        expected = f"int a;\nint b;{separator}// tail\nint added;\nint c;\n".encode("utf-8")
+        patch = _git_style_patch("x.cc", "@@ -1,3 +1,4 @@", [
+            " int a;",
+            f" int b;{separator}// tail",
+            "+int added;",
+            " int c;",
+        ])
+        file_patch = diff_engine.parse_patch(patch)[0]
+        self.assertEqual(file_patch.hunks[0].old_count, 3)
+        self.assertEqual(file_patch.hunks[0].new_count, 4)
+        self.assertEqual(diff_engine.apply_to_bytes(old, file_patch), expected)
+
+    def test_form_feed_in_context(self):
+        self._check_separator("\x0c")
+
+    def test_line_separator_in_context(self):
+        self._check_separator("\u2028")
+
+    def test_make_patch_round_trip(self):
+        old = "a\nb\x0cc\u2028d\ne\n".encode("utf-8")
+        new = "a\nb\x0cc\u2028d\nnew\ne\n".encode("utf-8")
+        patch = diff_engine.make_patch(old, new, "y.cc")
+        self.assertEqual(diff_engine.apply_to_bytes(old, diff_engine.parse_patch(patch)[0]), new)
+
+    def test_decode_content_splits_on_newline_only(self):
+        data = "a\x0cb\u2028c\r\nd".encode("utf-8")
+        self.assertEqual(diff_engine.decode_content(data), ["a\x0cb\u2028c\r\n", "d"])
+
+
+class HunkCountTest(unittest.TestCase):
+
+    def test_truncated_hunk_is_rejected(self):
+        patch = _git_style_patch("x.cc", "@@ -1,3 +1,4 @@", [
+            " int a;",
+            "+int added;",
+        ])
+        with self.assertRaises(diff_engine.PatchError):
+            diff_engine.parse_patch(patch)
+
+    def test_crlf_patch(self):
+        patch = "--- a/x.cc\r\n+++ b/x.cc\r\n@@ -1,2 +1,3 @@\r\n a\r\n+b\r\n c\r\n"
+        file_patch = diff_engine.parse_patch(patch)[0]
+        self.assertEqual(diff_engine.apply_to_bytes(b"a\r\nc\r\n", file_patch), b"a\r\nb\r\nc\r\n")
+
+
+
+class FuzzTest(unittest.TestCase):
+    """默认要求上下文完全匹配，模糊匹配需要显式指定"""
+
+    OLD = "".join(f"line {i}\n" for i in range(20)).encode("utf-8")
+
+    def _patch(self):
+        # 首尾各有一行上下文与文件不一致
+        return diff_engine.parse_patch(_git_style_patch("x.cc", "@@ -5,4 +5,5 @@", [
+            " changed above",
+            " line 5",
+            "+added",
+            " line 6",
+            " changed below",
+        ]))[0]
+
+    def test_default_requires_exact_context(self):
+        with self.assertRaises(diff_engine.PatchError):
+            diff_engine.apply_to_bytes(self.OLD, self._patch())
+
+    def test_explicit_fuzz(self):
+        result = diff_engine.apply_to_bytes(self.OLD, self._patch(), fuzz=1)
+        self.assertIn(b"line 5\nadded\nline 6\n", result)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""patch_bisect中ddmin算法的回归测试"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import patch_bisect
+
+
+def failing_when(predicate):
+    """构造run_tests：predicate(子集)为True表示该子集测试失败，同时记录测试过的子集"""
+    tested = []
+
+    def run_tests(subsets):
+        tested.extend(subsets)
+        return [predicate(set(s)) for s in subsets]
+
+    return run_tests, tested
+
+
+class SplitTest(unittest.TestCase):
+
+    def test_chunks_cover_items_in_order(self):
+        self.assertEqual(patch_bisect.split(list(range(7)), 3), [(0, 1), (2, 3), (4, 5, 6)])
+
+
+class DdminTest(unittest.TestCase):
+
+    def test_single_culprit(self):
+        run_tests, tested = failing_when(lambda s: 11 in s)
+        subset, rounds, count = patch_bisect.ddmin(range(16), run_tests)
+        self.assertEqual(subset, (11,))
+        self.assertEqual(rounds, 4)
+        self.assertEqual(count, len(tested))
+
+    def test_interacting_pair(self):
+        run_tests, _ = failing_when(lambda s: {2, 13} <= s)
+        subset, _, _ = patch_bisect.ddmin(range(16), run_tests)
+        self.assertEqual(subset, (2, 13))
+
+    def test_result_is_one_minimal(self):
+        run_tests, _ = failing_when(lambda s: {1, 5} <= s or {5, 9, 12} <= s)
+        subset, _, _ = patch_bisect.ddmin(range(16), run_tests)
+        for item in subset:
+            self.assertFalse(run_tests([tuple(i for i in subset if i != item)])[0])
+
+    def test_subsets_are_tested_once(self):
+        run_tests, tested = failing_when(lambda s: {3, 4} <= s)
+        patch_bisect.ddmin(range(8), run_tests)
+        self.assertEqual(len(tested), len(set(tested)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+"""patch_daemon执行转发命令时的回归测试"""
+
+import io
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import patch_daemon
+import patch_manager
+
+
+class ClientEnvTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = patch_daemon.DaemonServer.__new__(patch_daemon.DaemonServer)
+        self.server.warm = patch_daemon.WarmCache(watching=False)
+        self.server.watcher = None
+        self.server._command_lock = threading.Lock()
+
+    def _run(self, env):
+        seen = {}
+
+        def fake_main(argv):
+            seen.update(os.environ)
+            return 0
+
+        request = {"argv": ["check-compile"], "cwd": os.getcwd(), "env": env}
+        with mock.patch.object(patch_manager, "main", fake_main):
+            exit_code = self.server.run_command(request, io.StringIO())
+        self.assertEqual(exit_code, 0)
+        return seen
+
+    def test_command_sees_client_environment(self):
+        before = dict(os.environ)
+        env = {"PATH": "/opt/client/bin", "CXX": "client-g++", "FP_BACKUP_MODE": "git"}
+        self.assertEqual(self._run(env), env)
+        self.assertEqual(dict(os.environ), before)
+
+
+if __name__ == "__main__":
+    unittest.main()
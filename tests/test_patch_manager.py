@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""patch_manager中应用、切换和还原的回归测试"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sandbox import SandboxTestCase, make_patch
+import patch_manager
+
+ORIGINAL = "int a;\nint b;\nint c;\n"
+PATCHED = "int a;\nint b;\nint patched;\nint c;\n"
+
+
+class ApplyDriftTest(SandboxTestCase):
+    MAPPINGS = {"language": ["base/time/time.cc"]}
+
+    def setUp(self):
+        super().setUp()
+        self.write_src("base/time/time.cc", ORIGINAL)
+        self.write_patch("language", "custom_lang_time.cc.patch", make_patch("base/time/time.cc", ORIGINAL, PATCHED))
+        self.config = self.write_config("lang", {"language": "custom"})
+
+    def test_apply_refuses_manually_edited_target(self):
+        self.assertIsNotNone(self.quiet(patch_manager.apply_fingerprint_patches, self.config)[0])
+        edited = PATCHED + "// local edit\n"
+        self.write_src("base/time/time.cc", edited)
+
+        record_id, output = self.quiet(patch_manager.apply_fingerprint_patches, self.config)
+        self.assertIsNone(record_id)
+        self.assertIn("base/time/time.cc", output)
+        self.assertEqual(self.read_src("base/time/time.cc"), edited)
+
+    def test_reapply_of_patched_target_is_not_drift(self):
+        self.quiet(patch_manager.apply_fingerprint_patches, self.config)
+        record_id, _ = self.quiet(patch_manager.apply_fingerprint_patches, self.config)
+        self.assertIsNotNone(record_id)
+        self.assertEqual(self.read_src("base/time/time.cc"), PATCHED)
+
+    def test_updated_source_is_backed_up_again(self):
+        self.quiet(patch_manager.apply_fingerprint_patches, self.config)
+        self.assertIsNotNone(self.quiet(patch_manager.restore_all_patches)[0])
+        upstream = "// upstream\n" + ORIGINAL
+        self.write_src("base/time/time.cc", upstream)
+
+        record_id, _ = self.quiet(patch_manager.apply_fingerprint_patches, self.config)
+        self.assertIsNotNone(record_id)
+        self.assertEqual(self.read_src("base/time/time.cc"), "// upstream\n" + PATCHED)
+        self.quiet(patch_manager.restore_all_patches)
+        self.assertEqual(self.read_src("base/time/time.cc"), upstream)
+
+    def test_refresh_backup_takes_current_content(self):
+        self.quiet(patch_manager.apply_fingerprint_patches, self.config)
+        self.write_src("base/time/time.cc", "// local\n" + ORIGINAL)
+        record_id, _ = self.quiet(patch_manager.apply_fingerprint_patches, self.config, refresh_backup=True)
+        self.assertIsNotNone(record_id)
+        self.assertEqual(self.read_src("base/time/time.cc"), "// local\n" + PATCHED)
+
+
+
+OTHER = "void f();\nvoid g();\nvoid h();\n"
+OTHER_PATCHED = "void f();\nvoid g();\nvoid patched();\nvoid h();\n"
+
+
+class SwitchTest(SandboxTestCase):
+    MAPPINGS = {"language": ["base/time/time.cc"], "timezone": ["base/other.cc"]}
+
+    def setUp(self):
+        super().setUp()
+        self.write_src("base/time/time.cc", ORIGINAL)
+        self.write_src("base/other.cc", OTHER)
+        self.write_patch("language", "custom_lang_time.cc.patch", make_patch("base/time/time.cc", ORIGINAL, PATCHED))
+        self.write_patch("timezone", "custom_tz_other.cc.patch", make_patch("base/other.cc", OTHER, OTHER_PATCHED))
+        self.both = self.write_config("both", {"language": "custom", "timezone": "custom"})
+        self.lang_only = self.write_config("lang_only", {"language": "custom"})
+        self.first_id = self.quiet(patch_manager.apply_fingerprint_patches, self.both)[0]
+        self.db = patch_manager.get_state_db()
+
+    def test_switch_does_not_revert_manual_edit(self):
+        edited = OTHER_PATCHED + "// local edit\n"
+        self.write_src("base/other.cc", edited)
+        record_id, output = self.quiet(patch_manager.switch_fingerprint_config, self.lang_only)
+        self.assertIsNone(record_id)
+        self.assertIn("base/other.cc", output)
+        self.assertEqual(self.read_src("base/other.cc"), edited)
+
+    def test_failed_target_keeps_old_record_active(self):
+        self.write_src("base/other.cc", OTHER_PATCHED + "// local edit\n")
+        self.quiet(patch_manager.switch_fingerprint_config, self.lang_only)
+        self.assertIn(self.first_id, self.db.active_ids())
+        self.assertIn("base/other.cc", patch_manager.active_patch_set())
+
+    def test_successful_switch_supersedes_old_record(self):
+        record_id, _ = self.quiet(patch_manager.switch_fingerprint_config, self.lang_only)
+        self.assertIsNotNone(record_id)
+        self.assertEqual(self.db.active_ids(), [record_id])
+        self.assertEqual(self.read_src("base/other.cc"), OTHER)
+        self.assertEqual(self.read_src("base/time/time.cc"), PATCHED)
+
+
+class RestoreTest(SandboxTestCase):
+    MAPPINGS = {"language": ["base/time/time.cc"]}
+
+    def setUp(self):
+        super().setUp()
+        self.write_src("base/time/time.cc", ORIGINAL)
+        self.write_patch("language", "custom_lang_time.cc.patch", make_patch("base/time/time.cc", ORIGINAL, PATCHED))
+        config = self.write_config("lang", {"language": "custom"})
+        self.record_id = self.quiet(patch_manager.apply_fingerprint_patches, config)[0]
+        self.db = patch_manager.get_state_db()
+
+    def test_restore_marks_records_restored(self):
+        self.assertEqual(self.quiet(patch_manager.restore_all_patches)[0], 1)
+        self.assertEqual(self.read_src("base/time/time.cc"), ORIGINAL)
+        self.assertEqual(self.db.active_ids(), [])
+
+    def test_missing_backup_keeps_records_active(self):
+        os.unlink(patch_manager.get_blob_store().manifest_file)
+        self.assertIsNone(self.quiet(patch_manager.restore_all_patches)[0])
+        self.assertEqual(self.db.active_ids(), [self.record_id])
+        self.assertEqual(self.read_src("base/time/time.cc"), PATCHED)
+
+    def test_mark_record_restored_requires_pristine_targets(self):
+        self.assertFalse(self.quiet(patch_manager.mark_record_restored, self.record_id)[0])
+        self.assertEqual(self.db.active_ids(), [self.record_id])
+        self.write_src("base/time/time.cc", ORIGINAL)
+        self.assertTrue(self.quiet(patch_manager.mark_record_restored, self.record_id)[0])
+        self.assertEqual(self.db.active_ids(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
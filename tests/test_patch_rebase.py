@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+"""patch_rebase的回归测试"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import diff_engine
+import patch_rebase
+
+OLD = "".join(f"line {i}\n" for i in range(20))
+
+
+class RebaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.from_src = os.path.join(self.tmp, "old")
+        self.to_src = os.path.join(self.tmp, "new")
+        os.makedirs(self.from_src)
+        os.makedirs(self.to_src)
+        self.patch_file = os.path.join(self.tmp, "custom_x.cc.patch")
+
+    def _setup(self, old, new, patch_text):
+        for root, text in ((self.from_src, old), (self.to_src, new)):
+            with open(os.path.join(root, "x.cc"), "w", encoding="utf-8") as f:
+                f.write(text)
+        with open(self.patch_file, "w", encoding="utf-8") as f:
+            f.write(patch_text)
+        return patch_rebase.rebase_patch(self.patch_file, self.from_src, self.to_src)
+
+    def test_exact_context_is_reapplied(self):
+        patch = diff_engine.make_patch(b"line 5\nline 6\n", b"line 5\nadded\nline 6\n", "x.cc")
+        # 补丁与旧版本不一致（旧版本没有这两行相邻），新版本中上下文完全匹配
+        result = self._setup("other\n", OLD, patch)
+        self.assertEqual(result["status"], patch_rebase.STATUS_REAPPLIED)
+
+    def test_fuzzed_result_needs_review(self):
+        patch = ("--- a/x.cc\n+++ b/x.cc\n@@ -5,4 +5,5 @@\n"
+                 " changed above\n line 5\n+added\n line 6\n changed below\n")
+        result = self._setup("other\n", OLD, patch)
+        self.assertEqual(result["status"], patch_rebase.STATUS_REVIEW)
+        self.assertEqual(result["targets"][0]["status"], patch_rebase.STATUS_REVIEW)
+        self.assertIn("+added", result["content"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Chrome trace-event格式的耗时记录
+
+通过 --trace out.json 启用后，各阶段以完整事件(ph=X)记录起止时间，ninja构建
+进度等以计数事件(ph=C)记录，生成的文件可直接在Perfetto或chrome://tracing中打开。
+同时在 out.json 旁写入 out.counters.jsonl，每行是一个阶段的汇总：
+  {"name": 阶段名, "cat": 分类, "count": 次数, "total_ms": 总耗时, "max_ms": 最长耗时, ...}
+
+时间戳取自单调时钟（Linux上为系统范围的CLOCK_MONOTONIC），子进程写出的trace
+文件可以直接合并到父进程的trace中。未启用时span()返回空上下文，几乎没有开销。
+"""
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+_NULL_SPAN = contextlib.nullcontext()
+
+_TRACER = None
+
+
+def _now_us():
+    return time.perf_counter_ns() / 1000.0
+
+
+class Tracer(object):
+    """收集一个进程内的trace事件"""
+
+    def __init__(self, path, process_name):
+        self.path = os.path.abspath(path)
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._events = [{"ph": "M", "name": "process_name", "pid": self.pid, "tid": 0,
+                         "args": {"name": process_name}}]
+        self._threads = set()
+        # (分类, 阶段名) -> 汇总计数
+        self._counters = {}
+        # 需要合并的子进程trace文件
+        self._children = []
+
+    def _tid(self):
+        tid = threading.get_native_id()
+        if tid not in self._threads:
+            self._threads.add(tid)
+            self._events.append({"ph": "M", "name": "thread_name", "pid": self.pid, "tid": tid,
+                                 "args": {"name": threading.current_thread().name}})
+        return tid
+
+    @contextlib.contextmanager
+    def span(self, name, cat, args):
+        start = _now_us()
+        try:
+            yield
+        finally:
+            dur = _now_us() - start
+            with self._lock:
+                event = {"ph": "X", "name": name, "cat": cat, "ts": start, "dur": dur,
+                         "pid": self.pid, "tid": self._tid()}
+                if args:
+                    event["args"] = args
+                self._events.append(event)
+                summary = self._counters.setdefault((cat, name), {"name": name, "cat": cat, "count": 0,
+                                                                  "total_ms": 0.0, "max_ms": 0.0})
+                summary["count"] += 1
+                summary["total_ms"] += dur / 1000.0
+                summary["max_ms"] = max(summary["max_ms"], dur / 1000.0)
+
+    def counter(self, name, values):
+        with self._lock:
+            self._events.append({"ph": "C", "name": name, "ts": _now_us(), "pid": self.pid,
+                                 "tid": self._tid(), "args": values})
+
+    def add(self, name, values):
+        with self._lock:
+            summary = self._counters.setdefault(("fp", name), {"name": name, "cat": "fp", "count": 0,
+                                                               "total_ms": 0.0, "max_ms": 0.0})
+            for key, value in values.items():
+                summary[key] = summary.get(key, 0) + value
+
+    def child_path(self, label):
+        """为子进程分配trace文件路径，stop时合并"""
+        path = f"{self.path}.{label}.{len(self._children)}.json"
+        self._children.append(path)
+        return path
+
+    def write(self):
+        events = list(self._events)
+        counters = [dict(c) for c in self._counters.values()]
+        for path in self._children:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    events.extend(json.load(f)["traceEvents"])
+                os.unlink(path)
+            except (OSError, ValueError, KeyError):
+                continue
+            counters_path = _counters_path(path)
+            if os.path.exists(counters_path):
+                with open(counters_path, "r", encoding="utf-8") as f:
+                    counters.extend(dict(json.loads(line), process="child") for line in f if line.strip())
+                os.unlink(counters_path)
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        with open(_counters_path(self.path), "w", encoding="utf-8") as f:
+            for summary in counters:
+                for key in ("total_ms", "max_ms"):
+                    summary[key] = round(summary[key], 3)
+                f.write(json.dumps(summary, ensure_ascii=False) + "\n")
+
+
+def _counters_path(path):
+    root, ext = os.path.splitext(path)
+    return f"{root}.counters.jsonl" if ext == ".json" else f"{path}.counters.jsonl"
+
+
+def start(path, process_name):
+    """开始记录，之后的span/counter写入path"""
+    global _TRACER
+    _TRACER = Tracer(path, process_name)
+    return _TRACER
+
+
+def stop():
+    """写出trace文件并停止记录"""
+    global _TRACER
+    tracer, _TRACER = _TRACER, None
+    if tracer is not None:
+        tracer.write()
+
+
+def enabled():
+    return _TRACER is not None
+
+
+def span(name, cat="fp", **args):
+    """记录一个阶段的耗时：with trace_events.span("backup", file=...): ..."""
+    if _TRACER is None:
+        return _NULL_SPAN
+    return _TRACER.span(name, cat, args)
+
+
+def traced(name, cat="fp"):
+    """装饰器：将整个函数调用记录为一个阶段"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _TRACER is None:
+                return func(*args, **kwargs)
+            with _TRACER.span(name, cat, None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def counter(name, **values):
+    """记录计数事件（在Perfetto中显示为曲线）"""
+    if _TRACER is not None:
+        _TRACER.counter(name, values)
+
+
+def add(name, **values):
+    """累加阶段汇总中的计数，例如处理的字节数"""
+    if _TRACER is not None:
+        _TRACER.add(name, values)
+
+
+def child_trace_path(label):
+    """为子进程分配trace文件路径，未启用时返回None"""
+    return _TRACER.child_path(label) if _TRACER is not None else None